@@ -0,0 +1,226 @@
+import os
+import glob
+import shutil
+import sqlite3
+import logging
+import datetime
+
+from hash_manifest import manifest_path_for
+
+logger = logging.getLogger()
+
+CATALOG_NAME = "backup_catalog.db" # created inside the destination directory
+PATH_BATCH_SIZE = 500 # paths looked up per query when interning them
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    id INTEGER PRIMARY KEY,
+    series TEXT NOT NULL,
+    name TEXT NOT NULL,
+    source TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL,
+    created REAL NOT NULL,
+    hash_algorithm TEXT,
+    file_count INTEGER NOT NULL,
+    total_bytes INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS backups_by_series ON backups (series, created);
+
+CREATE TABLE IF NOT EXISTS paths (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS files (
+    backup_id INTEGER NOT NULL REFERENCES backups (id),
+    path_id INTEGER NOT NULL REFERENCES paths (id),
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT,
+    PRIMARY KEY (backup_id, path_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS files_by_path ON files (path_id, backup_id);
+"""
+
+# retention buckets: (config attribute, strftime format of the bucket a backup falls in)
+RETENTION_BUCKETS = [
+    ("keep_daily", "%Y-%m-%d"),
+    ("keep_weekly", "%G-W%V"),
+    ("keep_monthly", "%Y-%m")
+]
+
+
+'''
+SQLite index of every backup written to a destination directory and the files in it
+(relative path, size, mtime and hash when a hash manifest was written), recorded when the backup
+is made, so listing backups, finding every version of a file and pruning old backups never
+need to open an archive or walk a copied tree.
+Paths are stored once in their own table and shared between backups, so thousands of backups
+of the same tree stay small.
+'''
+class BackupCatalog:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.db = sqlite3.connect(db_path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL") # readers (e.g. catalog.py) don't block a running backup
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA foreign_keys=ON")
+        self.db.executescript(SCHEMA)
+
+    @staticmethod
+    def for_destination(destination_path):
+        return BackupCatalog(os.path.join(destination_path, CATALOG_NAME))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    '''
+    records a backup and its files in a single transaction
+    series - backups that retention policies are applied to together (named after the source)
+    kind - dir, file, zip, tar, volumes or snapshot
+    files - relative path ("/" separated) -> (size, mtime_ns, hash or None)
+    returns the id of the new backup
+    '''
+    def add_backup(self, series, name, source, mode, kind, path, created, files, hash_algorithm=None) -> int:
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT INTO backups (series, name, source, mode, kind, path, created, hash_algorithm, file_count, total_bytes) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (series, name, source, mode, kind, path, created, hash_algorithm,
+                 len(files), sum(f[0] for f in files.values())))
+            backup_id = cursor.lastrowid
+
+            path_ids = self.intern_paths(list(files))
+            self.db.executemany(
+                "INSERT INTO files (backup_id, path_id, size, mtime_ns, hash) VALUES (?, ?, ?, ?, ?)",
+                ((backup_id, path_ids[rel_path], size, mtime_ns, digest)
+                 for rel_path, (size, mtime_ns, digest) in files.items()))
+
+        logger.info(f"Recorded backup {name} with {len(files)} files in the catalog: {self.db_path}")
+        return backup_id
+
+    # returns the id of every path, adding the ones that aren't in the catalog yet
+    def intern_paths(self, rel_paths) -> dict:
+        self.db.executemany("INSERT OR IGNORE INTO paths (path) VALUES (?)", ((p,) for p in rel_paths))
+        path_ids = {}
+        for start in range(0, len(rel_paths), PATH_BATCH_SIZE):
+            batch = rel_paths[start:start + PATH_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            for row in self.db.execute(f"SELECT id, path FROM paths WHERE path IN ({placeholders})", batch):
+                path_ids[row["path"]] = row["id"]
+        return path_ids
+
+    # every backup, newest first
+    def list_backups(self, series=None) -> list:
+        if series is None:
+            return self.db.execute("SELECT * FROM backups ORDER BY created DESC").fetchall()
+        return self.db.execute("SELECT * FROM backups WHERE series = ? ORDER BY created DESC", (series,)).fetchall()
+
+    def get_backup(self, name):
+        return self.db.execute("SELECT * FROM backups WHERE name = ? ORDER BY created DESC", (name,)).fetchone()
+
+    def list_files(self, backup_id) -> list:
+        return self.db.execute(
+            "SELECT paths.path, files.size, files.mtime_ns, files.hash FROM files "
+            "JOIN paths ON paths.id = files.path_id WHERE files.backup_id = ? ORDER BY paths.path",
+            (backup_id,)).fetchall()
+
+    # every backup holding a file matching a glob pattern (e.g. "docs/*.txt"), newest first
+    def find_files(self, pattern) -> list:
+        return self.db.execute(
+            "SELECT backups.name, backups.path AS backup_path, backups.created, paths.path, "
+            "files.size, files.mtime_ns, files.hash FROM paths "
+            "JOIN files ON files.path_id = paths.id "
+            "JOIN backups ON backups.id = files.backup_id "
+            "WHERE paths.path GLOB ? ORDER BY paths.path, backups.created DESC",
+            (pattern,)).fetchall()
+
+    # every backup holding the file at rel_path, newest first
+    def file_history(self, rel_path) -> list:
+        return self.db.execute(
+            "SELECT backups.name, backups.path AS backup_path, backups.created, "
+            "files.size, files.mtime_ns, files.hash FROM paths "
+            "JOIN files ON files.path_id = paths.id "
+            "JOIN backups ON backups.id = files.backup_id "
+            "WHERE paths.path = ? ORDER BY backups.created DESC",
+            (rel_path,)).fetchall()
+
+    # deletes the backup from disk (with its hash manifest), then from the catalog
+    # files are left alone if a newer entry points at the same path (backups with a fixed name overwrite each other)
+    def remove_backup(self, backup):
+        shared = self.db.execute("SELECT COUNT(*) FROM backups WHERE path = ? AND id != ?",
+                                 (backup["path"], backup["id"])).fetchone()[0]
+        if not shared:
+            delete_backup_files(backup["path"], backup["kind"])
+        with self.db:
+            self.db.execute("DELETE FROM files WHERE backup_id = ?", (backup["id"],))
+            self.db.execute("DELETE FROM backups WHERE id = ?", (backup["id"],))
+        logger.info(f"Pruned backup {backup['name']}: {backup['path']}")
+
+    '''
+    removes the backups of a series that fall outside the retention policy and returns them
+    keep_last - the newest N backups are kept
+    keep_daily/weekly/monthly - the newest backup of each of the last N days/weeks/months with backups is kept
+    only full backups are pruned: the incremental mirror is a single directory shared by every run,
+    and dedup snapshots share chunks with each other
+    '''
+    def apply_retention(self, series, keep_last=0, keep_daily=0, keep_weekly=0, keep_monthly=0) -> list:
+        backups = [b for b in self.list_backups(series) if b["mode"] == "full"]
+        expired = expired_backups(backups, keep_last, keep_daily, keep_weekly, keep_monthly)
+        for backup in expired:
+            try:
+                self.remove_backup(backup)
+            except OSError as e:
+                logger.error(f"Unable to prune backup {backup['name']}: {e}")
+
+        if expired:
+            # drop paths no backup refers to anymore
+            with self.db:
+                self.db.execute("DELETE FROM paths WHERE id NOT IN (SELECT path_id FROM files)")
+            logger.info(f"Retention policy pruned {len(expired)} of {len(backups)} backups of {series}")
+        return expired
+
+
+# picks the backups (newest first, with a "created" unix time) that none of the rules keep
+# a policy without any rule keeps everything
+def expired_backups(backups, keep_last=0, keep_daily=0, keep_weekly=0, keep_monthly=0) -> list:
+    limits = {"keep_daily": keep_daily, "keep_weekly": keep_weekly, "keep_monthly": keep_monthly}
+    if not keep_last and not any(limits.values()):
+        return []
+
+    backups = sorted(backups, key=lambda b: b["created"], reverse=True)
+    keep = {b["id"] for b in backups[:keep_last]}
+    for (rule, bucket_format) in RETENTION_BUCKETS:
+        buckets = set()
+        for backup in backups:
+            if len(buckets) >= limits[rule]:
+                break
+            bucket = datetime.datetime.fromtimestamp(backup["created"]).strftime(bucket_format)
+            if bucket not in buckets:
+                buckets.add(bucket)
+                keep.add(backup["id"])
+
+    return [b for b in backups if b["id"] not in keep]
+
+def delete_backup_files(path, kind):
+    if kind == "volumes":
+        # <archive>.001, <archive>.002, ...
+        paths = glob.glob(glob.escape(path[:-len(".001")]) + ".[0-9][0-9][0-9]")
+    else:
+        paths = [path]
+    paths.append(manifest_path_for(path))
+
+    for p in paths:
+        if os.path.isdir(p):
+            shutil.rmtree(p)
+        elif os.path.isfile(p):
+            os.remove(p)
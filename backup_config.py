@@ -2,20 +2,106 @@ import os
 from pathlib import Path
 
 class BackupConfig:
-    def __init__(self, source_path, destination_path, selected_file, backup_name, compress_backup, cloud_providers):
+    def __init__(self, source_path, destination_path, selected_file, backup_name, compress_backup, cloud_providers,
+                 backup_mode="full", hash_check="0", copy_workers=1, split_size=0,
+                 stream_archive="0", archive_format="zip",
+                 codec="deflate", compress_level=None, compress_workers=None,
+                 upload_chunk_size=32, upload_workers=4, cloud_sync="0",
+                 volume_size=0, max_pending_volumes=2,
+                 verbose="0", metrics_json="", prometheus_file="", progress_interval=5,
+                 copy_strategy="auto", hash_manifest="0", hash_algorithm="blake2b",
+                 catalog="0", keep_last=0, keep_daily=0, keep_weekly=0, keep_monthly=0,
+                 include=None, exclude=None, min_file_size=0, max_file_size=0, min_age=0, max_age=0,
+                 io_limit=0, upload_limit=0, low_priority="0", journal="0"):
         self.source_path = source_path.strip()
         self.destination_path = destination_path.strip()
         self.selected_file = selected_file.strip()
         self.backup_name = backup_name.strip()
         self.compress_backup = compress_backup.strip()
         self.cloud_providers = cloud_providers
+        # full - copy everything on each run, incremental - only copy files that changed since the last run,
+        # dedup - store files as deduplicated chunks and record each run as a snapshot
+        self.backup_mode = backup_mode.strip()
+        # 1 - hash files whose stat changed but size didn't, to avoid re-copying identical content
+        self.hash_check = hash_check.strip()
+        # number of files copied at the same time, 1 - copy one file at a time with shutil
+        self.copy_workers = copy_workers
+        # files at least this big (in MB) are split into byte ranges copied in parallel, 0 - never split
+        self.split_size = split_size
+        # 1 - when compressing, write the archive straight from the source instead of compressing a copy
+        self.stream_archive = stream_archive.strip()
+        # zip, tar, tar.gz, tar.bz2 or tar.xz (tar formats are only available when streaming)
+        self.archive_format = archive_format.strip()
+        # ZIP codec (stored, deflate, bzip2 or lzma) and level, None - the codec's default level
+        self.codec = codec.strip()
+        self.compress_level = compress_level
+        # number of threads compressing archive members, None - one per CPU core
+        self.compress_workers = compress_workers
+        # size (in MB) of each request in a resumable cloud upload
+        self.upload_chunk_size = upload_chunk_size
+        # number of files uploaded at the same time
+        self.upload_workers = upload_workers
+        # 1 - sync into a fixed cloud folder, skipping files whose remote checksum matches
+        self.cloud_sync = cloud_sync.strip()
+        # size (in MB) of each archive volume when streaming, 0 - write a single archive
+        self.volume_size = volume_size
+        # number of sealed volumes allowed to wait for upload before writing pauses
+        self.max_pending_volumes = max_pending_volumes
+        # 1 - log every file that is copied/compressed (DEBUG level)
+        self.verbose = verbose.strip()
+        # (optional) files to write the per-stage metrics of each backup to
+        self.metrics_json = metrics_json.strip()
+        self.prometheus_file = prometheus_file.strip()
+        # minimum number of seconds between progress messages
+        self.progress_interval = progress_interval
+        # auto - use the fastest copy method each file supports (reflink, copy_file_range, sendfile, basic),
+        # or the name of the first method to try
+        self.copy_strategy = copy_strategy.strip()
+        # 1 - write <backup>.hashes.json with the hash of every file, computed while the backup is written
+        self.hash_manifest = hash_manifest.strip()
+        # blake2b, sha256 or xxh3_128 (requires the xxhash package)
+        self.hash_algorithm = hash_algorithm.strip()
+        # 1 - record every backup and its files in backup_catalog.db in the destination directory
+        self.catalog = catalog.strip()
+        # retention policy applied to full backups through the catalog, 0 - rule not used
+        self.keep_last = keep_last
+        self.keep_daily = keep_daily
+        self.keep_weekly = keep_weekly
+        self.keep_monthly = keep_monthly
+        # glob patterns of the files/directories to back up or leave out (e.g. "node_modules", "*.tmp", ".git/objects")
+        self.include = include or []
+        self.exclude = exclude or []
+        # only back up files within this size range (in MB) and age range (in days since modified), 0 - no limit
+        self.min_file_size = min_file_size
+        self.max_file_size = max_file_size
+        self.min_age = min_age
+        self.max_age = max_age
+        # MB/s read from the source (copy, compression, streaming, dedup) and sent to cloud services, 0 - unlimited
+        self.io_limit = io_limit
+        self.upload_limit = upload_limit
+        # 1 - run the backup with low CPU and I/O priority
+        self.low_priority = low_priority.strip()
+        # 1 - copy into a staging directory with a journal of the finished files, so a failed backup resumes where it stopped
+        self.journal = journal.strip()
+        # results of the path checks below, so a backup doesn't stat the same paths over and over
+        self.path_checks = {}
 
     '''
     path and file check flags:
     0 - path/file name not specified (shown by asterisk)
     1 - path/file exists
     -1 - path/file does NOT exist
+    the result of each check is cached until clear_path_checks() is called (at the start of every backup)
     '''
+    def clear_path_checks(self):
+        self.path_checks = {}
+
+    # runs the check once and returns the cached result after that
+    def cached_check(self, key, check) -> int:
+        if key not in self.path_checks:
+            self.path_checks[key] = 1 if check() else -1
+        return self.path_checks[key]
+
     def check_file_existence(self) -> int:
         # -- checks if the file name is specified --
         if self.selected_file.strip() == "":
@@ -24,10 +110,7 @@ class BackupConfig:
         # -- check if the source directory exists --
         full_path_str = os.path.join(Path(self.source_path), self.selected_file)
         full_path_obj = Path(full_path_str)
-        if os.path.isfile(full_path_obj):
-            return 1
-        
-        return -1
+        return self.cached_check("file", lambda: os.path.isfile(full_path_obj))
     
     def check_source_path(self) -> int:
         # -- checks if the source directory is specified --
@@ -35,10 +118,7 @@ class BackupConfig:
             return 0
         
         # -- check if the source directory exists --
-        if os.path.isdir(self.source_path):
-            return 1
-        
-        return -1
+        return self.cached_check("source", lambda: os.path.isdir(self.source_path))
     
     def check_dest_path(self) -> int:
         # -- checks if the destination directory is specified --
@@ -46,11 +126,40 @@ class BackupConfig:
             return 0
 
         # -- check if the destination directory already exists --
-        if os.path.isdir(self.destination_path):
-            return 1
-        
-        return -1
+        return self.cached_check("dest", lambda: os.path.isdir(self.destination_path))
     
+    def is_incremental(self) -> bool:
+        return self.backup_mode == "incremental"
+
+    def is_dedup(self) -> bool:
+        return self.backup_mode == "dedup"
+
+    # streaming only applies to full backups, the other modes need a copy/store to compare against
+    def is_streaming(self) -> bool:
+        return self.compress_backup == "1" and self.stream_archive == "1" and self.backup_mode == "full"
+
+    # whether the backup ends up as a ZIP archive (compressed from a copy, or streamed)
+    def writes_zip(self) -> bool:
+        return self.compress_backup == "1" and self.backup_mode != "dedup" and (not self.is_streaming() or self.archive_format == "zip")
+
+    def uses_hash_manifest(self) -> bool:
+        return self.hash_manifest == "1"
+
+    def uses_retention(self) -> bool:
+        return any(keep > 0 for keep in (self.keep_last, self.keep_daily, self.keep_weekly, self.keep_monthly))
+
+    # retention is driven by the catalog, so setting a policy turns it on as well
+    def uses_catalog(self) -> bool:
+        return self.catalog == "1" or self.uses_retention()
+
+    # only full copies are journaled: streamed archives are already written to a .part file and renamed when complete,
+    # incremental mirrors and the dedup store only copy what they don't have on the next run
+    def uses_journal(self) -> bool:
+        return self.journal == "1" and self.backup_mode == "full" and not self.is_streaming()
+
+    def uses_volumes(self) -> bool:
+        return self.is_streaming() and self.volume_size > 0
+
     # check if the backup filename is specified in the config file
     def check_backup_name(self) -> bool:
         if self.backup_name == "":
@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import glob
+import shutil
+import logging
+import threading
+
+from tree_walker import TreeWalker
+
+logger = logging.getLogger()
+
+JOURNAL_VERSION = 1
+STAGING_SUFFIX = ".partial" # the backup is written here and renamed once complete
+JOURNAL_SUFFIX = ".journal"
+CHECKPOINT_INTERVAL = 5 # seconds between fsyncs of the journal
+
+'''
+Append-only journal of a full backup in progress, so a backup that dies halfway can be resumed
+<destination>/<backup name>.partial - staging copy the backup is written into
+<destination>/<backup name>.partial.journal - one JSON line describing the backup, then one line per finished file:
+                                              {"path", "size", "mtime_ns", "hash"}
+Lines are flushed as soon as a file is finished and fsync'ed every CHECKPOINT_INTERVAL seconds.
+A finished file is only skipped on resume if the source still has the size and mtime it was copied with,
+and the staged copy is still there with the same size and mtime (copy2 gives it the source's mtime),
+so files lost from the page cache by a power cut are copied again.
+Once every file is copied, the staging copy is renamed to its real name in one step (publish())
+and the journal is deleted.
+'''
+class BackupJournal:
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        self.staging_path = journal_path[:-len(JOURNAL_SUFFIX)]
+        self.header = {}
+        self.done = {} # relative path -> (size, mtime_ns, hash)
+        self.file = None
+        self.lock = threading.Lock()
+        self.last_sync = time.monotonic()
+
+    @staticmethod
+    def for_output(output_path):
+        return BackupJournal(f"{output_path}{STAGING_SUFFIX}{JOURNAL_SUFFIX}")
+
+    '''
+    returns the journal of an unfinished backup of source in destination_path, None if there isn't one
+    (the newest one when there are several)
+    '''
+    @staticmethod
+    def find(destination_path, source):
+        pattern = os.path.join(glob.escape(destination_path), f"*{STAGING_SUFFIX}{JOURNAL_SUFFIX}")
+        source = os.path.abspath(source)
+        for journal_path in sorted(glob.glob(pattern), key=os.path.getmtime, reverse=True):
+            try:
+                journal = BackupJournal(journal_path).load()
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable backup journal {journal_path}: {e}")
+                continue
+            if journal.header.get("source") == source:
+                return journal
+        return None
+
+    def name(self) -> str:
+        return self.header["name"]
+
+    def load(self):
+        with open(self.journal_path, "r", encoding="utf-8") as f:
+            lines = f.read().split("\n")
+
+        self.header = json.loads(lines[0])
+        if self.header.get("version") != JOURNAL_VERSION:
+            raise ValueError(f"unsupported journal version {self.header.get('version')}")
+
+        for line in lines[1:]:
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break # the last line was cut off by a crash
+            self.done[entry["path"]] = (entry["size"], entry["mtime_ns"], entry.get("hash"))
+        return self
+
+    '''
+    starts a new journal
+    source - absolute path of the file/directory being backed up
+    kind - dir or file
+    '''
+    def start(self, name, source, kind, hash_algorithm=None):
+        self.header = {
+            "version": JOURNAL_VERSION,
+            "name": name,
+            "source": os.path.abspath(source),
+            "kind": kind,
+            "hash_algorithm": hash_algorithm,
+            "started": time.time()
+        }
+        self.done = {}
+        self.file = open(self.journal_path, "w", encoding="utf-8")
+        self.write_line(self.header)
+        self.checkpoint()
+
+    # continues a loaded journal, new lines are appended to it
+    def resume(self):
+        self.file = open(self.journal_path, "a", encoding="utf-8")
+        logger.info(f"Resuming backup {self.name()} from its journal: {len(self.done)} files already copied")
+
+    # path of the staged copy of a file
+    def staged_path(self, rel_path) -> str:
+        return self.staging_path if self.header.get("kind") == "file" else os.path.join(self.staging_path, rel_path)
+
+    # whether a file was already copied by an earlier run and neither it nor its copy has changed since
+    def is_done(self, rel_path, st) -> bool:
+        entry = self.done.get(rel_path)
+        if entry is None or entry[0] != st.st_size or entry[1] != st.st_mtime_ns:
+            return False
+        try:
+            staged = os.stat(self.staged_path(rel_path))
+        except OSError:
+            return False
+        return staged.st_size == entry[0] and staged.st_mtime_ns == entry[1]
+
+    # marks a file as copied, called once its contents and metadata are in the staging copy
+    def record(self, rel_path, st, digest=None):
+        entry = {"path": rel_path, "size": st.st_size, "mtime_ns": st.st_mtime_ns, "hash": digest}
+        with self.lock:
+            self.done[rel_path] = (st.st_size, st.st_mtime_ns, digest)
+            self.write_line(entry)
+            if time.monotonic() - self.last_sync >= CHECKPOINT_INTERVAL:
+                self.checkpoint()
+
+    def write_line(self, data):
+        self.file.write(json.dumps(data) + "\n")
+        self.file.flush() # a killed process loses nothing that was recorded
+
+    # makes everything recorded so far survive a power cut
+    def checkpoint(self):
+        os.fsync(self.file.fileno())
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        if self.file:
+            self.checkpoint()
+            self.file.close()
+            self.file = None
+
+    '''
+    removes what earlier runs staged for files/directories the current walk didn't see (deleted from the source
+    or excluded since), so they aren't published, and forgets their journal entries
+    records - relative path -> stat record of every file walked
+    dirs - relative paths of every directory walked ("" for the root)
+    '''
+    def prune(self, records, dirs):
+        removed = 0
+        walker = TreeWalker(self.staging_path)
+        for (rel_dir, abs_dir, subdirs, files) in walker.walk():
+            for name in subdirs[:]:
+                if (os.path.join(rel_dir, name) if rel_dir else name) not in dirs:
+                    shutil.rmtree(os.path.join(abs_dir, name))
+                    subdirs.remove(name) # not walked into
+                    removed += 1
+            for (name, st) in files:
+                if (os.path.join(rel_dir, name) if rel_dir else name) not in records:
+                    os.remove(os.path.join(abs_dir, name))
+                    removed += 1
+        walker.check_errors()
+        with self.lock:
+            self.done = {rel_path: entry for (rel_path, entry) in self.done.items() if rel_path in records}
+        if removed:
+            logger.info(f"Removed {removed} files/directories from {self.staging_path} that are no longer in the source")
+
+    # renames the staging copy to output_path, then deletes the journal
+    def publish(self, output_path):
+        self.close()
+        os.replace(self.staging_path, output_path)
+        self.discard()
+
+    # deletes the journal (and whatever is left of the staging copy)
+    def discard(self):
+        self.close()
+        if os.path.isdir(self.staging_path):
+            shutil.rmtree(self.staging_path)
+        elif os.path.isfile(self.staging_path):
+            os.remove(self.staging_path)
+        if os.path.isfile(self.journal_path):
+            os.remove(self.journal_path)
@@ -0,0 +1,181 @@
+import os
+import json
+import stat
+import hashlib
+import logging
+import datetime
+
+from tree_walker import TreeWalker
+
+logger = logging.getLogger()
+
+MANIFEST_VERSION = 1
+HASH_BLOCK_SIZE = 1024 * 1024 # 1 MiB blocks when hashing file contents
+
+# Keeps track of every file in the last backup along with its size, modification time,
+# inode and (optionally) its content hash, so the next run only needs to copy what changed
+class BackupManifest:
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.files = {} # relative path -> {"size", "mtime_ns", "inode", "hash"}
+        self.dirs = set() # relative paths of every directory in the tree
+        self.last_run = {}
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.manifest_path)
+
+    def load(self):
+        if not self.exists():
+            return self
+
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        if data.get("version") != MANIFEST_VERSION:
+            logger.warning(f"Ignoring manifest {self.manifest_path} with unsupported version {data.get('version')}")
+            return self
+
+        self.files = data.get("files", {})
+        self.dirs = set(data.get("dirs", []))
+        self.last_run = data.get("last_run", {})
+        return self
+
+    def save(self):
+        data = {
+            "version": MANIFEST_VERSION,
+            "files": self.files,
+            "dirs": sorted(self.dirs),
+            "last_run": self.last_run
+        }
+
+        # write to a temporary file first, then swap it in, so a crash never leaves a half-written manifest
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    # walks the tree and collects a stat record for every file that passes the rules (a WalkRules, None - every file)
+    # start - (optional) relative path of a subdirectory to scan instead of the whole tree
+    # returns a tuple of (files, dirs) in the same shape as the manifest
+    @staticmethod
+    def scan(root, rules=None, start="") -> tuple:
+        files = {}
+        dirs = set()
+        walker = TreeWalker(root, rules)
+        for (rel_dir, abs_dir, subdirs, filenames) in walker.walk(start):
+            if rel_dir:
+                dirs.add(rel_dir)
+            for (name, st) in filenames:
+                files[os.path.join(rel_dir, name) if rel_dir else name] = BackupManifest.make_record(st)
+
+        walker.log_excluded()
+        walker.check_errors()
+        return (files, dirs)
+
+    # same as scan(), except only the given relative paths are looked at again
+    # everything else is taken from the manifest, so the cost depends on how many paths changed
+    def rescan(self, root, rel_paths, rules=None) -> tuple:
+        dirty = set(rel_paths)
+
+        # returns True if the path or any of its parent directories is dirty
+        def is_dirty(rel_path):
+            while rel_path:
+                if rel_path in dirty:
+                    return True
+                rel_path = os.path.dirname(rel_path)
+            return False
+
+        files = {rel_path: dict(record) for rel_path, record in self.files.items() if not is_dirty(rel_path)}
+        dirs = {rel_dir for rel_dir in self.dirs if not is_dirty(rel_dir)}
+
+        for rel_path in dirty:
+            abs_path = os.path.join(root, rel_path)
+            try:
+                st = os.stat(abs_path) # symlinks are followed, the same as scan()
+            except (FileNotFoundError, NotADirectoryError):
+                continue # deleted, or a dangling symlink
+            if stat.S_ISDIR(st.st_mode):
+                if rules and not rules.keep_path(rel_path):
+                    continue
+                if os.path.islink(abs_path) and TreeWalker(root).is_loop(abs_path):
+                    continue
+                # new/moved directory: pick up everything inside it
+                (sub_files, sub_dirs) = BackupManifest.scan(root, rules, rel_path)
+                files.update(sub_files)
+                dirs.update(sub_dirs)
+            elif stat.S_ISREG(st.st_mode) and (not rules or rules.keep_path(rel_path, st)):
+                files[rel_path] = BackupManifest.make_record(st)
+
+        # parent directories of new files have to exist in the mirror as well
+        for rel_path in list(files) + list(dirs):
+            parent = os.path.dirname(rel_path)
+            while parent and parent not in dirs:
+                dirs.add(parent)
+                parent = os.path.dirname(parent)
+
+        return (files, dirs)
+
+    @staticmethod
+    def make_record(st) -> dict:
+        return {
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "inode": st.st_ino,
+            "hash": None
+        }
+
+    @staticmethod
+    def hash_file(path) -> str:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                h.update(block)
+        return h.hexdigest()
+
+    # fast path: a file is unchanged if its size, mtime and inode all match the manifest
+    @staticmethod
+    def stat_matches(old, new) -> bool:
+        return (old["size"] == new["size"]
+            and old["mtime_ns"] == new["mtime_ns"]
+            and old["inode"] == new["inode"])
+
+    '''
+    compares the current state of the tree against the manifest
+    returns a tuple of (changed, deleted):
+    changed - relative paths of files that are new or have been modified
+    deleted - relative paths of files that are no longer in the source
+    when use_hash is set, files with the same size but a different mtime/inode
+    are hashed so that touched-but-identical files are not copied again
+    '''
+    def diff(self, current_files, root=None, use_hash=False) -> tuple:
+        changed = []
+        for rel_path, record in current_files.items():
+            old = self.files.get(rel_path)
+            if old is None:
+                changed.append(rel_path)
+                continue
+
+            if self.stat_matches(old, record):
+                record["hash"] = old.get("hash")
+                continue
+
+            if use_hash and old.get("hash") and old["size"] == record["size"] and root is not None:
+                try:
+                    record["hash"] = self.hash_file(os.path.join(root, rel_path))
+                except OSError as e:
+                    logger.warning(f"Unable to hash {rel_path}: {e}")
+                if record["hash"] == old["hash"]:
+                    continue
+
+            changed.append(rel_path)
+
+        deleted = [rel_path for rel_path in self.files if rel_path not in current_files]
+        return (changed, deleted)
+
+    def record_run(self, copied, deleted):
+        self.last_run = {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "copied": len(copied),
+            "deleted": sorted(deleted)
+        }
+
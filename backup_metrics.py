@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import logging
+import threading
+
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+
+# timers, file/byte counters and throughput for each stage of a backup (copy, compress, upload, ...)
+class BackupMetrics:
+    def __init__(self, backup_name):
+        self.backup_name = backup_name
+        self.started = time.time()
+        self.stages = {} # stage name -> {"seconds", "files", "bytes"}
+        self.succeeded = None
+        self.lock = threading.Lock()
+
+    def get_stage(self, name) -> dict:
+        return self.stages.setdefault(name, {"seconds": 0.0, "files": 0, "bytes": 0})
+
+    # times the code inside the with block as the given stage
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield self
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.get_stage(name)["seconds"] += elapsed
+
+    # adds time spent on a stage outside of a stage() block (e.g. on a background thread)
+    def add_seconds(self, stage, seconds):
+        with self.lock:
+            self.get_stage(stage)["seconds"] += seconds
+
+    def add(self, stage, files=0, nbytes=0):
+        with self.lock:
+            counters = self.get_stage(stage)
+            counters["files"] += files
+            counters["bytes"] += nbytes
+
+    def summary(self) -> dict:
+        with self.lock:
+            stages = {}
+            for name, counters in self.stages.items():
+                seconds = counters["seconds"]
+                stages[name] = dict(counters)
+                stages[name]["mb_per_sec"] = counters["bytes"] / (1024 * 1024) / seconds if seconds else 0.0
+                stages[name]["files_per_sec"] = counters["files"] / seconds if seconds else 0.0
+
+        return {
+            "backup_name": self.backup_name,
+            "started": self.started,
+            "total_seconds": time.time() - self.started,
+            "succeeded": self.succeeded,
+            "stages": stages
+        }
+
+    def write_json(self, path):
+        write_atomic(path, json.dumps(self.summary(), indent=2))
+        logger.info(f"Backup metrics written to: {path}")
+
+    # writes the metrics in the Prometheus text format, for node_exporter's textfile collector
+    def write_prometheus(self, path):
+        summary = self.summary()
+        lines = []
+
+        def metric(name, help_text, metric_type, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for (labels, value) in samples:
+                lines.append(f"{name}{labels} {value}")
+
+        stages = summary["stages"]
+        metric("backup_stage_duration_seconds", "Time spent in each stage of the last backup.", "gauge",
+               [(f'{{stage="{name}"}}', s["seconds"]) for name, s in stages.items()])
+        metric("backup_stage_files", "Files processed by each stage of the last backup.", "gauge",
+               [(f'{{stage="{name}"}}', s["files"]) for name, s in stages.items()])
+        metric("backup_stage_bytes", "Bytes processed by each stage of the last backup.", "gauge",
+               [(f'{{stage="{name}"}}', s["bytes"]) for name, s in stages.items()])
+        metric("backup_duration_seconds", "Total duration of the last backup.", "gauge",
+               [("", summary["total_seconds"])])
+        metric("backup_last_run_timestamp_seconds", "Unix time the last backup started.", "gauge",
+               [("", summary["started"])])
+        metric("backup_last_run_success", "1 if the last backup succeeded, 0 otherwise.", "gauge",
+               [("", 1 if summary["succeeded"] else 0)])
+
+        # the textfile collector may read the file at any time, so it's replaced atomically
+        write_atomic(path, "\n".join(lines) + "\n")
+        logger.info(f"Prometheus metrics written to: {path}")
+
+def write_atomic(path, text):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+# logs progress for a stage at most once every interval seconds, no matter how many files go through it
+class ProgressReporter:
+    def __init__(self, metrics, stage, interval=5.0):
+        self.metrics = metrics
+        self.stage = stage
+        self.interval = interval
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.files = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def update(self, files=0, nbytes=0):
+        self.metrics.add(self.stage, files, nbytes)
+        with self.lock:
+            self.files += files
+            self.bytes += nbytes
+            now = time.monotonic()
+            if now - self.last_report < self.interval:
+                return
+            self.last_report = now
+            files_done = self.files
+            bytes_done = self.bytes
+
+        elapsed = max(now - self.started, 1e-9)
+        logger.info(f"Progress [{self.stage}]: {files_done} files, {bytes_done / (1024 * 1024):.1f} MB "
+                    f"({bytes_done / (1024 * 1024) / elapsed:.1f} MB/s, {files_done / elapsed:.0f} files/s)")
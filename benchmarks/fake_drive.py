@@ -0,0 +1,129 @@
+import re
+import json
+import uuid
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+'''
+Minimal local stand-in for the Google Drive resumable upload endpoint
+Supports POST (new upload session), PATCH (update session) and PUT (chunks and status queries).
+Uploaded bytes are counted and thrown away, so it can take uploads of any size.
+keep_data - keep the bytes of every upload instead, completed uploads go into files (name -> bytes)
+Failures can be injected for testing: fail_next() answers the next chunks with an error status,
+expire_sessions() forgets every session the way Drive does after about a week.
+'''
+class FakeDriveServer:
+    def __init__(self, keep_data=False):
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.bytes_received = 0
+        self.files_completed = 0
+        self.sessions_started = 0
+        self.keep_data = keep_data
+        self.files = {}
+        self.failures = [] # statuses returned for the next chunks instead of accepting them
+        self.expired_status = 404 # status for requests to sessions that don't exist (anymore)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def upload_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}/upload/drive/v3/files"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # the next count chunks are answered with status (e.g. 503) and not stored
+    def fail_next(self, status, count=1):
+        with self.lock:
+            self.failures.extend([status] * count)
+
+    # forgets every upload session, requests to them get status (404 or 410) from now on
+    def expire_sessions(self, status=404):
+        with self.lock:
+            self.sessions.clear()
+            self.expired_status = status
+
+    def make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def read_body(self) -> bytes:
+                length = int(self.headers.get("Content-Length", 0))
+                return self.rfile.read(length) if length else b""
+
+            def reply(self, status, body=b"", headers=None):
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def start_session(self):
+                metadata = json.loads(self.read_body() or b"{}")
+                session_id = uuid.uuid4().hex
+                with fake.lock:
+                    fake.sessions[session_id] = {
+                        "name": metadata.get("name", ""),
+                        "size": int(self.headers.get("X-Upload-Content-Length", 0)),
+                        "received": 0,
+                        "data": bytearray()
+                    }
+                    fake.sessions_started += 1
+                location = f"http://127.0.0.1:{fake.server.server_port}/session/{session_id}"
+                self.reply(200, headers={"Location": location})
+
+            def do_POST(self):
+                self.start_session()
+
+            def do_PATCH(self):
+                self.start_session()
+
+            def do_PUT(self):
+                session = fake.sessions.get(self.path.rsplit("/", 1)[-1])
+                body = self.read_body()
+                if session is None:
+                    self.reply(fake.expired_status)
+                    return
+
+                if body:
+                    with fake.lock:
+                        failure = fake.failures.pop(0) if fake.failures else None
+                    if failure:
+                        self.reply(failure)
+                        return
+
+                match = re.match(r"bytes (\d+)-(\d+)/(\d+)", self.headers.get("Content-Range", ""))
+                if match and int(match.group(1)) == session["received"]:
+                    with fake.lock:
+                        session["received"] += len(body)
+                        fake.bytes_received += len(body)
+                        if fake.keep_data:
+                            session["data"] += body
+
+                if session["received"] >= session["size"]:
+                    with fake.lock:
+                        fake.files_completed += 1
+                        if fake.keep_data:
+                            fake.files[session["name"]] = bytes(session["data"])
+                    body = json.dumps({"id": uuid.uuid4().hex, "name": session["name"]}).encode()
+                    self.reply(200, body, {"Content-Type": "application/json"})
+                elif session["received"]:
+                    self.reply(308, headers={"Range": f"bytes=0-{session['received'] - 1}"})
+                else:
+                    self.reply(308)
+
+        return Handler
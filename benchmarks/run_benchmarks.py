@@ -0,0 +1,272 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+
+# the benchmarks import the backup script's modules from the repository root
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import resource # not available on Windows
+except ImportError:
+    resource = None
+
+# LocalBackupManager methods timed as stages
+STAGES = ["copy_file", "incremental_backup", "dedup_backup", "stream_backup", "compress_backup", "upload_to_cloud"]
+
+'''
+Synthetic source trees, sizes are multiplied by --scale
+tiny_files - lots of 1 KB text files spread over a few directories
+deep_nesting - a 40 level deep directory chain with a few files on each level
+huge_files - a few large, compressible files
+incompressible - random data that compression can't shrink
+'''
+def make_tiny_files(root, scale, rng):
+    for i in range(int(5000 * scale)):
+        directory = os.path.join(root, f"dir{i % 50:02d}")
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"file{i:06d}.txt"), "w") as f:
+            f.write(f"line {rng.random()}\n" * 40)
+
+def make_deep_nesting(root, scale, rng):
+    directory = root
+    for depth in range(40):
+        directory = os.path.join(directory, f"level{depth:02d}")
+        os.makedirs(directory, exist_ok=True)
+        for i in range(max(1, int(10 * scale))):
+            with open(os.path.join(directory, f"file{i}.txt"), "w") as f:
+                f.write(f"depth {depth} file {i}\n" * 200)
+
+def make_huge_files(root, scale, rng):
+    os.makedirs(root, exist_ok=True)
+    block = b"".join(f"record {i:08d} {rng.random():.12f}\n".encode() for i in range(32768)) # ~1 MiB
+    for i in range(3):
+        with open(os.path.join(root, f"huge{i}.log"), "wb") as f:
+            for _ in range(max(1, int(64 * scale))):
+                f.write(block)
+
+def make_incompressible(root, scale, rng):
+    os.makedirs(root, exist_ok=True)
+    for i in range(max(1, int(200 * scale))):
+        with open(os.path.join(root, f"random{i:04d}.bin"), "wb") as f:
+            f.write(rng.randbytes(256 * 1024))
+
+DATASETS = {
+    "tiny_files": make_tiny_files,
+    "deep_nesting": make_deep_nesting,
+    "huge_files": make_huge_files,
+    "incompressible": make_incompressible
+}
+
+'''
+backup modes that are benchmarked
+config - keyword arguments for BackupConfig
+warmup_runs - unmeasured runs into the same destination first (e.g. to measure a no-op incremental run)
+'''
+CASES = {
+    "full_copy": {"config": {}},
+    "parallel_copy": {"config": {"copy_workers": 8}},
+    "incremental_first": {"config": {"backup_mode": "incremental"}},
+    "incremental_rerun": {"config": {"backup_mode": "incremental"}, "warmup_runs": 1},
+    "dedup_first": {"config": {"backup_mode": "dedup"}},
+    "dedup_rerun": {"config": {"backup_mode": "dedup"}, "warmup_runs": 1},
+    "copy_then_zip": {"config": {"compress_backup": "1"}},
+    "stream_zip": {"config": {"compress_backup": "1", "stream_archive": "1"}},
+    "stream_tar_gz": {"config": {"compress_backup": "1", "stream_archive": "1", "archive_format": "tar.gz"}},
+    "zip_upload": {"config": {"compress_backup": "1", "stream_archive": "1"}, "cloud": True},
+    "volume_upload": {"config": {"compress_backup": "1", "stream_archive": "1", "volume_size": 16}, "cloud": True}
+}
+
+def tree_size(root) -> tuple:
+    files = 0
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for f in filenames:
+            files += 1
+            total += os.path.getsize(os.path.join(dirpath, f))
+    return (files, total)
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux reports kilobytes
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+# points the Google Drive module at the local fake endpoint
+def use_fake_drive(fake):
+    import requests
+    import google_drive_manager
+
+    google_drive_manager.UPLOAD_URL = fake.upload_url
+    google_drive_manager.authorise = lambda: None
+    google_drive_manager.AuthorizedSession = lambda creds: requests.Session()
+
+# wraps the stage methods of a manager so their durations are added to stages
+def instrument(manager, stages):
+    for name in STAGES:
+        original = getattr(manager, name)
+
+        def timed(*args, _original=original, _name=name, **kwargs):
+            started = time.perf_counter()
+            try:
+                return _original(*args, **kwargs)
+            finally:
+                stages[_name] = stages.get(_name, 0.0) + time.perf_counter() - started
+
+        setattr(manager, name, timed)
+
+# runs in a fresh process, so peak RSS only covers this case
+def run_case(case_name, dataset_path, work_dir):
+    from backup_config import BackupConfig
+    from local_backup_manager import LocalBackupManager
+    from fake_drive import FakeDriveServer
+
+    case = CASES[case_name]
+    os.chdir(work_dir)
+    os.makedirs("logs", exist_ok=True)
+    dest = os.path.join(work_dir, "dest")
+
+    fake = None
+    cloud = None
+    if case.get("cloud"):
+        fake = FakeDriveServer().start()
+        use_fake_drive(fake)
+        cloud = ["google_drive"]
+
+    def make_manager():
+        options = {"compress_backup": "0"}
+        options.update(case["config"])
+        compress = options.pop("compress_backup")
+        config = BackupConfig(dataset_path, dest, "", "", compress, cloud, **options)
+        return LocalBackupManager(config)
+
+    for _ in range(case.get("warmup_runs", 0)):
+        make_manager().perform_backup()
+        time.sleep(0.01) # backups are named with a millisecond timestamp
+
+    stages = {}
+    manager = make_manager()
+    instrument(manager, stages)
+    started = time.perf_counter()
+    result = manager.perform_backup()
+    elapsed = time.perf_counter() - started
+
+    output = {
+        "seconds": elapsed,
+        "succeeded": result is not None,
+        "stages": stages,
+        "peak_rss_kb": peak_rss_kb()
+    }
+    if fake:
+        output["uploaded_bytes"] = fake.bytes_received
+        output["uploaded_files"] = fake.files_completed
+        fake.stop()
+    return output
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+def get_cmd_parser():
+    parser = argparse.ArgumentParser(
+        prog="File Backup Script Benchmarks",
+        description="Runs every backup mode against synthetic source trees and reports the results as JSON")
+    parser.add_argument("--datasets",
+        help="Datasets to generate and benchmark. Default: all of them.",
+        nargs="*",
+        choices=list(DATASETS),
+        default=list(DATASETS))
+    parser.add_argument("--cases",
+        help="Backup modes to benchmark. Default: all of them.",
+        nargs="*",
+        choices=list(CASES),
+        default=list(CASES))
+    parser.add_argument("--scale",
+        help="Multiplies the size of every dataset. Default value will be 1.0.",
+        type=float,
+        default=1.0)
+    parser.add_argument("--seed",
+        help="Seed for the generated data, so runs can be compared. Default value will be 1234.",
+        type=int,
+        default=1234)
+    parser.add_argument("--work_dir",
+        help="Directory the datasets and backups are written to. Default: a new temporary directory.",
+        default=None)
+    parser.add_argument("-o", "--output",
+        help="File to write the JSON results to. Default: print to stdout.",
+        default=None)
+    return parser
+
+def main():
+    args = get_cmd_parser().parse_args()
+    work_root = args.work_dir or tempfile.mkdtemp(prefix="backup-bench-")
+    os.makedirs(work_root, exist_ok=True)
+
+    results = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "scale": args.scale,
+        "seed": args.seed,
+        "results": []
+    }
+
+    # each case gets its own process, created with "spawn" so nothing is inherited from earlier cases
+    context = multiprocessing.get_context("spawn")
+    try:
+        for dataset in args.datasets:
+            dataset_path = os.path.join(work_root, "datasets", dataset)
+            if not os.path.isdir(dataset_path):
+                DATASETS[dataset](dataset_path, args.scale, random.Random(args.seed))
+            (files, total_bytes) = tree_size(dataset_path)
+
+            for case_name in args.cases:
+                case_dir = os.path.join(work_root, "runs", dataset, case_name)
+                shutil.rmtree(case_dir, ignore_errors=True)
+                os.makedirs(case_dir)
+
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                    output = pool.submit(run_case, case_name, dataset_path, case_dir).result()
+                shutil.rmtree(case_dir, ignore_errors=True)
+
+                seconds = max(output["seconds"], 1e-9)
+                entry = {
+                    "dataset": dataset,
+                    "case": case_name,
+                    "files": files,
+                    "bytes": total_bytes,
+                    "mb_per_sec": total_bytes / (1024 * 1024) / seconds,
+                    "files_per_sec": files / seconds
+                }
+                entry.update(output)
+                results["results"].append(entry)
+                print(f"{dataset:>15} {case_name:>18}: {seconds:8.3f}s {entry['mb_per_sec']:9.1f} MB/s "
+                      f"{entry['files_per_sec']:10.1f} files/s", file=sys.stderr)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_root, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import os
+import sys
+import logging
+import sqlite3
+import argparse
+import datetime
+
+from backup_catalog import BackupCatalog, CATALOG_NAME, expired_backups
+
+logger = logging.getLogger()
+
+def format_time(timestamp) -> str:
+    return datetime.datetime.fromtimestamp(timestamp).strftime("%d-%b-%Y %H:%M:%S")
+
+def format_mtime(mtime_ns) -> str:
+    return format_time(mtime_ns / 1e9)
+
+def list_backups(catalog, args):
+    for backup in catalog.list_backups(args.series):
+        print(f"{format_time(backup['created'])}  {backup['mode']:<11} {backup['kind']:<8} "
+              f"{backup['file_count']:>8} files {backup['total_bytes'] / (1024 * 1024):>10.1f} MB  "
+              f"{backup['name']}  ({backup['path']})")
+
+def list_files(catalog, args):
+    backup = catalog.get_backup(args.backup_name)
+    if backup is None:
+        logger.error(f"No backup named {args.backup_name} in the catalog")
+        sys.exit(1)
+    for f in catalog.list_files(backup["id"]):
+        print(f"{f['size']:>12}  {format_mtime(f['mtime_ns'])}  {f['hash'] or '-'}  {f['path']}")
+
+def find_files(catalog, args):
+    for f in catalog.find_files(args.pattern):
+        print(f"{f['path']}  {f['size']} bytes, modified {format_mtime(f['mtime_ns'])}  in {f['name']}  ({f['backup_path']})")
+
+# lists each version of a file once (by size, mtime and hash), with the newest backup that has it
+def file_versions(catalog, args):
+    seen = set()
+    for f in catalog.file_history(args.path):
+        version = (f["size"], f["mtime_ns"], f["hash"])
+        if version in seen:
+            continue
+        seen.add(version)
+        print(f"{f['size']:>12}  {format_mtime(f['mtime_ns'])}  {f['hash'] or '-'}  newest in {f['name']}  ({f['backup_path']})")
+    if not seen:
+        logger.info(f"{args.path} isn't in any backup")
+
+def prune(catalog, args):
+    series_names = [args.series] if args.series else sorted({b["series"] for b in catalog.list_backups()})
+    for series in series_names:
+        if args.dry_run:
+            backups = [b for b in catalog.list_backups(series) if b["mode"] == "full"]
+            for backup in expired_backups(backups, args.keep_last, args.keep_daily, args.keep_weekly, args.keep_monthly):
+                print(f"Would prune {backup['name']}  ({backup['path']})")
+        else:
+            catalog.apply_retention(series, args.keep_last, args.keep_daily, args.keep_weekly, args.keep_monthly)
+
+def get_cmd_parser():
+    parser = argparse.ArgumentParser(
+        prog="File Backup Script Catalog",
+        description="Looks up backups and their files in the catalog of a destination directory (--catalog 1) and prunes old backups")
+    parser.add_argument("dest_path",
+        help=f"Destination directory holding {CATALOG_NAME}.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = commands.add_parser("list", help="Lists every backup, newest first.")
+    list_parser.add_argument("--series", help="Only list backups of this source/backup name.", default=None)
+    list_parser.set_defaults(run=list_backups)
+
+    files_parser = commands.add_parser("files", help="Lists the files in a backup.")
+    files_parser.add_argument("backup_name", help="Name of the backup.")
+    files_parser.set_defaults(run=list_files)
+
+    find_parser = commands.add_parser("find", help="Finds files matching a glob pattern (e.g. \"docs/*.txt\") in every backup.")
+    find_parser.add_argument("pattern", help="Glob pattern matched against paths relative to the source.")
+    find_parser.set_defaults(run=find_files)
+
+    versions_parser = commands.add_parser("versions", help="Lists every version of a file and the newest backup holding each one.")
+    versions_parser.add_argument("path", help="Path of the file relative to the source, \"/\" separated.")
+    versions_parser.set_defaults(run=file_versions)
+
+    prune_parser = commands.add_parser("prune", help="Deletes full backups that fall outside a retention policy.")
+    prune_parser.add_argument("--series", help="Only prune backups of this source/backup name. Default: every series.", default=None)
+    for (rule, period) in (("last", "newest N backups"), ("daily", "newest backup of each of the last N days"),
+                           ("weekly", "newest backup of each of the last N weeks"), ("monthly", "newest backup of each of the last N months")):
+        prune_parser.add_argument(f"--keep_{rule}", help=f"Keeps the {period}. Default value will be 0.", type=int, default=0)
+    prune_parser.add_argument("--dry_run", help="Only print what would be pruned.", action="store_true")
+    prune_parser.set_defaults(run=prune)
+    return parser
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(levelname)s] %(message)s"
+    )
+    args = get_cmd_parser().parse_args()
+
+    db_path = os.path.join(args.dest_path, CATALOG_NAME)
+    if not os.path.isfile(db_path):
+        logger.error(f"No catalog found at {db_path}")
+        sys.exit(2)
+
+    try:
+        with BackupCatalog(db_path) as catalog:
+            args.run(catalog, args)
+    except sqlite3.Error as e:
+        logger.error(f"Unable to read the catalog {db_path}: {e}")
+        sys.exit(2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+import os
+import json
+import zlib
+import random
+import hashlib
+import logging
+import datetime
+
+from tree_walker import TreeWalker
+
+# numpy is optional, without it chunk boundaries are found with a plain Python loop (around 5 MB/s)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger()
+
+SNAPSHOT_VERSION = 1
+
+# chunk size limits used by content-defined chunking
+MIN_CHUNK_SIZE = 256 * 1024
+AVG_CHUNK_SIZE = 1024 * 1024 # must be a power of 2
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+# each stored chunk starts with a single byte saying how its payload is encoded
+CHUNK_RAW = b"\x00"
+CHUNK_ZLIB = b"\x01"
+
+# gear table for the rolling hash, generated from a fixed seed so chunk boundaries
+# stay the same between runs (otherwise nothing would ever be deduplicated)
+_gear_rng = random.Random(0x6765617248617368)
+GEAR = [_gear_rng.getrandbits(64) for _ in range(256)]
+HASH_MASK_64 = (1 << 64) - 1
+# only the low bits of the hash are tested, so the vectorized search works on 32 bits when the mask fits
+GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint64) if numpy is not None else None
+GEAR_ARRAY_32 = GEAR_ARRAY.astype(numpy.uint32) if numpy is not None else None
+CUT_SCAN_BLOCK = 256 * 1024 # bytes hashed per numpy pass while looking for a cut point
+
+
+'''
+Repository-style backup destination:
+<repo_path>/chunks/<first 2 hash chars>/<sha256> - every unique chunk, stored once
+<repo_path>/snapshots/<backup_name>.json - one small index per backup, listing the chunks of every file
+Files are split with content-defined chunking (gear rolling hash), so an insertion/edit only
+changes the chunks around it and identical content is shared across files and snapshots.
+throttle - (optional) TokenBucket limiting the bytes read per second from the files being stored
+'''
+class ChunkStore:
+    def __init__(self, repo_path, compress=True,
+                 min_size=MIN_CHUNK_SIZE, avg_size=AVG_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE, throttle=None):
+        self.repo_path = repo_path
+        self.chunks_path = os.path.join(repo_path, "chunks")
+        self.snapshots_path = os.path.join(repo_path, "snapshots")
+        self.compress = compress
+        self.min_size = min_size
+        self.max_size = max_size
+        self.mask = avg_size - 1
+        self.known_chunks = set() # chunks confirmed to be in the store during this run
+        self.throttle = throttle
+
+        # statistics for the last snapshot
+        self.new_chunks = 0
+        self.new_bytes = 0
+        self.reused_files = 0
+        self.snapshot_files = 0
+
+    def init_repo(self):
+        os.makedirs(self.chunks_path, exist_ok=True)
+        os.makedirs(self.snapshots_path, exist_ok=True)
+
+    def chunk_path(self, chunk_hash) -> str:
+        return os.path.join(self.chunks_path, chunk_hash[:2], chunk_hash)
+
+    # returns the length of the next chunk at the start of data
+    # the cut point is where the rolling hash hits the mask, within [min_size, max_size]
+    def find_cut(self, data) -> int:
+        n = len(data)
+        if n <= self.min_size:
+            return n
+
+        end = min(n, self.max_size)
+        if numpy is None:
+            return self.find_cut_range(data, self.min_size, end) or end
+
+        # the hash is shifted left once per byte, so its low bits (the ones tested against the mask)
+        # only depend on the last window bytes and can be computed for every position at once
+        window = self.mask.bit_length()
+        head = min(end, self.min_size + window)
+        # until the hash covers a full window it also depends on where it started, so that part uses the loop
+        cut = self.find_cut_range(data, self.min_size, head)
+        if cut is not None or head == end:
+            return cut or end
+
+        table = GEAR_ARRAY_32 if window <= 32 else GEAR_ARRAY
+        values = numpy.frombuffer(data, dtype=numpy.uint8, count=end)
+        mask = table.dtype.type(self.mask)
+        for start in range(head, end, CUT_SCAN_BLOCK):
+            stop = min(end, start + CUT_SCAN_BLOCK)
+            h = self.window_hashes(table[values[start - window + 1:stop]], window)
+            hits = numpy.flatnonzero((h & mask) == 0)
+            if hits.size:
+                return start + int(hits[0]) + 1
+        return end
+
+    # hash of every window of window bytes in gear (gear values of the bytes), sum of gear[i - k] << k for k < window
+    # windows are built by doubling, so it takes log2(window) passes instead of one pass per byte
+    @staticmethod
+    def window_hashes(gear, window):
+        # joins hashes of the newest `width` bytes with the hashes of the `older_width` bytes before them
+        def combine(newer, width, older, older_width):
+            n = min(len(newer) - older_width, len(older))
+            return newer[older_width:older_width + n] + (older[:n] << newer.dtype.type(width))
+
+        h, width = None, 0
+        piece, piece_width = gear, 1
+        remaining = window
+        while True:
+            if remaining & 1:
+                h, width = (piece, piece_width) if h is None else (combine(piece, piece_width, h, width), piece_width + width)
+            remaining >>= 1
+            if not remaining:
+                return h
+            piece, piece_width = combine(piece, piece_width, piece, piece_width), piece_width * 2
+
+    # rolling hash over data[start:end] one byte at a time, starting from an empty hash
+    # returns None if there is no cut point in the range
+    def find_cut_range(self, data, start, end) -> int:
+        h = 0
+        mask = self.mask
+        gear = GEAR
+        for i in range(start, end):
+            h = ((h << 1) + gear[data[i]]) & HASH_MASK_64
+            if not (h & mask):
+                return i + 1
+        return None
+
+    # yields the chunks of a file one at a time, never holding more than max_size * 2 bytes in memory
+    def split_file(self, path):
+        with open(path, "rb") as f:
+            buf = bytearray()
+            eof = False
+            while True:
+                # keep at least max_size bytes buffered so every cut point can be found
+                while not eof and len(buf) < self.max_size:
+                    block = f.read(self.max_size)
+                    if not block:
+                        eof = True
+                    elif self.throttle:
+                        self.throttle.consume(len(block))
+                    buf += block
+
+                if not buf:
+                    return
+
+                cut = self.find_cut(buf)
+                yield bytes(buf[:cut])
+                del buf[:cut]
+
+    def has_chunk(self, chunk_hash) -> bool:
+        if chunk_hash in self.known_chunks:
+            return True
+        if os.path.exists(self.chunk_path(chunk_hash)):
+            self.known_chunks.add(chunk_hash)
+            return True
+        return False
+
+    # stores a chunk if it isn't in the repository yet, returns its hash
+    def put_chunk(self, data) -> str:
+        chunk_hash = hashlib.sha256(data).hexdigest()
+        if self.has_chunk(chunk_hash):
+            return chunk_hash
+
+        payload = CHUNK_RAW + data
+        if self.compress:
+            packed = zlib.compress(data, 1)
+            if len(packed) < len(data):
+                payload = CHUNK_ZLIB + packed
+
+        path = self.chunk_path(chunk_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write to a temporary file first so a crash never leaves a truncated chunk behind
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+
+        self.known_chunks.add(chunk_hash)
+        self.new_chunks += 1
+        self.new_bytes += len(payload)
+        return chunk_hash
+
+    def get_chunk(self, chunk_hash) -> bytes:
+        with open(self.chunk_path(chunk_hash), "rb") as f:
+            payload = f.read()
+
+        if payload[:1] == CHUNK_ZLIB:
+            return zlib.decompress(payload[1:])
+        return payload[1:]
+
+    def store_file(self, path) -> list:
+        return [self.put_chunk(chunk) for chunk in self.split_file(path)]
+
+    def list_snapshots(self) -> list:
+        if not os.path.isdir(self.snapshots_path):
+            return []
+        names = [os.path.splitext(f)[0] for f in os.listdir(self.snapshots_path) if f.endswith(".json")]
+        return sorted(names, key=lambda n: os.path.getmtime(self.snapshot_path(n)))
+
+    # returns the newest snapshot of source, {} if there isn't one
+    # the store is shared by every dedup backup in the destination, so the newest snapshot may be of another source
+    def latest_snapshot_of(self, source) -> dict:
+        source = os.path.abspath(source)
+        for name in reversed(self.list_snapshots()):
+            try:
+                snapshot = self.load_snapshot(name)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Unable to read previous snapshot {name}: {e}")
+                continue
+            if snapshot.get("source") == source:
+                return snapshot
+        return {}
+
+    def snapshot_path(self, name) -> str:
+        return os.path.join(self.snapshots_path, f"{name}.json")
+
+    def load_snapshot(self, name) -> dict:
+        with open(self.snapshot_path(name), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    '''
+    stores every file under source (a directory or a single file) and writes a snapshot index
+    files whose size and mtime match the previous snapshot reuse its chunk list without being read
+    rules - (optional) WalkRules deciding which files of a directory source are stored
+    returns the path of the snapshot index
+    '''
+    def create_snapshot(self, source, name, rules=None) -> str:
+        self.init_repo()
+        if numpy is None:
+            logger.warning("numpy isn't installed, new and changed files are split into chunks at only a few MB/s")
+        self.new_chunks = 0
+        self.new_bytes = 0
+        self.reused_files = 0
+
+        parent = self.latest_snapshot_of(source).get("files", {})
+
+        files = {}
+        dirs = []
+        if os.path.isdir(source):
+            walker = TreeWalker(source, rules)
+            for (rel_root, root, subdirs, filenames) in walker.walk():
+                if rel_root:
+                    dirs.append(rel_root)
+                for (f, st) in filenames:
+                    rel_path = os.path.join(rel_root, f) if rel_root else f
+                    files[rel_path] = self.snapshot_file(os.path.join(root, f), parent.get(rel_path), st)
+            walker.log_excluded()
+            walker.check_errors()
+        else:
+            rel_path = os.path.basename(source)
+            files[rel_path] = self.snapshot_file(source, parent.get(rel_path))
+
+        snapshot = {
+            "version": SNAPSHOT_VERSION,
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "source": os.path.abspath(source),
+            "dirs": dirs,
+            "files": files
+        }
+
+        self.snapshot_files = len(files)
+        path = self.snapshot_path(name)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+
+        logger.info(f"Snapshot {name}: {len(files)} files ({self.reused_files} unchanged), "
+                    f"{self.new_chunks} new chunks, {self.new_bytes} bytes written")
+        return path
+
+    # st - (optional) the file's stat result when the caller already has it
+    def snapshot_file(self, path, previous, st=None) -> dict:
+        st = st or os.stat(path)
+        if previous and previous["size"] == st.st_size and previous["mtime_ns"] == st.st_mtime_ns:
+            self.reused_files += 1
+            return previous
+
+        return {
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "mode": st.st_mode & 0o7777,
+            "chunks": self.store_file(path)
+        }
+
+    # writes a file from a snapshot back out to disk, restoring its mtime and permissions
+    def restore_file(self, entry, output_path):
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        with open(output_path, "wb") as f:
+            for chunk_hash in entry["chunks"]:
+                f.write(self.get_chunk(chunk_hash))
+        os.chmod(output_path, entry["mode"])
+        os.utime(output_path, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+
+    def restore_snapshot(self, name, output_path):
+        snapshot = self.load_snapshot(name)
+        for rel_dir in snapshot["dirs"]:
+            os.makedirs(os.path.join(output_path, rel_dir), exist_ok=True)
+        for rel_path, entry in snapshot["files"].items():
+            self.restore_file(entry, os.path.join(output_path, rel_path))
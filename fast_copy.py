@@ -0,0 +1,214 @@
+import os
+import sys
+import errno
+import shutil
+import logging
+import threading
+
+from hash_manifest import new_hasher
+
+try:
+    import fcntl # not available on Windows
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger()
+
+FICLONE = 0x40049409 # ioctl from linux/fs.h, makes the destination a copy-on-write clone of the source
+SYSCALL_CHUNK_SIZE = 64 * 1024 * 1024 # bytes requested per copy_file_range()/sendfile() call
+THROTTLED_CHUNK_SIZE = 1024 * 1024 # bytes per call when the copy is rate limited, so the rate stays smooth
+BASIC_BLOCK_SIZE = 1024 * 1024 # read/write size of the plain userspace copy
+
+# strategies in the order they are tried, fastest first
+STRATEGIES = ["reflink", "copy_file_range", "sendfile", "basic"]
+
+# errors meaning the strategy doesn't work for this pair of filesystems, rather than a real I/O error
+UNSUPPORTED_ERRORS = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL, errno.ENOSYS, errno.ENOTTY}
+
+
+class StrategyUnsupported(Exception):
+    pass
+
+
+def available_strategies() -> list:
+    available = []
+    is_linux = sys.platform.startswith("linux")
+    if fcntl is not None and is_linux:
+        available.append("reflink")
+    if hasattr(os, "copy_file_range"):
+        available.append("copy_file_range")
+    if hasattr(os, "sendfile") and is_linux: # other platforms only sendfile() into sockets
+        available.append("sendfile")
+    available.append("basic")
+    return available
+
+
+'''
+Copies files with the fastest method the source and destination filesystems support:
+reflink - FICLONE ioctl, an instant copy-on-write clone (btrfs, XFS, ...) when both files are on the same filesystem
+copy_file_range - copied inside the kernel, which may offload it to the filesystem/storage (NFS, SMB, ...)
+sendfile - copied inside the kernel without going through userspace buffers
+basic - plain read/write loop, works everywhere
+strategy - "auto" to try them all, or the name of the first strategy to try (the ones after it are the fallbacks)
+hash_algorithm - (optional) hash each file while it's copied, the digests are kept in hashes (destination path -> digest)
+unsupported - (optional) set of strategies known not to work, shared between copiers so each one doesn't have to find out again
+throttle - (optional) TokenBucket limiting the bytes copied per second (reflinks don't copy any data, so they aren't limited)
+A strategy that fails for a pair of devices isn't tried again for that pair.
+Hashing needs the data in userspace, so files are copied with the basic strategy when it's enabled.
+'''
+class FastCopier:
+    def __init__(self, strategy="auto", hash_algorithm=None, unsupported=None, throttle=None):
+        available = available_strategies()
+        first = 0 if strategy == "auto" else STRATEGIES.index(strategy)
+        self.strategies = [name for name in STRATEGIES[first:] if name in available]
+        self.unsupported = unsupported if unsupported is not None else set() # (strategy, source device, destination device)
+        self.counts = {name: 0 for name in STRATEGIES} # files copied with each strategy
+        self.bytes = {name: 0 for name in STRATEGIES}
+        self.hash_algorithm = hash_algorithm
+        self.hashes = {}
+        self.throttle = throttle
+        self.lock = threading.Lock()
+        self.copy_functions = {
+            "reflink": self.copy_reflink,
+            "copy_file_range": self.copy_kernel_range,
+            "sendfile": self.copy_sendfile,
+            "basic": self.copy_basic
+        }
+
+    # same as shutil.copy2(): copies the contents and the metadata, dst may be a directory
+    def copy2(self, src, dst):
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        self.copyfile(src, dst)
+        shutil.copystat(src, dst)
+        return dst
+
+    # copies the contents of src into dst, returns the name of the strategy used
+    def copyfile(self, src, dst) -> str:
+        with open(src, "rb", buffering=0) as fsrc, open(dst, "wb", buffering=0) as fdst:
+            src_fd = fsrc.fileno()
+            dst_fd = fdst.fileno()
+            if self.hash_algorithm:
+                hasher = new_hasher(self.hash_algorithm)
+                copied = self.copy_basic(src_fd, dst_fd, hasher)
+                with self.lock:
+                    self.hashes[dst] = hasher.hexdigest()
+                    self.counts["basic"] += 1
+                    self.bytes["basic"] += copied
+                return "basic"
+
+            src_dev = os.fstat(src_fd).st_dev
+            dst_dev = os.fstat(dst_fd).st_dev
+
+            for name in self.strategies:
+                key = (name, src_dev, dst_dev)
+                if key in self.unsupported:
+                    continue
+                try:
+                    copied = self.copy_functions[name](src_fd, dst_fd)
+                except StrategyUnsupported as e:
+                    logger.debug("%s isn't supported from device %s to %s (%s), falling back", name, src_dev, dst_dev, e)
+                    with self.lock:
+                        self.unsupported.add(key)
+                    # start over, in case the failed strategy copied part of the file
+                    os.lseek(src_fd, 0, os.SEEK_SET)
+                    os.lseek(dst_fd, 0, os.SEEK_SET)
+                    os.ftruncate(dst_fd, 0)
+                    continue
+
+                with self.lock:
+                    self.counts[name] += 1
+                    self.bytes[name] += copied
+                return name
+
+        # never reached, "basic" doesn't raise StrategyUnsupported
+        raise IOError(f"No copy strategy worked for {src}")
+
+    @staticmethod
+    def copy_reflink(src_fd, dst_fd) -> int:
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        except OSError as e:
+            if e.errno in UNSUPPORTED_ERRORS:
+                raise StrategyUnsupported(e)
+            raise
+        return os.fstat(src_fd).st_size
+
+    def is_throttled(self) -> bool:
+        return self.throttle is not None and self.throttle.is_limited()
+
+    # bytes requested per copy syscall
+    def syscall_chunk_size(self) -> int:
+        return THROTTLED_CHUNK_SIZE if self.is_throttled() else SYSCALL_CHUNK_SIZE
+
+    def copy_kernel_range(self, src_fd, dst_fd) -> int:
+        return self.copy_syscall_loop(lambda: os.copy_file_range(src_fd, dst_fd, self.syscall_chunk_size()), src_fd)
+
+    def copy_sendfile(self, src_fd, dst_fd) -> int:
+        return self.copy_syscall_loop(lambda: os.sendfile(dst_fd, src_fd, None, self.syscall_chunk_size()), src_fd)
+
+    # calls a copy syscall until it reaches the end of the source file, so files that grow are copied in full
+    def copy_syscall_loop(self, call, src_fd) -> int:
+        copied = 0
+        while True:
+            try:
+                n = call()
+            except OSError as e:
+                if copied == 0 and e.errno in UNSUPPORTED_ERRORS:
+                    raise StrategyUnsupported(e)
+                raise
+            if n == 0:
+                break
+            copied += n
+            if self.throttle:
+                self.throttle.consume(n)
+
+        # some filesystems (procfs, sysfs, ...) report 0 bytes for files that aren't empty
+        if copied == 0 and os.fstat(src_fd).st_size > 0:
+            raise StrategyUnsupported("no data copied")
+        return copied
+
+    def copy_basic(self, src_fd, dst_fd, hasher=None) -> int:
+        copied = 0
+        while True:
+            block = os.read(src_fd, BASIC_BLOCK_SIZE)
+            if not block:
+                break
+            if hasher:
+                hasher.update(block)
+            view = memoryview(block)
+            while view:
+                written = os.write(dst_fd, view)
+                view = view[written:]
+            copied += len(block)
+            if self.throttle:
+                self.throttle.consume(len(block))
+        return copied
+
+    # copies up to length bytes at offset from one open file to another inside the kernel
+    # used for the byte ranges of large files split across several threads
+    # returns the number of bytes copied, the caller copies whatever is left (0 if copy_file_range isn't usable)
+    def copy_range(self, src_fd, dst_fd, offset, length) -> int:
+        if "copy_file_range" not in self.strategies:
+            return 0
+
+        copied = 0
+        try:
+            while copied < length:
+                n = os.copy_file_range(src_fd, dst_fd, min(length - copied, self.syscall_chunk_size()),
+                                       offset + copied, offset + copied)
+                if n == 0:
+                    break
+                copied += n
+                if self.throttle:
+                    self.throttle.consume(n)
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_ERRORS:
+                raise
+        return copied
+
+    def summary(self) -> str:
+        with self.lock:
+            used = [f"{name}: {self.counts[name]} files ({self.bytes[name] / (1024 * 1024):.1f} MB)"
+                    for name in STRATEGIES if self.counts[name]]
+        return ", ".join(used) if used else "no files copied"
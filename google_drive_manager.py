@@ -1,22 +1,62 @@
+import io
+import json
+import time
+import hashlib
 import logging
 import mimetypes
 import os.path
+import threading
 
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
-from google.auth.transport.requests import Request
+import requests
+
+from throttle import ThrottledReader
+
+from google.auth.transport.requests import AuthorizedSession, Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaFileUpload
 
 # If modifying these scopes, delete the file token_GoogleDrive.json.
 SCOPES = ["https://www.googleapis.com/auth/drive"]
 
 logger = logging.getLogger()
 
+UPLOAD_URL = "https://www.googleapis.com/upload/drive/v3/files"
+# stores the session URIs of resumable uploads that haven't finished yet, so they can be continued
+SESSIONS_FILE = "upload_sessions_GoogleDrive.json"
+CHUNK_ALIGNMENT = 256 * 1024 # Drive requires chunk sizes to be a multiple of 256 KiB
+DEFAULT_CHUNK_SIZE = 32 * 1024 * 1024
+MAX_RETRIES = 5
+
+# credentials and the Drive service are cached for the lifetime of the process,
+# so successive uploads don't re-read the token file or rebuild the service
+_cache_lock = threading.Lock()
+_cached_creds = None
+_cached_service = None
+
 def authorise():
+	global _cached_creds
+	with _cache_lock:
+		if _cached_creds and _cached_creds.valid:
+			return _cached_creds
+		if _cached_creds and _cached_creds.expired and _cached_creds.refresh_token:
+			_cached_creds.refresh(Request())
+			return _cached_creds
+		_cached_creds = load_credentials()
+		return _cached_creds
+
+def get_service(creds):
+	global _cached_service
+	with _cache_lock:
+		if _cached_service is None:
+			_cached_service = build("drive", "v3", credentials=creds)
+		return _cached_service
+
+def load_credentials():
 	creds = None
 	# The file token_GoogleDrive.json stores the user's access and refresh tokens, and is
 	# created automatically when the authorization flow completes for the first
@@ -37,31 +77,375 @@ def authorise():
 			token.write(creds.to_json())
 	return creds
 
-def upload(creds, backup_path):
+def upload(creds, backup_path, chunk_size=DEFAULT_CHUNK_SIZE, throttle=None):
 	try:
-		service = build("drive", "v3", credentials=creds)
-		mimetype = mimetypes.guess_type(backup_path) # get file's mimetype
-		
+		logger.info(f"Uploading file {os.path.basename(backup_path)} to Google Drive...")
+		output = DriveUploader(creds, chunk_size=chunk_size, throttle=throttle).upload(backup_path)
+		logger.info(f"Upload successful!")
+		return output
+	except (requests.RequestException, DriveUploadError) as error:
+		# handle API error
+		logger.info(f"An error occurred while uploading the file: {error}")
+
+class DriveUploadError(Exception):
+	pass
+
+# the resumable session is gone (Drive answers 404/410 once it expires), the upload has to start over
+class DriveSessionExpired(DriveUploadError):
+	pass
+
+'''
+Uploads files to Google Drive with the resumable upload protocol
+chunk_size - bytes sent per request (rounded down to a multiple of 256 KiB)
+workers - number of files uploaded at the same time by upload_many()
+sessions_file - where the session URIs of unfinished uploads are saved, so an interrupted
+upload continues from the last byte Drive acknowledged instead of starting over
+upload_url/session_factory - can be pointed at a local fake endpoint for testing
+throttle - (optional) TokenBucket limiting the bytes sent per second, shared by every upload thread
+'''
+class DriveUploader:
+	def __init__(self, creds, chunk_size=DEFAULT_CHUNK_SIZE, workers=4, sessions_file=SESSIONS_FILE,
+				 upload_url=None, session_factory=None, throttle=None):
+		self.creds = creds
+		self.chunk_size = max(CHUNK_ALIGNMENT, chunk_size - chunk_size % CHUNK_ALIGNMENT)
+		self.workers = max(1, workers)
+		self.sessions_file = sessions_file
+		self.upload_url = upload_url or UPLOAD_URL
+		self.session_factory = session_factory or (lambda: AuthorizedSession(self.creds))
+		self.local = threading.local() # one HTTP session per thread
+		self.sessions_lock = threading.Lock()
+		self.throttle = throttle
+
+	def get_http(self):
+		if not hasattr(self.local, "http"):
+			self.local.http = self.session_factory()
+		return self.local.http
+
+	'''
+	uploads several files at the same time, returns the Drive metadata for each (None on failure)
+	jobs - list of (path, parents, file_id) tuples, file_id is the existing Drive file to overwrite (or None)
+	'''
+	def upload_many(self, jobs) -> list:
+		def upload_one(job):
+			(path, parents, file_id) = job
+			try:
+				return self.upload(path, parents, file_id=file_id)
+			except (requests.RequestException, DriveUploadError, OSError) as error:
+				logger.error(f"An error occurred while uploading {path}: {error}")
+				return None
+
+		with ThreadPoolExecutor(max_workers=self.workers) as pool:
+			return list(pool.map(upload_one, jobs))
+
+	def upload(self, path, parents=None, name=None, file_id=None) -> dict:
+		path = os.path.abspath(path)
+		size = os.path.getsize(path)
+		mtime_ns = os.stat(path).st_mtime_ns
+
+		# continue a previous upload of the same (unchanged) file if there is one
+		session = self.load_session(path)
+		offset = None
+		if session and session["size"] == size and session["mtime_ns"] == mtime_ns:
+			offset = self.query_offset(session["uri"], size)
+			if isinstance(offset, dict): # the previous upload had actually finished
+				self.remove_session(path)
+				return offset
+			if offset is not None:
+				logger.info(f"Resuming upload of {path} from byte {offset}")
+
+		if offset is None:
+			session = self.new_session(path, size, mtime_ns, parents, name, file_id)
+			offset = 0
+
+		try:
+			result = self.send_chunks(path, session["uri"], size, offset)
+		except DriveSessionExpired:
+			logger.warning(f"Upload session for {path} has expired, starting the upload over")
+			session = self.new_session(path, size, mtime_ns, parents, name, file_id)
+			result = self.send_chunks(path, session["uri"], size, 0)
+		self.remove_session(path)
+		return result
+
+	# starts a resumable upload session and saves it, so an interrupted upload can continue from it
+	def new_session(self, path, size, mtime_ns, parents, name, file_id) -> dict:
+		session = {"uri": self.start_session(path, size, parents, name, file_id), "size": size, "mtime_ns": mtime_ns}
+		self.save_session(path, session)
+		return session
+
+	# creates a resumable upload session and returns its URI
+	# if file_id is given, the upload replaces the contents of that file instead of creating a new one
+	def start_session(self, path, size, parents, name, file_id=None) -> str:
+		mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream" # get file's mimetype
+
 		# set file metadata for the output file (the file that is uploaded to google drive)
 		file_metadata = {
-			"name": os.path.basename(backup_path),
+			"name": name or os.path.basename(path),
 			"mimeType": mimetype,
-			"parents": [] # <== TO UPLOAD FILES TO A PARTICULAR FOLDER, ADD ITS FOLDER ID HERE 
+			"parents": parents or [] # <== TO UPLOAD FILES TO A PARTICULAR FOLDER, ADD ITS FOLDER ID HERE 
 		}
 
-		media = MediaFileUpload(backup_path, resumable=True)
+		url = self.upload_url
+		method = "POST"
+		if file_id:
+			url = f"{self.upload_url}/{file_id}"
+			method = "PATCH"
+			del file_metadata["parents"] # parents can't be set when updating a file
+
+		response = self.get_http().request(
+			method,
+			url,
+			params={"uploadType": "resumable", "fields": "id, name"},
+			headers={
+				"Content-Type": "application/json; charset=UTF-8",
+				"X-Upload-Content-Type": mimetype,
+				"X-Upload-Content-Length": str(size)
+			},
+			data=json.dumps(file_metadata)
+		)
+		if response.status_code != 200 or "Location" not in response.headers:
+			raise DriveUploadError(f"Unable to start upload session ({response.status_code}): {response.text}")
+		return response.headers["Location"]
+
+	'''
+	asks Drive how much of an upload it has received
+	returns the offset to continue from, the file metadata (dict) if the upload is already complete,
+	or None if the session has expired and the upload has to start over
+	'''
+	def query_offset(self, uri, size):
+		try:
+			response = self.get_http().put(uri, headers={"Content-Length": "0", "Content-Range": f"bytes */{size}"})
+		except requests.RequestException:
+			return None
+
+		if response.status_code in (200, 201):
+			return response.json()
+		if response.status_code == 308:
+			return self.parse_range(response)
+		return None
+
+	# the Range header of a 308 response holds the last byte received, e.g. "bytes=0-1048575"
+	@staticmethod
+	def parse_range(response) -> int:
+		received = response.headers.get("Range")
+		if not received:
+			return 0
+		return int(received.split("-")[-1]) + 1
+
+	def send_chunks(self, path, uri, size, offset) -> dict:
+		retries = 0
+		with open(path, "rb") as f:
+			while True:
+				f.seek(offset)
+				chunk = f.read(self.chunk_size)
+				end = offset + len(chunk) - 1
+				content_range = f"bytes {offset}-{end}/{size}" if chunk else f"bytes */{size}"
+
+				# a limited upload streams the chunk through the throttle as it's sent, instead of in one burst
+				data = chunk
+				if self.throttle and self.throttle.is_limited() and chunk:
+					data = ThrottledReader(io.BytesIO(chunk), self.throttle, len(chunk))
+
+				try:
+					response = self.get_http().put(uri, data=data, headers={"Content-Range": content_range})
+				except requests.RequestException as e:
+					response = None
+					error = e
+
+				if response is not None and response.status_code in (200, 201):
+					return response.json()
 
-		logger.info(f"Uploading file {file_metadata['name']} to Google Drive...")
+				if response is not None and response.status_code == 308:
+					offset = self.parse_range(response)
+					retries = 0
+					continue
 
-		output = (
-			service.files()
-			.create(body=file_metadata, media_body=media, fields="id, name")
+				# connection error or server error: back off, then ask Drive where to continue from
+				if response is not None:
+					if response.status_code in (404, 410):
+						raise DriveSessionExpired(f"Upload session for {path} has expired")
+					if response.status_code < 500 and response.status_code != 429:
+						raise DriveUploadError(f"Upload of {path} failed ({response.status_code}): {response.text}")
+					error = f"HTTP {response.status_code}"
+
+				retries += 1
+				if retries > MAX_RETRIES:
+					raise DriveUploadError(f"Upload of {path} failed after {MAX_RETRIES} retries: {error}")
+				logger.warning(f"Upload of {path} interrupted ({error}), retrying...")
+				time.sleep(min(2 ** retries, 30))
+
+				resumed = self.query_offset(uri, size)
+				if isinstance(resumed, dict):
+					return resumed
+				if resumed is None:
+					raise DriveSessionExpired(f"Upload session for {path} has expired")
+				offset = resumed
+
+	def load_sessions(self) -> dict:
+		if not os.path.exists(self.sessions_file):
+			return {}
+		try:
+			with open(self.sessions_file, "r") as f:
+				return json.load(f)
+		except (OSError, ValueError):
+			return {}
+
+	def load_session(self, path):
+		with self.sessions_lock:
+			return self.load_sessions().get(path)
+
+	def save_session(self, path, session):
+		with self.sessions_lock:
+			sessions = self.load_sessions()
+			sessions[path] = session
+			self.write_sessions(sessions)
+
+	def remove_session(self, path):
+		with self.sessions_lock:
+			sessions = self.load_sessions()
+			if sessions.pop(path, None) is not None:
+				self.write_sessions(sessions)
+
+	def write_sessions(self, sessions):
+		tmp_path = f"{self.sessions_file}.tmp"
+		with open(tmp_path, "w") as f:
+			json.dump(sessions, f)
+		os.replace(tmp_path, self.sessions_file)
+
+
+'''
+Copies a local file/directory to a Drive folder, only uploading files that differ from what's already there
+Remote metadata (size and md5Checksum) is fetched one folder at a time in pages of up to 1000 files,
+local files are only hashed when their size matches the remote copy, and files that differ are
+uploaded concurrently (overwriting the remote copy). Files deleted locally are left in Drive.
+'''
+class DriveSync:
+	FOLDER_MIMETYPE = "application/vnd.google-apps.folder"
+
+	def __init__(self, service, uploader, hash_workers=4):
+		self.service = service
+		self.uploader = uploader
+		self.hash_workers = max(1, hash_workers)
+		self.skipped = 0
+
+	# local_path - file or directory to sync, folder_name - Drive folder (in the root of My Drive) to sync it into
+	def sync(self, local_path, folder_name) -> list:
+		self.skipped = 0
+		folder_id = self.find_or_create_folder(folder_name, "root")
+
+		jobs = []
+		if os.path.isdir(local_path):
+			self.collect_directory(local_path, folder_id, jobs)
+		else:
+			remote = self.list_folder(folder_id)
+			jobs.extend(self.compare_files([(local_path, os.path.basename(local_path))], remote, folder_id))
+
+		logger.info(f"Google Drive sync: {len(jobs)} files to upload, {self.skipped} unchanged")
+		return self.uploader.upload_many(jobs)
+
+	def collect_directory(self, local_dir, folder_id, jobs):
+		remote = self.list_folder(folder_id)
+		local_files = []
+
+		with os.scandir(local_dir) as it:
+			entries = sorted(it, key=lambda e: e.name)
+
+		for entry in entries:
+			if entry.is_dir(follow_symlinks=False):
+				sub_folder = remote.get(entry.name)
+				if sub_folder and sub_folder["mimeType"] == self.FOLDER_MIMETYPE:
+					sub_folder_id = sub_folder["id"]
+				else:
+					sub_folder_id = self.create_folder(entry.name, folder_id)
+				self.collect_directory(entry.path, sub_folder_id, jobs)
+			elif entry.is_file():
+				local_files.append((entry.path, entry.name))
+
+		jobs.extend(self.compare_files(local_files, remote, folder_id))
+
+	# returns upload jobs for the files that are missing remotely or have different contents
+	def compare_files(self, local_files, remote, folder_id) -> list:
+		jobs = []
+		to_hash = []
+		for (path, name) in local_files:
+			remote_file = remote.get(name)
+			if remote_file is None or remote_file["mimeType"] == self.FOLDER_MIMETYPE:
+				jobs.append((path, [folder_id], None))
+			elif int(remote_file.get("size", -1)) != os.path.getsize(path):
+				jobs.append((path, [folder_id], remote_file["id"]))
+			else:
+				to_hash.append((path, remote_file))
+
+		# only same-sized files need hashing, which is done in parallel (hashlib releases the GIL)
+		with ThreadPoolExecutor(max_workers=self.hash_workers) as pool:
+			hashes = pool.map(lambda item: md5_file(item[0]), to_hash)
+			for ((path, remote_file), local_md5) in zip(to_hash, hashes):
+				if local_md5 == remote_file.get("md5Checksum"):
+					self.skipped += 1
+				else:
+					jobs.append((path, [folder_id], remote_file["id"]))
+
+		return jobs
+
+	# returns {name: metadata} for every file in a folder, following pagination
+	def list_folder(self, folder_id) -> dict:
+		files = {}
+		page_token = None
+		while True:
+			response = (
+				self.service.files()
+				.list(
+					q=f"'{folder_id}' in parents and trashed = false",
+					fields="nextPageToken, files(id, name, mimeType, size, md5Checksum)",
+					pageSize=1000,
+					pageToken=page_token
+				)
+				.execute()
+			)
+			for f in response.get("files", []):
+				files.setdefault(f["name"], f)
+			page_token = response.get("nextPageToken")
+			if not page_token:
+				return files
+
+	def find_or_create_folder(self, name, parent_id) -> str:
+		escaped = name.replace("\\", "\\\\").replace("'", "\\'")
+		response = (
+			self.service.files()
+			.list(
+				q=f"name = '{escaped}' and '{parent_id}' in parents and mimeType = '{self.FOLDER_MIMETYPE}' and trashed = false",
+				fields="files(id)",
+				pageSize=1
+			)
 			.execute()
 		)
+		found = response.get("files", [])
+		if found:
+			return found[0]["id"]
+		return self.create_folder(name, parent_id)
 
-		logger.info(f"Upload successful!")
-		return output
-	except HttpError as error:
+	def create_folder(self, name, parent_id) -> str:
+		metadata = {"name": name, "mimeType": self.FOLDER_MIMETYPE, "parents": [parent_id]}
+		return self.service.files().create(body=metadata, fields="id").execute()["id"]
+
+def md5_file(path) -> str:
+	h = hashlib.md5()
+	with open(path, "rb") as f:
+		for block in iter(lambda: f.read(1024 * 1024), b""):
+			h.update(block)
+	return h.hexdigest()
+
+# syncs a backup into a Drive folder, skipping files that are already there with the same contents
+def sync(creds, backup_path, folder_name, chunk_size=DEFAULT_CHUNK_SIZE, workers=4, throttle=None):
+	try:
+		logger.info(f"Syncing {backup_path} to Google Drive folder {folder_name}...")
+		uploader = DriveUploader(creds, chunk_size=chunk_size, workers=workers, throttle=throttle)
+		results = DriveSync(get_service(creds), uploader, workers).sync(backup_path, folder_name)
+		failed = results.count(None)
+		if failed:
+			logger.error(f"Sync finished with {failed} failed uploads")
+		else:
+			logger.info(f"Sync successful!")
+		return results
+	except (HttpError, requests.RequestException, DriveUploadError) as error:
 		# handle API error
-		logger.info(f"An error occurred while uploading the file: {error}")
-		
\ No newline at end of file
+		logger.info(f"An error occurred while syncing the backup: {error}")
@@ -0,0 +1,101 @@
+import os
+import mmap
+import json
+import hashlib
+import logging
+import datetime
+import threading
+
+# xxhash is optional, the xxh3_128 algorithm is only available when it's installed
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+logger = logging.getLogger()
+
+HASH_MANIFEST_VERSION = 1
+
+# algorithms a hash manifest can be written with
+# blake2b is the fastest one in the standard library on 64-bit CPUs
+HASH_ALGORITHMS = {
+    "blake2b": hashlib.blake2b,
+    "sha256": hashlib.sha256
+}
+if xxhash is not None:
+    HASH_ALGORITHMS["xxh3_128"] = xxhash.xxh3_128
+
+def new_hasher(algorithm):
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"Unsupported hash algorithm: {algorithm}")
+    return HASH_ALGORITHMS[algorithm]()
+
+# hashes a whole file through a read-only memory map (the hash functions release the GIL on large buffers,
+# so several files can be hashed at the same time on different threads)
+def hash_file(path, algorithm) -> str:
+    hasher = new_hasher(algorithm)
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size > 0: # empty files can't be mapped
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                hasher.update(mapped)
+    return hasher.hexdigest()
+
+# path of the hash manifest that goes with a backup (a directory, a single file or a ZIP)
+def manifest_path_for(backup_path) -> str:
+    return f"{backup_path}.hashes.json"
+
+# turns a path relative to the backup into a manifest key, which always uses "/" like ZIP member names
+def to_key(rel_path) -> str:
+    return rel_path.replace(os.sep, "/")
+
+
+'''
+Content hashes of every file in a backup, written next to it as <backup>.hashes.json
+kind - dir (keys are paths relative to the backup directory), file (a single file, keyed by its name)
+or zip (keys are member names)
+The hashes are computed while the backup is written, from the data that was read for it.
+'''
+class HashManifest:
+    def __init__(self, manifest_path, kind="dir", algorithm="blake2b"):
+        self.manifest_path = manifest_path
+        self.kind = kind
+        self.algorithm = algorithm
+        self.created = None
+        self.files = {} # key -> hex digest
+        self.lock = threading.Lock()
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.manifest_path)
+
+    def add(self, key, digest):
+        with self.lock:
+            self.files[key] = digest
+
+    def load(self):
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        if data.get("version") != HASH_MANIFEST_VERSION:
+            raise ValueError(f"Unsupported hash manifest version {data.get('version')} in {self.manifest_path}")
+
+        self.kind = data["kind"]
+        self.algorithm = data["algorithm"]
+        self.created = data.get("created")
+        self.files = data.get("files", {})
+        return self
+
+    def save(self):
+        data = {
+            "version": HASH_MANIFEST_VERSION,
+            "kind": self.kind,
+            "algorithm": self.algorithm,
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "files": self.files
+        }
+
+        # write to a temporary file first, then swap it in, so a crash never leaves a half-written manifest
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.manifest_path)
+        logger.info(f"Hash manifest with {len(self.files)} files written to: {self.manifest_path}")
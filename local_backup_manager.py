@@ -1,20 +1,70 @@
 import os
+import sqlite3
 import logging
 import shutil
 import zipfile
 import datetime
 import google_drive_manager
+import streaming_archive
 
 from backup_config import BackupConfig
+from backup_manifest import BackupManifest
+from chunk_store import ChunkStore
+from parallel_copy import ParallelCopier
+from fast_copy import FastCopier
+from parallel_compression import ParallelZipWriter
+from volume_pipeline import VolumeWriter, VolumeUploadPipeline
+from backup_metrics import BackupMetrics, ProgressReporter
+from hash_manifest import HashManifest, hash_file, manifest_path_for, to_key
+from backup_catalog import BackupCatalog
+from tree_walker import TreeWalker, WalkRules
+from throttle import BackupThrottle
+from backup_journal import BackupJournal, STAGING_SUFFIX
 from pathlib import Path
 
 logger = logging.getLogger()
 
+# name of the deduplicated chunk store inside the destination directory
+DEDUP_STORE_NAME = "BACKUP-STORE"
+
+'''
+Runs a single backup job described by config
+configure_logging - set up the log file/console handlers for this backup, turned off when several jobs
+                    share the process (the scheduler sets up logging once for all of them)
+compress_pool - (optional) thread pool shared with other jobs for compressing ZIP members
+copy_failures - (optional) set of copy strategies known not to work, shared with other jobs
+throttle - (optional) BackupThrottle shared with other backups, so its limits can be changed while they run,
+           otherwise one is made from the limits in config
+'''
 class LocalBackupManager:
-    def __init__(self, config: BackupConfig):
+    def __init__(self, config: BackupConfig, configure_logging=True, compress_pool=None, copy_failures=None, throttle=None):
         self.config = config
+        self.config.clear_path_checks() # the source/destination may have changed since the last backup
+        self.compress_pool = compress_pool
+        # include/exclude, size and age rules, compiled once and used by every stage that walks the source
+        self.rules = WalkRules.from_config(config)
+        self.throttle = throttle or BackupThrottle.from_config(config)
         self.output_backup_name = self.name_backup()
-        self.setup_logging()
+        # an unfinished journaled backup of the same source is resumed under the name it was started with
+        self.journal = self.find_journal()
+        if self.journal:
+            self.output_backup_name = self.journal.name()
+        self.metrics = BackupMetrics(self.output_backup_name)
+        # files are hashed by whichever stage writes the final backup: the copy, or the ZIP writer when compressing
+        hash_copies = self.config.uses_hash_manifest() and (self.config.is_incremental() or self.config.compress_backup != "1")
+        copy_hash_algorithm = self.config.hash_algorithm if hash_copies else None
+        # incremental runs with hash_check keep a sha256 of every copied file in their manifest,
+        # computed while the file is copied unless the hash manifest needs another algorithm
+        if copy_hash_algorithm is None and self.config.is_incremental() and self.config.hash_check == "1":
+            copy_hash_algorithm = "sha256"
+        self.copier = FastCopier(self.config.copy_strategy, copy_hash_algorithm, copy_failures,
+                                 self.throttle.io)
+        # what the catalog records about this backup, filled in by the stages as they run
+        self.output_path = None # the backup as it was left in the destination (copy, archive, first volume or snapshot)
+        self.file_records = None # relative path -> stat record, when a stage already has them
+        self.hash_manifest = None
+        if configure_logging:
+            self.setup_logging()
 
     # set up file and console based logging
     def setup_logging(self):
@@ -24,49 +74,197 @@ class LocalBackupManager:
         for handler in logger.handlers[:]:
             logger.removeHandler(handler)
         
+        # per-file messages are logged at DEBUG level, which is only enabled with the verbose flag
+        # (on large trees, logging every file costs more than copying it)
+        level = logging.DEBUG if self.config.verbose == "1" else logging.INFO
+        logger.setLevel(level)
+
         file_handler = logging.FileHandler(f"logs/[LOG]-{self.output_backup_name}.log")
-        file_handler.setLevel(logging.DEBUG)
+        file_handler.setLevel(level)
 
         cli_handler = logging.StreamHandler()
-        cli_handler.setLevel(logging.DEBUG)
+        cli_handler.setLevel(level)
 
         logger.addHandler(file_handler)
         logger.addHandler(cli_handler)
 
-    def perform_backup(self) -> Path:
+    # changed_paths - (optional) absolute paths that changed since the last run, as reported by the watchdog
+    # in incremental mode only those paths are looked at, otherwise a normal backup is made
+    def perform_backup(self, changed_paths=None) -> Path:
+        backup_path = None
+        try:
+            backup_path = self.run_stages(changed_paths)
+            if backup_path is not None and self.config.uses_catalog():
+                self.update_catalog()
+            return backup_path
+        finally:
+            self.metrics.succeeded = backup_path is not None
+            self.write_metrics()
+
+    def run_stages(self, changed_paths=None) -> Path:
         compress_path = None
-        backup_path = self.copy_file()
+        if self.config.journal == "1" and not self.config.uses_journal():
+            logger.warning("The journal is only used for full backups that aren't streamed, ignoring it")
+
+        if self.config.is_streaming():
+            with self.metrics.stage("stream"):
+                backup_path = self.stream_backup()
+        elif self.config.is_incremental():
+            with self.metrics.stage("incremental"):
+                backup_path = self.incremental_backup(changed_paths)
+        elif self.config.is_dedup():
+            with self.metrics.stage("dedup"):
+                backup_path = self.dedup_backup()
+        else:
+            with self.metrics.stage("copy"):
+                backup_path = self.copy_file()
 
         if backup_path == None:
             target_path = os.path.join(self.config.source_path, self.config.selected_file)
             logger.error(f"Failed to backup {target_path}. Please check that the source file/directory exists, is named correctly and try again.")
             return None
 
+        if self.config.uses_hash_manifest() and (self.config.is_dedup() or self.config.uses_volumes() or
+                                                 (self.config.is_streaming() and self.config.archive_format != "zip")):
+            logger.warning("Hash manifests are only written for directory/file copies and single ZIP archives, skipping it")
+
+        # snapshots are already compressed chunk by chunk and only make sense alongside their store
+        if self.config.is_dedup():
+            if self.config.compress_backup == "1":
+                logger.info("Skipping compression: chunks in the deduplicated store are already compressed")
+            if self.config.cloud_providers:
+                logger.warning("Uploading the deduplicated store to cloud services is not supported yet")
+            logger.info(f"Backup successfully created. The snapshot index is located locally at: {str(backup_path)}")
+            self.output_path = str(backup_path)
+            return backup_path
+
         is_compressed = False
-        if self.config.compress_backup == "1" and backup_path != None:
-            compress_path = self.compress_backup(backup_path)
+        if self.config.is_streaming(): # the archive was written straight from the source
+            compress_path = backup_path
             is_compressed = True
+        elif self.config.compress_backup == "1" and backup_path != None:
+            # the incremental mirror is kept around so the next run can be compared against it
+            # a journaled copy is compressed straight from its staging directory, the archive is named after the backup
+            name_path = os.path.join(self.config.destination_path, self.output_backup_name) if self.journal else None
+            with self.metrics.stage("compress"):
+                compress_path = self.compress_backup(backup_path, delete_original=not self.config.is_incremental(),
+                                                     name_path=name_path)
+            is_compressed = True
+            if self.journal:
+                if compress_path is not None:
+                    self.journal.discard()
+                else: # the staging directory is kept, the next run compresses it without copying anything again
+                    self.journal.close()
+
+        # volumes are uploaded while the archive is being written
+        if self.config.cloud_providers and not self.config.uses_volumes():
+            with self.metrics.stage("upload"):
+                if is_compressed:
+                    self.upload_to_cloud(compress_path)
+                else:
+                    self.upload_to_cloud(backup_path)
 
-        if self.config.cloud_providers:
-            if is_compressed:
-                self.upload_to_cloud(compress_path)
-            else:
-                self.upload_to_cloud(backup_path)
-
+        self.output_path = str(compress_path if is_compressed else backup_path)
         if is_compressed:
             logger.info(f"Backup successfully created. The output file is located locally at: {str(compress_path)}")
         else:
             logger.info(f"Backup successfully created. The output file is located locally at: {str(backup_path)}")
             
         return backup_path
+
+    # writes the metrics of this backup to the JSON/Prometheus files set in the config
+    def write_metrics(self):
+        logger.info(f"Backup metrics: {self.metrics.summary()['stages']}")
+        try:
+            if self.config.metrics_json:
+                self.metrics.write_json(self.config.metrics_json)
+            if self.config.prometheus_file:
+                self.metrics.write_prometheus(self.config.prometheus_file)
+        except OSError as e:
+            logger.error(f"Unable to write backup metrics: {e}")
+
+    # records this backup and its files in the catalog of the destination directory,
+    # then prunes the backups that fall outside the retention policy
+    def update_catalog(self):
+        if self.config.is_dedup():
+            kind = "snapshot"
+        elif self.config.uses_volumes():
+            kind = "volumes"
+        elif os.path.isdir(self.output_path):
+            kind = "dir"
+        elif self.output_path.endswith(".zip") and self.config.compress_backup == "1":
+            kind = "zip"
+        elif self.config.is_streaming():
+            kind = "tar"
+        else:
+            kind = "file"
+
+        try:
+            (files, hash_algorithm) = self.catalog_records()
+            with BackupCatalog.for_destination(self.config.destination_path) as catalog:
+                series = self.get_sync_folder_name()
+                catalog.add_backup(series, self.output_backup_name, os.path.abspath(self.get_source_path()),
+                                   self.config.backup_mode, kind, self.output_path, self.metrics.started,
+                                   files, hash_algorithm)
+                if self.config.uses_retention():
+                    catalog.apply_retention(series, self.config.keep_last, self.config.keep_daily,
+                                            self.config.keep_weekly, self.config.keep_monthly)
+        except (OSError, sqlite3.Error) as e:
+            logger.error(f"Unable to update the backup catalog: {e}")
+
+    # returns ({relative path: (size, mtime_ns, hash)}, hash algorithm) for every file in this backup
+    # stat records come from the stage that wrote the backup (copy, compression or streaming walk,
+    # incremental manifest, dedup snapshot), a single file source is stat'ed
+    # (a directory is only scanned again when no stage kept them), hashes come from the hash manifest
+    def catalog_records(self) -> tuple:
+        records = self.file_records
+        if records is None:
+            full_path = self.get_source_path()
+            if os.path.isdir(full_path):
+                records = BackupManifest.scan(str(full_path), self.rules)[0]
+            else:
+                records = {os.path.basename(full_path): BackupManifest.make_record(os.stat(full_path))}
+
+        hashes = {}
+        hash_algorithm = None
+        if self.hash_manifest:
+            hash_algorithm = self.hash_manifest.algorithm
+            digests = self.hash_manifest.files
+            if len(records) == 1 and len(digests) == 1:
+                hashes = {to_key(rel_path): digest for rel_path in records for digest in digests.values()}
+            elif self.hash_manifest.kind == "zip":
+                # ZIP members of a directory backup are stored under a folder named after the backup
+                hashes = {key.split("/", 1)[-1]: digest for key, digest in digests.items()}
+            else:
+                hashes = digests
+
+        files = {}
+        for rel_path, record in records.items():
+            key = to_key(rel_path)
+            files[key] = (record["size"], record["mtime_ns"], hashes.get(key))
+        return (files, hash_algorithm)
+
+    # returns a reporter that counts files/bytes for a stage and logs progress every few seconds
+    def progress(self, stage) -> ProgressReporter:
+        return ProgressReporter(self.metrics, stage, self.config.progress_interval)
    
-    def upload_to_cloud(self, output_path):
+    # returns False if the upload to any of the cloud services failed
+    def upload_to_cloud(self, output_path) -> bool:
         current_service = ""
+        succeeded = True
+        if os.path.isfile(output_path):
+            self.metrics.add("upload", 1, os.path.getsize(output_path))
         try:
             if "google_drive" in self.config.cloud_providers:
                 current_service = "Google Drive"
                 creds = google_drive_manager.authorise()
-                google_drive_manager.upload(creds, output_path)
+                chunk_size = self.config.upload_chunk_size * 1024 * 1024
+                if self.config.cloud_sync == "1":
+                    results = google_drive_manager.sync(creds, output_path, self.get_sync_folder_name(), chunk_size,
+                                                        self.config.upload_workers, self.throttle.upload)
+                    succeeded = results is not None and None not in results
+                else:
+                    succeeded = google_drive_manager.upload(creds, output_path, chunk_size, self.throttle.upload) is not None
 
             if "onedrive" in self.config.cloud_providers:
                 # TODO ONEDRIVE BACKUP HERE
@@ -86,6 +284,17 @@ class LocalBackupManager:
         except Exception as e:
             error_msg = f"Error while syncing output file {output_path} to cloud service {current_service}: {e}"
             logger.error(error_msg)
+            return False
+        return succeeded
+
+    # name of the cloud folder backups are synced into, it stays the same between runs
+    # so that unchanged files can be skipped
+    def get_sync_folder_name(self) -> str:
+        if self.config.check_backup_name():
+            return self.config.backup_name
+        if self.config.check_file_existence() != 0:
+            return os.path.splitext(os.path.basename(self.config.selected_file))[0]
+        return os.path.basename(os.path.normpath(self.config.source_path))
 
     # returns a timestamp in the following format:
     # <backup_date>-<24h_formatted_time>
@@ -102,23 +311,26 @@ class LocalBackupManager:
     # rename the backed up file to what is specified in the config file (the "BACKUP_NAME" key)
     # or automatically rename it with the convention
     # <original_filename>-BACKUP-<full_timestamp>
+    # incremental backups always update the same mirror, so they are named without a timestamp:
+    # <original_filename>-INCREMENTAL
     def name_backup(self) -> str:
         name = self.config.backup_name
 
         if not self.config.check_backup_name():
+            suffix = "INCREMENTAL" if self.config.is_incremental() else f"BACKUP-{self.add_timestamp()}"
             if self.config.check_file_existence() != 0:
                 orig_path = os.path.splitext(self.config.selected_file)
                 orig_fname = orig_path[0]
                 f_ext = orig_path[1]
-                name = f"{orig_fname}-BACKUP-{self.add_timestamp()}{f_ext}"
+                name = f"{orig_fname}-{suffix}{f_ext}"
             else:
                 dir_name = os.path.basename(self.config.source_path)
-                name = f"{dir_name}-BACKUP-{self.add_timestamp()}"
+                name = f"{dir_name}-{suffix}"
 
         return name
 
-    # create a copy of the file/folder and moves that into the destination directory
-    def copy_file(self) -> Path:
+    # checks that the source exists and returns the full path of the file/directory to back up
+    def get_source_path(self) -> Path:
         # check source path and target file's existence
         src_path_check = self.config.check_source_path()
         if src_path_check == -1:
@@ -135,24 +347,67 @@ class LocalBackupManager:
         if src_path_check == 0: # check if the source directory is specified
             # if not specified, assume that the target file we want to backup 
             # is in the current directory the script is running
-            full_path = Path(self.config.selected_file)
-        else:
-            full_path = Path(os.path.join(self.config.source_path, self.config.selected_file))
+            return Path(self.config.selected_file)
 
-        dest_path_check = self.config.check_dest_path()
+        return Path(os.path.join(self.config.source_path, self.config.selected_file))
 
-        # destination directory does not exist, automatically create one
-        if dest_path_check == -1:
+    # destination directory does not exist, automatically create one
+    def create_dest_dir(self) -> bool:
+        if self.config.check_dest_path() == -1:
             try:
                 os.makedirs(self.config.destination_path)
+                self.config.clear_path_checks()
             except Exception as e:
                 error_msg = f"An error occurred while attempting to create the destination directory: {e}"
                 logger.error(error_msg)
-                return None
+                return False
+        return True
+
+    # returns the journal left by an unfinished backup of the same source, None if there isn't one (or no journal is used)
+    def find_journal(self) -> BackupJournal:
+        if not self.config.uses_journal() or self.config.check_dest_path() != 1:
+            return None
+        source = os.path.join(self.config.source_path, self.config.selected_file)
+        journal = BackupJournal.find(self.config.destination_path, source)
+        # a backup named in the config only resumes a backup of the same name
+        if journal and self.config.check_backup_name() and journal.name() != self.config.backup_name:
+            return None
+        return journal
+
+    # starts the journal of this backup, or continues the one found when the backup was set up
+    # kind - dir or file
+    def open_journal(self, full_path, kind):
+        hash_algorithm = self.copier.hash_algorithm
+        journal = self.journal
+        if journal and (journal.header.get("kind") != kind or journal.header.get("hash_algorithm") != hash_algorithm):
+            logger.warning(f"The unfinished backup {journal.name()} was made with different settings, starting it over")
+            journal.discard()
+            journal = None
+
+        if journal:
+            journal.resume()
+        else:
+            journal = BackupJournal.for_output(os.path.join(self.config.destination_path, self.output_backup_name))
+            journal.start(self.output_backup_name, full_path, kind, hash_algorithm)
+        self.journal = journal
+
+    # create a copy of the file/folder and moves that into the destination directory
+    # with the journal, the copy is made in <backup_name>.partial and renamed once it's complete
+    # (when it's compressed, the staging directory is compressed and deleted instead)
+    def copy_file(self) -> Path:
+        full_path = self.get_source_path()
+        file_check = self.config.check_file_existence()
+
+        if not self.create_dest_dir():
+            return None
 
         # copy operation here
         output_path = None
+        copy_path = None
         try:
+            if self.config.uses_journal():
+                self.open_journal(full_path, "dir" if file_check == 0 else "file")
+
             # when using the shutil copy methods and providing it the "dest",
             # it expects the destination directory and the name the file should be after it's copied
             backup_name = self.output_backup_name
@@ -167,22 +422,356 @@ class LocalBackupManager:
                 if not str(full_path).startswith("\\\\?\\"):
                     full_path = Path('\\\\?\\' + os.path.abspath(full_path))
 
-            if file_check == 0: # run if we are backing up an entire directory
-                shutil.copytree(full_path, output_path)
+            copy_path = output_path + STAGING_SUFFIX if self.journal else output_path
+            progress = self.progress("copy")
+
+            # copies a single file and counts it towards the copy stage
+            def counted_copy(src, dst, size):
+                result = self.copier.copy2(src, dst)
+                progress.update(1, size)
+                logger.debug("Copied %s", src)
+                return result
+
+            if self.config.copy_workers > 1: # copy files concurrently with a pool of worker threads
+                copier = ParallelCopier(self.config.copy_workers, self.config.split_size * 1024 * 1024,
+                                        on_progress=progress.update, copier=self.copier, rules=self.rules,
+                                        journal=self.journal)
+                if file_check == 0:
+                    copier.copy_tree(full_path, copy_path)
+                    self.file_records = copier.records
+                else:
+                    copier.copy_single_file(full_path, copy_path)
+            elif file_check == 0: # run if we are backing up an entire directory
+                self.copy_tree(full_path, copy_path, counted_copy)
             else: # run if we are trying to backup a file
                 # shutil.copyfile(full_path, new_dest_path) # don't use this, it does not keep original metadata
-                shutil.copy2(full_path, output_path) # this one keeps all the original metadata
+                counted_copy(full_path, copy_path, os.path.getsize(full_path)) # this one keeps all the original metadata
         except Exception as e:
             error_msg = f"An error occurred while attempting to copy the file to the directory {self.config.destination_path}: {e}"
             logger.error(error_msg)
 
-            self.delete_copy(output_path) # discards the file/directory in process in case of an error
+            if self.journal: # keeps what was copied so far, the next run picks up from there
+                self.journal.close()
+                logger.error(f"The files copied so far are kept in {copy_path}, run the backup again to resume it")
+            elif output_path:
+                self.delete_copy(output_path) # discards the file/directory in process in case of an error
             return None
 
-        success_msg = f"Successfully copied {full_path} to the new directory: {output_path}"
+        success_msg = f"Successfully copied {full_path} to the new directory: {copy_path}"
         logger.info(success_msg)
+        logger.info(f"Copy strategies used: {self.copier.summary()}")
+
+        if self.copier.hash_algorithm:
+            is_dir = os.path.isdir(copy_path)
+            manifest = HashManifest(manifest_path_for(output_path), "dir" if is_dir else "file", self.config.hash_algorithm)
+            if self.journal: # files copied by the earlier runs of a resumed backup that are still in the source
+                for (rel_path, (size, mtime_ns, digest)) in self.journal.done.items():
+                    if digest and (not is_dir or rel_path in self.file_records):
+                        manifest.add(to_key(rel_path) if is_dir else os.path.basename(output_path), digest)
+            self.save_copy_hashes(manifest, copy_path, os.path.basename(output_path))
+
+        if self.journal and self.config.compress_backup != "1":
+            try:
+                self.journal.publish(output_path)
+            except OSError as e:
+                logger.error(f"Unable to move the finished backup from {copy_path} to {output_path}: {e}")
+                return None
+            logger.info(f"Published the backup at {output_path}")
+        return copy_path if self.journal and self.config.compress_backup == "1" else output_path
+
+    # copies a directory tree the same way as shutil.copytree(), skipping whatever the rules leave out
+    # copy_function - called with (src, dst, size) for every file
+    # with the journal, files it already has are skipped and every file copied is recorded in it,
+    # and whatever earlier runs staged that the walk didn't see is removed
+    # the stat records of the files seen by the walk are kept for the catalog
+    def copy_tree(self, src, dst, copy_function):
+        walker = TreeWalker(src, self.rules, follow_symlinks=True)
+        records = {}
+        dirs = []
+        for (rel_dir, src_dir, subdirs, files) in walker.walk():
+            dest_dir = os.path.join(dst, rel_dir) if rel_dir else dst
+            # a resumed backup copies into the staging directory left by the previous run
+            os.makedirs(dest_dir, exist_ok=bool(rel_dir) or self.journal is not None)
+            dirs.append((rel_dir, src_dir, dest_dir))
+            for (name, st) in files:
+                rel_path = os.path.join(rel_dir, name) if rel_dir else name
+                records[rel_path] = BackupManifest.make_record(st)
+                if self.journal and self.journal.is_done(rel_path, st):
+                    continue
+                dest_file = os.path.join(dest_dir, name)
+                copy_function(os.path.join(src_dir, name), dest_file, st.st_size)
+                if self.journal:
+                    self.journal.record(rel_path, st, self.copier.hashes.get(dest_file))
+        walker.log_excluded()
+        walker.check_errors()
+        self.file_records = records
+        if self.journal:
+            self.journal.prune(records, set(rel_dir for (rel_dir, src_dir, dest_dir) in dirs))
+
+        # directory metadata goes last (deepest first), since creating files inside them changes their mtime
+        for (rel_dir, src_dir, dest_dir) in reversed(dirs):
+            shutil.copystat(src_dir, dest_dir)
+
+    # adds the hashes computed while copying into the backup at output_path to manifest and saves it
+    # file_name - (optional) name of a single file backup, when output_path is its staging copy
+    def save_copy_hashes(self, manifest, output_path, file_name=None):
+        for (dest, digest) in self.copier.hashes.items():
+            if manifest.kind == "dir":
+                manifest.add(to_key(os.path.relpath(dest, output_path)), digest)
+            else:
+                manifest.add(file_name or os.path.basename(output_path), digest)
+        try:
+            manifest.save()
+            self.hash_manifest = manifest
+        except OSError as e:
+            logger.error(f"Unable to write the hash manifest {manifest.manifest_path}: {e}")
+
+    # brings a mirror of the source in the destination directory up to date,
+    # copying only the files that are new/changed since the last run and removing deleted ones
+    # the state of the last run is kept in <backup_name>.manifest.json next to the mirror
+    # if changed_paths is given, only those paths are re-scanned instead of the whole source tree
+    def incremental_backup(self, changed_paths=None) -> Path:
+        full_path = self.get_source_path()
+
+        if not self.create_dest_dir():
+            return None
+
+        output_path = os.path.join(self.config.destination_path, self.output_backup_name)
+        manifest = BackupManifest(f"{output_path}.manifest.json").load()
+        use_hash = self.config.hash_check == "1"
+
+        # if the mirror has been removed since the last run, everything has to be copied again
+        if not os.path.exists(output_path):
+            manifest.files = {}
+            manifest.dirs = set()
+            manifest.last_run = {}
+
+        is_dir = os.path.isdir(full_path)
+        try:
+            if is_dir and changed_paths is not None and manifest.last_run:
+                src_root = str(full_path)
+                rel_paths = self.get_relative_paths(src_root, changed_paths)
+                logger.info(f"Targeted incremental backup of {len(rel_paths)} changed paths")
+                (files, dirs) = manifest.rescan(src_root, rel_paths, self.rules)
+            elif is_dir:
+                src_root = str(full_path)
+                (files, dirs) = BackupManifest.scan(src_root, self.rules)
+            else:
+                src_root = os.path.dirname(str(full_path))
+                files = {os.path.basename(full_path): BackupManifest.make_record(os.stat(full_path))}
+                dirs = set()
+        except OSError as e:
+            # files that couldn't be read would look deleted and be removed from the mirror
+            logger.error(f"Unable to scan {full_path} for the incremental backup, the mirror is left as it is: {e}")
+            return None
+
+        # a single file backup is mirrored to the output path itself
+        def dest_path(rel_path):
+            return os.path.join(output_path, rel_path) if is_dir else output_path
+
+        (changed, deleted) = manifest.diff(files, src_root, use_hash)
+        logger.info(f"Incremental backup: {len(changed)} new/changed and {len(deleted)} deleted out of {len(files)} files")
+
+        progress = self.progress("incremental")
+        try:
+            if is_dir:
+                os.makedirs(output_path, exist_ok=True)
+                for rel_dir in sorted(dirs - manifest.dirs):
+                    os.makedirs(os.path.join(output_path, rel_dir), exist_ok=True)
+
+            for rel_path in changed:
+                src = os.path.join(src_root, rel_path)
+                dest = dest_path(rel_path)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                self.copier.copy2(src, dest)
+                # files whose size didn't change were already hashed by diff(), the others were hashed by the copy
+                # (they're only read again when the copy hashed them with the hash manifest's algorithm instead)
+                if use_hash and not files[rel_path].get("hash"):
+                    digest = self.copier.hashes.get(dest) if self.copier.hash_algorithm == "sha256" else None
+                    files[rel_path]["hash"] = digest or BackupManifest.hash_file(src)
+                progress.update(1, files[rel_path]["size"])
+                logger.debug("Copied %s", src)
+
+            for rel_path in deleted:
+                dest = dest_path(rel_path)
+                if os.path.isfile(dest):
+                    os.remove(dest)
+
+            # remove directories that no longer exist, deepest first
+            for rel_dir in sorted(manifest.dirs - dirs, reverse=True):
+                shutil.rmtree(os.path.join(output_path, rel_dir), ignore_errors=True)
+        except Exception as e:
+            # the manifest is left untouched so the next run picks up where this one failed
+            error_msg = f"An error occurred while updating the incremental backup {output_path}: {e}"
+            logger.error(error_msg)
+            return None
+
+        manifest.files = files
+        manifest.dirs = dirs
+        manifest.record_run(changed, deleted)
+        manifest.save()
+        self.file_records = files
+
+        if self.config.uses_hash_manifest():
+            self.update_mirror_hashes(output_path, is_dir, files, deleted)
+
+        logger.info(f"Successfully updated incremental backup of {full_path} at: {output_path}")
         return output_path
 
+    # brings the hash manifest of the incremental mirror up to date with the files copied in this run
+    # files that were left alone keep the hash from an earlier run (and are hashed from the mirror if they don't have one)
+    def update_mirror_hashes(self, output_path, is_dir, files, deleted):
+        manifest = HashManifest(manifest_path_for(output_path), "dir" if is_dir else "file", self.config.hash_algorithm)
+        if manifest.exists():
+            try:
+                previous = HashManifest(manifest.manifest_path).load()
+                if previous.algorithm == manifest.algorithm and previous.kind == manifest.kind:
+                    manifest.files = previous.files
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Ignoring unreadable hash manifest {manifest.manifest_path}: {e}")
+
+        for rel_path in deleted:
+            manifest.files.pop(to_key(rel_path), None)
+
+        if is_dir:
+            for rel_path in files:
+                if to_key(rel_path) not in manifest.files and os.path.join(output_path, rel_path) not in self.copier.hashes:
+                    manifest.add(to_key(rel_path), hash_file(os.path.join(output_path, rel_path), manifest.algorithm))
+        self.save_copy_hashes(manifest, output_path)
+
+    # converts absolute paths into paths relative to the source directory, dropping any outside of it
+    @staticmethod
+    def get_relative_paths(src_root, paths) -> set:
+        src_root = os.path.abspath(src_root)
+        rel_paths = set()
+        for path in paths:
+            rel_path = os.path.relpath(os.path.abspath(path), src_root)
+            if rel_path != os.curdir and rel_path != os.pardir and not rel_path.startswith(os.pardir + os.sep):
+                rel_paths.add(rel_path)
+        return rel_paths
+
+    # stores the source in the deduplicated chunk store in the destination directory
+    # and records this backup as a snapshot named after the output backup name
+    def dedup_backup(self) -> Path:
+        full_path = self.get_source_path()
+
+        if not self.create_dest_dir():
+            return None
+
+        store = ChunkStore(os.path.join(self.config.destination_path, DEDUP_STORE_NAME), throttle=self.throttle.io)
+        try:
+            snapshot_path = store.create_snapshot(str(full_path), self.output_backup_name, self.rules)
+            self.metrics.add("dedup", store.snapshot_files, store.new_bytes)
+            self.file_records = store.load_snapshot(self.output_backup_name)["files"]
+        except Exception as e:
+            error_msg = f"An error occurred while storing {full_path} in the deduplicated store {store.repo_path}: {e}"
+            logger.error(error_msg)
+            return None
+
+        logger.info(f"Successfully stored {full_path} in the deduplicated store: {store.repo_path}")
+        return Path(snapshot_path)
+
+    # reads the source once and writes it straight into an archive in the destination directory,
+    # instead of copying it first and compressing the copy afterwards
+    def stream_backup(self) -> Path:
+        full_path = self.get_source_path()
+
+        if not self.create_dest_dir():
+            return None
+
+        output_path = os.path.join(self.config.destination_path, self.output_backup_name)
+        archive_path = streaming_archive.archive_name(output_path, self.config.archive_format, os.path.isfile(full_path))
+
+        if self.config.volume_size > 0:
+            return self.stream_volumes(full_path, archive_path)
+
+        hash_manifest = None
+        if self.config.uses_hash_manifest() and self.config.archive_format == "zip":
+            hash_manifest = HashManifest(manifest_path_for(archive_path), "zip", self.config.hash_algorithm)
+
+        # the stat records of a directory source are kept for the catalog as the stream walks it
+        records = {} if os.path.isdir(full_path) else None
+        try:
+            logger.info(f"Streaming {full_path} into archive: {archive_path}...")
+            count = streaming_archive.write_archive(str(full_path), archive_path, self.output_backup_name, self.config.archive_format,
+                                                    self.config.codec, self.config.compress_level, self.config.compress_workers,
+                                                    hash_manifest, self.compress_pool, self.rules, self.throttle.io, records)
+            self.metrics.add("stream", count, os.path.getsize(archive_path))
+            self.file_records = records
+            if hash_manifest:
+                hash_manifest.save()
+                self.hash_manifest = hash_manifest
+        except Exception as e:
+            error_msg = f"An error occurred while writing the archive {archive_path}: {e}"
+            logger.error(error_msg)
+            return None
+
+        return Path(archive_path)
+
+    # streams the archive into fixed-size volumes (<archive>.001, .002, ...)
+    # with cloud providers set, each volume is uploaded as soon as it is sealed while the next one is written,
+    # so compression and upload overlap instead of running one after the other
+    # the first volume that fails to upload stops the archive, instead of writing and uploading the rest for nothing
+    # returns the path of the first volume
+    def stream_volumes(self, full_path, archive_path) -> Path:
+        volume_size = self.config.volume_size * 1024 * 1024
+        pipeline = None
+        on_sealed = None
+        cancel = None
+        if self.config.cloud_providers:
+            pipeline = VolumeUploadPipeline(self.upload_volume, self.config.max_pending_volumes)
+            pipeline.start()
+            on_sealed = pipeline.submit
+            cancel = pipeline.cancel
+
+        writer = VolumeWriter(archive_path, volume_size, on_sealed, cancel)
+        records = {} if os.path.isdir(full_path) else None
+        failed = False
+        try:
+            logger.info(f"Streaming {full_path} into {self.config.volume_size} MB volumes: {archive_path}.*...")
+            with writer:
+                count = streaming_archive.write_archive_to(writer, str(full_path), self.output_backup_name, self.config.archive_format,
+                                                           self.config.codec, self.config.compress_level, self.config.compress_workers,
+                                                           pool=self.compress_pool, rules=self.rules, throttle=self.throttle.io,
+                                                           records=records)
+            self.metrics.add("stream", count, sum(os.path.getsize(v) for v in writer.volumes))
+            self.file_records = records
+        except Exception as e:
+            failed = True
+            if pipeline and pipeline.failed:
+                error_msg = (f"Volume {os.path.basename(pipeline.failed[0])} failed to upload, stopped writing "
+                             f"the archive volumes {archive_path}.*")
+            else:
+                error_msg = f"An error occurred while writing the archive volumes {archive_path}.*: {e}"
+            logger.error(error_msg)
+        finally:
+            # let any upload in progress finish (before its volume is deleted, when the archive failed)
+            # the uploads ran alongside the stream stage, so their time is added to the upload stage here
+            if pipeline:
+                pipeline.finish()
+                self.metrics.add_seconds("upload", pipeline.seconds)
+
+        if failed:
+            # the truncated volume was never sealed, so it wasn't uploaded
+            if pipeline and pipeline.uploaded:
+                logger.error(f"The cloud copy of {os.path.basename(archive_path)} is incomplete, only these volumes "
+                             f"were uploaded: {', '.join(os.path.basename(v) for v in pipeline.uploaded)}")
+            for volume in writer.volumes:
+                self.delete_copy(volume)
+            return None
+
+        logger.info(f"Wrote {len(writer.volumes)} volumes, join them in order to get the archive back")
+        if pipeline and pipeline.failed:
+            logger.error(f"{len(pipeline.failed)} of {len(writer.volumes)} volumes failed to upload, the cloud copy of "
+                         f"{os.path.basename(archive_path)} is incomplete (the volumes are kept locally)")
+            return None
+        return Path(writer.volumes[0])
+
+    # uploads one sealed volume for the upload pipeline, which records it as failed when this raises
+    def upload_volume(self, path):
+        if not self.upload_to_cloud(path):
+            raise IOError(f"upload of {os.path.basename(path)} failed")
+
     # TODO
     def delete_copy(self, path):
         if os.path.isdir(path):
@@ -191,51 +780,80 @@ class LocalBackupManager:
             os.remove(path)
 
     # (optionally, in the config file) compress the output file/folder into a ZIP file
-    def compress_backup(self, backup_path) -> Path:
-        zip_name = f"{backup_path}.zip"
+    # name_path - (optional) path the ZIP and the folder inside it are named after, when backup_path is a staging copy
+    # the ZIP is written to <zip name>.part and renamed once it's complete, so a ZIP with its final name is never half-written
+    def compress_backup(self, backup_path, delete_original=True, name_path=None) -> Path:
+        name_path = str(name_path or backup_path)
+        zip_name = f"{name_path}.zip"
 
         # if it's a file, then create strip away the backed up file's extension from the zip's name
         if os.path.isfile(backup_path):
-            p = os.path.splitext(backup_path)
+            p = os.path.splitext(name_path)
             prefix = p[0]
             zip_name = f"{prefix}.zip"
 
+        hash_algorithm = self.config.hash_algorithm if self.config.uses_hash_manifest() else None
+        progress = self.progress("compress")
         try:
-            with zipfile.ZipFile(zip_name, "w") as zip_file:
+            with zipfile.ZipFile(zip_name + ".part", "w") as zip_file, \
+                    ParallelZipWriter(zip_file, self.config.codec, self.config.compress_level, self.config.compress_workers,
+                                      hash_algorithm, self.compress_pool, self.throttle.io) as writer:
                 logger.info(f"Creating ZIP file: {zip_name}...")
                 if os.path.isdir(backup_path):
-                    base_dir = os.path.basename(backup_path)
-                    # os.walk() - array of tuples
+                    base_dir = os.path.basename(name_path)
 
                     # goes through the directory and its subdirectories - sort of like a depth first style
-                    for root, dirs, files in os.walk(backup_path):
-                        for f in files:
+                    # (the copy was already filtered by the include/exclude rules, so everything in it goes in)
+                    # the copy has the sizes and mtimes of the source, so its walk gives the catalog records
+                    # when the stage before didn't keep them
+                    records = {} if self.file_records is None else None
+                    walker = TreeWalker(str(backup_path))
+                    for (rel_root, root, dirs, files) in walker.walk():
+                        arc_root = os.path.join(base_dir, rel_root) if rel_root else base_dir
+                        for (f, st) in files:
                             file_path = os.path.join(root, f)
-                            arcdir = os.path.join(base_dir, os.path.relpath(file_path, backup_path))
-                            zip_file.write(file_path, arcdir)
-                            logger.info(f"Successfully added to ZIP: {file_path}")
+                            if records is not None:
+                                records[os.path.join(rel_root, f) if rel_root else f] = BackupManifest.make_record(st)
+                            # compressed on the writer's worker threads, members are written in order
+                            writer.add_file(file_path, os.path.join(arc_root, f))
+                            progress.update(1, st.st_size)
+                            logger.debug("Successfully added to ZIP: %s", file_path)
 
                         # consider all of the empty subdirectories
                         if not files and not dirs:
                             # name of the empty folder we want to insert to the archive
-                            arcdir = os.path.join(base_dir, os.path.relpath(root, backup_path)) + "/"
-                            # zip_file.writestr(base_dir, arcdir) # doesn't add the empty directories
-                            zip_file.writestr(arcdir, "") 
-                            logger.info(f"Successfully added to ZIP: {arcdir}")
+                            arcdir = arc_root + "/"
+                            writer.add_dir(arcdir)
+                            logger.debug("Successfully added to ZIP: %s", arcdir)
+                    walker.check_errors()
+                    if records is not None:
+                        self.file_records = records
                         
                 else:
-                    zip_file.write(backup_path, os.path.basename(backup_path))
+                    writer.add_file(backup_path, os.path.basename(name_path))
+                    progress.update(1, os.path.getsize(backup_path))
                     logger.info(f"Successfully added file to ZIP: {backup_path}")
 
+                if writer.stored_count:
+                    logger.info(f"Stored {writer.stored_count} already-compressed files without recompressing them")
+            os.replace(zip_name + ".part", zip_name)
+
+            # the hashes are only complete once the writer has written every member
+            if hash_algorithm:
+                hash_manifest = HashManifest(manifest_path_for(zip_name), "zip", hash_algorithm)
+                hash_manifest.files = writer.hashes
+                hash_manifest.save()
+                self.hash_manifest = hash_manifest
+
             # deletes the original file/directory after compression
-            if os.path.isdir(backup_path):
-                shutil.rmtree(backup_path)
-            elif os.path.isfile(backup_path):
-                os.remove(backup_path)
+            if delete_original:
+                self.delete_copy(backup_path)
 
             logger.info("Compression successful!")
             return Path(zip_name)
         except Exception as e:
             message = f"Compression failed: {e}"
             logger.error(message)
+            if os.path.isfile(zip_name + ".part"):
+                os.remove(zip_name + ".part")
             return None
\ No newline at end of file
@@ -4,10 +4,17 @@ import logging
 import sys
 import argparse
 import threading
+import streaming_archive
+import parallel_compression
+import fast_copy
+import hash_manifest
 
 from google_auth_oauthlib.flow import google
 from backup_config import BackupConfig
 from local_backup_manager import LocalBackupManager
+from polling_scanner import PollingScanner
+from tree_walker import WalkRules
+from throttle import BackupThrottle, LimitsFile, lower_priority
 from pathlib import Path
 
 from watchdog.observers import Observer 
@@ -16,49 +23,126 @@ from watchdog.events import FileSystemEventHandler
 # Worker to detect file and directory changes
 # Automatically runs the backup subroutine upon detecting a change
 class LocalBackupWorker(FileSystemEventHandler):
+    # only these events change the contents of the source (opened/closed events are ignored,
+    # otherwise reading the source during a backup would trigger another backup)
+    CHANGE_EVENTS = {"created", "modified", "moved", "deleted"}
+
     def __init__(self, observer, logger, config):
         self.observer = observer
         self.logger = logger
         self.config = config
+        self.rules = WalkRules.from_config(config) # changes to excluded files don't trigger a backup
+        self.throttle = BackupThrottle.from_config(config) # shared by every backup, so --limits_file can change it
         self.debounce_timer = None
         self.debounce_delay = 2  # in seconds
+        self.max_latency = 30  # in seconds, a backup always starts at most this long after the first change
+        self.retry_delay = 30 # in seconds, wait before retrying the changes of a failed backup
+        self.dirty_paths = set() # every path that changed since the last backup
+        self.first_change_time = None
+        self.lock = threading.Lock() # protects the dirty paths and the debounce timer
+        self.backup_lock = threading.Lock() # makes sure only one backup runs at a time
 
     def on_any_event(self, event):
+        if event.event_type not in self.CHANGE_EVENTS:
+            return
+
+        # a directory's mtime changes whenever something inside it does,
+        # the events for the files themselves already cover that
+        if event.is_directory and event.event_type == "modified":
+            return
+
         # check if the event happened was triggered by a directory
         if event.is_directory:
-            self.logger.info(f"Content changed in directory: {self.config.source_path}")
+            self.logger.debug("Content changed in directory: %s", event.src_path)
         else:
-            self.logger.info(f"Content changed in file: {event.src_path}")
+            self.logger.debug("Content changed in file: %s", event.src_path)
+
+        paths = [event.src_path]
+        if event.event_type == "moved":
+            paths.append(event.dest_path)
+        self.mark_dirty(paths)
+
+    # drops paths that the include/exclude rules leave out of the backup
+    def filter_paths(self, paths) -> list:
+        root = os.path.abspath(self.config.source_path)
+        kept = []
+        for path in paths:
+            rel_path = os.path.relpath(os.path.abspath(path), root)
+            if rel_path == os.curdir or rel_path.startswith(os.pardir) or self.rules.keep_path(rel_path):
+                kept.append(path)
+        return kept
+
+    # records changed paths and (re)starts the debounce timer
+    def mark_dirty(self, paths):
+        paths = self.filter_paths(paths)
+        if not paths:
+            return
 
         # when a directory that has multiple files is copied,
         # the watchdog monitors every single file in the directory that gets copied,
         # so the watchdog ends up spamming multiple backups for each file copy
         # so for each detection, make sure to add a debounce timer that resets when it detects another event
+        # the timer can't be pushed back past max_latency, so continuous writes can't postpone the backup forever
+        with self.lock:
+            self.dirty_paths.update(paths)
 
-        # cancel the pending backup
-        if self.debounce_timer:
-            self.debounce_timer.cancel()
-        
-        self.debounce_timer = threading.Timer(self.debounce_delay, self.run_backup, args=[event])
-        self.debounce_timer.start()
+            now = time.monotonic()
+            if self.first_change_time is None:
+                self.first_change_time = now
+            delay = min(self.debounce_delay, max(0, self.first_change_time + self.max_latency - now))
 
-    def run_backup(self, event):
-        try:
-            # if there is a target file, check if the event was actually triggered
-            # by the target file
-            if self.config.selected_file != "":
-                if os.path.join(self.config.source_path, self.config.selected_file) == event.src_path:
-                    self.logger.info("Starting backup...")
-                    manager = LocalBackupManager(self.config)
-                    manager.perform_backup()
-            else:
-                self.logger.info("Starting backup...")
-                manager = LocalBackupManager(self.config)
-                manager.perform_backup()
-        except Exception as e:
-            self.logger.error(f"Backup failed: {e}")
-        finally:
-            self.debounce_timer = None # stop the debounce timer once the backup has finished
+            # cancel the pending backup
+            if self.debounce_timer:
+                self.debounce_timer.cancel()
+
+            self.debounce_timer = threading.Timer(delay, self.run_backup)
+            self.debounce_timer.start()
+
+    def run_backup(self):
+        with self.backup_lock:
+            # take the current set of changes, anything that changes during the backup goes into the next one
+            with self.lock:
+                paths = self.dirty_paths
+                self.dirty_paths = set()
+                self.first_change_time = None
+                self.debounce_timer = None # stop the debounce timer once the backup has started
+
+            if not paths:
+                return
+
+            succeeded = True
+            try:
+                # if there is a target file, check if the event was actually triggered
+                # by the target file
+                if self.config.selected_file != "":
+                    target_path = os.path.join(self.config.source_path, self.config.selected_file)
+                    if any(os.path.abspath(p) == os.path.abspath(target_path) for p in paths):
+                        self.logger.info("Starting backup...")
+                        manager = LocalBackupManager(self.config, throttle=self.throttle)
+                        succeeded = manager.perform_backup() is not None
+                else:
+                    self.logger.info(f"Starting backup of {len(paths)} changed paths...")
+                    manager = LocalBackupManager(self.config, throttle=self.throttle)
+                    succeeded = manager.perform_backup(paths) is not None
+            except Exception as e:
+                self.logger.error(f"Backup failed: {e}")
+                succeeded = False
+
+            if not succeeded:
+                self.requeue(paths)
+
+    # puts the changes of a failed backup back into the dirty paths and retries after retry_delay,
+    # otherwise the next (targeted) run would never look at them again
+    def requeue(self, paths):
+        with self.lock:
+            self.dirty_paths.update(paths)
+            if self.first_change_time is None:
+                self.first_change_time = time.monotonic()
+            # changes made during the failed backup already started a timer
+            if self.debounce_timer is None:
+                self.debounce_timer = threading.Timer(self.retry_delay, self.run_backup)
+                self.debounce_timer.start()
+        self.logger.warning(f"{len(paths)} changed paths will be backed up again in {self.retry_delay}s")
 
 
 # cli argument parsing method
@@ -90,6 +174,151 @@ def get_cmd_parser():
     parser.add_argument("-w", "--watchdog", 
         help="EXPERIMENTAL. Sets a flag to EITHER run the backup straight away and exit (0) OR continuously scan the specified directory/file for any changes and run the backup everytime it detects one. (1)", 
         default="0")
+    parser.add_argument("--watch_engine",
+        help="Only used with --watchdog 1. Sets how changes are detected. events - filesystem notifications (inotify on Linux), polling - periodically compare a snapshot of the tree, for trees too large for inotify watches. Default value will be events.",
+        choices=["events", "polling"],
+        default="events")
+    parser.add_argument("--poll_interval",
+        help="Only used with --watch_engine polling. Sets the number of seconds between scans. Default value will be 10.",
+        type=int,
+        default=10)
+    parser.add_argument("-m", "--mode",
+        help="Sets the backup mode. full - copy everything on each run, incremental - keep a mirror in the destination directory and only copy files that changed since the last run, dedup - split files into chunks stored once by hash and record each backup as a small snapshot index. Default value will be full.",
+        choices=["full", "incremental", "dedup"],
+        default="full")
+    parser.add_argument("--hash_check",
+        help="Incremental mode only. Sets a flag to hash files whose modification time changed but size didn't, so that identical content is not copied again. 0 - DON'T HASH, 1 - HASH. Default value will be 0.",
+        default="0")
+    parser.add_argument("--workers",
+        help="Sets the number of worker threads used to copy files at the same time. 1 - copy one file at a time. Default value will be 1.",
+        type=int,
+        default=1)
+    parser.add_argument("--split_size",
+        help="Only used when --workers is above 1. Files at least this big (in MB) are split into ranges that are copied in parallel. 0 - never split files. Default value will be 0.",
+        type=int,
+        default=0)
+    parser.add_argument("--copy_strategy",
+        help="Sets how files are copied. auto - use the fastest method each file supports: reflink (copy-on-write clone on btrfs/XFS), copy_file_range, sendfile, then a basic read/write copy. Naming a method starts from it and falls back to the ones after it. Default value will be auto.",
+        choices=["auto"] + fast_copy.STRATEGIES,
+        default="auto")
+    parser.add_argument("--hash_manifest",
+        help="Sets a flag to write <backup>.hashes.json with the hash of every file, computed while the backup is written. Check the backup later with verify.py. 0 - DON'T WRITE, 1 - WRITE. Default value will be 0.",
+        default="0")
+    parser.add_argument("--hash_algorithm",
+        help="Only used with --hash_manifest 1. Sets the hash algorithm (xxh3_128 requires the xxhash package). Default value will be blake2b.",
+        choices=list(hash_manifest.HASH_ALGORITHMS),
+        default="blake2b")
+    parser.add_argument("--catalog",
+        help="Sets a flag to record every backup and its files in backup_catalog.db in the destination directory, so they can be looked up with catalog.py. 0 - DON'T RECORD, 1 - RECORD. Default value will be 0.",
+        default="0")
+    parser.add_argument("--keep_last",
+        help="Retention policy (turns on --catalog): keeps the newest N full backups. 0 - rule not used. Default value will be 0.",
+        type=int,
+        default=0)
+    parser.add_argument("--keep_daily",
+        help="Retention policy (turns on --catalog): keeps the newest full backup of each of the last N days with backups. 0 - rule not used. Default value will be 0.",
+        type=int,
+        default=0)
+    parser.add_argument("--keep_weekly",
+        help="Retention policy (turns on --catalog): keeps the newest full backup of each of the last N weeks with backups. 0 - rule not used. Default value will be 0.",
+        type=int,
+        default=0)
+    parser.add_argument("--keep_monthly",
+        help="Retention policy (turns on --catalog): keeps the newest full backup of each of the last N months with backups. 0 - rule not used. Default value will be 0.",
+        type=int,
+        default=0)
+    parser.add_argument("--include",
+        help="Only backs up files matching one of these glob patterns. A pattern without a / matches file names at any depth (e.g. \"*.docx\"), one with a / matches paths relative to the source (e.g. \"docs/*.pdf\"). If not specified, every file is backed up.",
+        nargs="+",
+        default=[])
+    parser.add_argument("--exclude",
+        help="Leaves out files and directories matching any of these glob patterns, in the same form as --include (e.g. node_modules .git/objects \"*.tmp\"). Excluded directories are skipped without being scanned.",
+        nargs="+",
+        default=[])
+    parser.add_argument("--min_file_size",
+        help="Only backs up files at least this big (in MB). 0 - no limit. Default value will be 0.",
+        type=float,
+        default=0)
+    parser.add_argument("--max_file_size",
+        help="Only backs up files up to this big (in MB). 0 - no limit. Default value will be 0.",
+        type=float,
+        default=0)
+    parser.add_argument("--min_age",
+        help="Only backs up files last modified at least this many days ago. 0 - no limit. Default value will be 0.",
+        type=float,
+        default=0)
+    parser.add_argument("--max_age",
+        help="Only backs up files modified in the last this many days. 0 - no limit. Default value will be 0.",
+        type=float,
+        default=0)
+    parser.add_argument("--io_limit",
+        help="Limits how fast the source is read while copying/compressing (in MB/s), so the backup doesn't starve other programs of disk bandwidth. 0 - no limit. Default value will be 0.",
+        type=float,
+        default=0)
+    parser.add_argument("--upload_limit",
+        help="Limits the upload bandwidth to cloud services (in MB/s). 0 - no limit. Default value will be 0.",
+        type=float,
+        default=0)
+    parser.add_argument("--low_priority",
+        help="Sets a flag to run the backup with low CPU and I/O priority (the I/O priority requires the psutil package). 0 - NORMAL PRIORITY, 1 - LOW PRIORITY. Default value will be 0.",
+        default="0")
+    parser.add_argument("--limits_file",
+        help="Only used with --watchdog 1. JSON file with the limits, e.g. {\"io_limit\": 20, \"upload_limit\": 5}, re-read whenever it changes so the limits can be adjusted without restarting.",
+        default="")
+    parser.add_argument("--journal",
+        help="Only used in full mode without --stream. Sets a flag to copy into a staging directory with a journal of the finished files, so a backup that fails or is killed resumes where it stopped on the next run instead of starting over. 0 - NO JOURNAL, 1 - JOURNAL. Default value will be 0.",
+        default="0")
+    parser.add_argument("--stream",
+        help="Only used with --compress 1 in full mode. Sets a flag to write the archive straight from the source in a single pass instead of compressing a temporary copy. 0 - COPY THEN COMPRESS, 1 - STREAM. Default value will be 0.",
+        default="0")
+    parser.add_argument("--archive_format",
+        help="Only used with --stream 1. Sets the format of the archive (tar.zst requires the zstandard package). Default value will be zip.",
+        choices=list(streaming_archive.ARCHIVE_FORMATS),
+        default="zip")
+    parser.add_argument("--volume_size",
+        help="Only used with --stream 1. Splits the archive into volumes of this size (in MB), each uploaded to the cloud as soon as it is written. 0 - write a single archive. Default value will be 0.",
+        type=int,
+        default=0)
+    parser.add_argument("--max_pending_volumes",
+        help="Only used with --volume_size. Sets how many finished volumes can wait for upload before writing pauses. Default value will be 2.",
+        type=int,
+        default=2)
+    parser.add_argument("--codec",
+        help="Sets the codec used to compress ZIP archives. Files that are already compressed (e.g. .jpg, .zip, .mp4) are always stored as-is. Default value will be deflate.",
+        choices=list(parallel_compression.ZIP_CODECS),
+        default="deflate")
+    parser.add_argument("--compress_level",
+        help="Sets the compression level (deflate: 0-9, bzip2: 1-9, tar.zst: 1-22, stored and lzma don't take a level). If not specified, the codec's default level is used.",
+        type=int,
+        default=None)
+    parser.add_argument("--compress_workers",
+        help="Sets the number of threads used to compress archive members in parallel. If not specified, one thread per CPU core is used.",
+        type=int,
+        default=None)
+    parser.add_argument("--upload_chunk_size",
+        help="Sets the size (in MB) of each request when uploading to cloud services. Interrupted uploads resume from the last chunk received. Default value will be 32.",
+        type=int,
+        default=32)
+    parser.add_argument("--upload_workers",
+        help="Sets the number of files uploaded to cloud services at the same time. Default value will be 4.",
+        type=int,
+        default=4)
+    parser.add_argument("--cloud_sync",
+        help="Sets a flag to EITHER upload the backup as a new file (0) OR sync it into a cloud folder named after the source, only uploading files whose size/checksum differ from the remote copy (1). Default value will be 0.",
+        default="0")
+    parser.add_argument("--verbose",
+        help="Sets a flag to log every file that is copied/compressed. 0 - ONLY LOG PROGRESS, 1 - LOG EVERY FILE. Default value will be 0.",
+        default="0")
+    parser.add_argument("--metrics_json",
+        help="Writes per-stage timings, file/byte counts and throughput of each backup to this JSON file.",
+        default="")
+    parser.add_argument("--prometheus_file",
+        help="Writes the backup metrics to this file in the Prometheus text format (for node_exporter's textfile collector).",
+        default="")
+    parser.add_argument("--progress_interval",
+        help="Sets the minimum number of seconds between progress messages. Default value will be 5.",
+        type=int,
+        default=5)
     parser.add_argument(
         "--cloud",
         nargs="*",
@@ -120,6 +349,42 @@ def main():
     compress_backup = args.compress
     cloud = args.cloud
     watchdog = args.watchdog
+    backup_mode = args.mode
+    hash_check = args.hash_check
+    copy_workers = args.workers
+    split_size = args.split_size
+    stream_archive = args.stream
+    archive_format = args.archive_format
+    volume_size = args.volume_size
+    max_pending_volumes = args.max_pending_volumes
+    codec = args.codec
+    compress_level = args.compress_level
+    compress_workers = args.compress_workers
+    upload_chunk_size = args.upload_chunk_size
+    upload_workers = args.upload_workers
+    cloud_sync = args.cloud_sync
+    verbose = args.verbose
+    metrics_json = args.metrics_json
+    prometheus_file = args.prometheus_file
+    progress_interval = args.progress_interval
+    copy_strategy = args.copy_strategy
+    use_hash_manifest = args.hash_manifest
+    hash_algorithm = args.hash_algorithm
+    catalog = args.catalog
+    keep_last = args.keep_last
+    keep_daily = args.keep_daily
+    keep_weekly = args.keep_weekly
+    keep_monthly = args.keep_monthly
+    include = args.include
+    exclude = args.exclude
+    min_file_size = args.min_file_size
+    max_file_size = args.max_file_size
+    min_age = args.min_age
+    max_age = args.max_age
+    io_limit = args.io_limit
+    upload_limit = args.upload_limit
+    low_priority = args.low_priority
+    journal = args.journal
 
     if not source_path:
         raise ValueError("ERROR: Please specify a source directory")
@@ -127,20 +392,48 @@ def main():
     if not dest_path:
         raise ValueError("ERROR: Please specify a destination directory")
 
-    config = BackupConfig(source_path, dest_path, target_file, backup_name, compress_backup, cloud)
+    config = BackupConfig(source_path, dest_path, target_file, backup_name, compress_backup, cloud,
+                          backup_mode, hash_check, copy_workers, split_size,
+                          stream_archive, archive_format,
+                          codec, compress_level, compress_workers,
+                          upload_chunk_size, upload_workers, cloud_sync,
+                          volume_size, max_pending_volumes,
+                          verbose, metrics_json, prometheus_file, progress_interval,
+                          copy_strategy, use_hash_manifest, hash_algorithm,
+                          catalog, keep_last, keep_daily, keep_weekly, keep_monthly,
+                          include, exclude, min_file_size, max_file_size, min_age, max_age,
+                          io_limit, upload_limit, low_priority, journal)
+
+    # checked up front, a bad level would otherwise only show up as a failed compression once the copy is done
+    if config.writes_zip():
+        parallel_compression.check_level(config.codec, config.compress_level)
+
+    # before any worker threads are started, they inherit the priority
+    if low_priority == "1":
+        lower_priority()
 
     if watchdog == "1":
-        observer = Observer()
-        handler = LocalBackupWorker(observer, logger, config)
+        if args.watch_engine == "polling":
+            # for trees too big for inotify watches: diff a snapshot of the tree on an interval instead
+            # runs on a separate background thread
+            handler = LocalBackupWorker(None, logger, config)
+            observer = PollingScanner(source_path, handler.mark_dirty, args.poll_interval, rules=handler.rules)
+            handler.observer = observer
+        else:
+            observer = Observer()
+            handler = LocalBackupWorker(observer, logger, config)
 
-        # main event handler, use recursive=True to monitor all subdirectories
-        # runs on a separate background thread
-        observer.schedule(handler, source_path, recursive=True)
+            # main event handler, use recursive=True to monitor all subdirectories
+            # runs on a separate background thread
+            observer.schedule(handler, source_path, recursive=True)
         observer.start()
 
+        limits_file = LimitsFile(args.limits_file, handler.throttle) if args.limits_file else None
         try:
             logger.info("Main backup thread started.")
             while True:
+                if limits_file:
+                    limits_file.poll() # picks up new limits, even while a backup is running
                 time.sleep(1) # small delay to avoid CPU overloading - gives it some time to free up resources
         except KeyboardInterrupt:
             logger.info("Terminating...")
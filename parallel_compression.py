@@ -0,0 +1,219 @@
+import os
+import sys
+import zlib
+import shutil
+import logging
+import zipfile
+import tempfile
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from hash_manifest import new_hasher, hash_file
+
+logger = logging.getLogger()
+
+# codecs available for ZIP archives
+ZIP_CODECS = {
+    "stored": zipfile.ZIP_STORED,
+    "deflate": zipfile.ZIP_DEFLATED,
+    "bzip2": zipfile.ZIP_BZIP2,
+    "lzma": zipfile.ZIP_LZMA
+}
+
+# compression levels each codec accepts, stored and lzma members are written without a level
+ZIP_LEVELS = {
+    "deflate": (0, 9),
+    "bzip2": (1, 9)
+}
+
+# files with these extensions are already compressed, so they are stored as-is instead of wasting CPU on them
+PRECOMPRESSED_EXTENSIONS = {
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic",
+    ".mp3", ".aac", ".ogg", ".flac", ".m4a",
+    ".mp4", ".mkv", ".mov", ".avi", ".webm",
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".lz4", ".7z", ".rar",
+    ".docx", ".xlsx", ".pptx", ".jar", ".apk"
+}
+
+COMPRESS_BLOCK_SIZE = 1024 * 1024 # 1 MiB reads when compressing a file
+SPOOL_MAX_SIZE = 8 * 1024 * 1024 # compressed members bigger than this are spooled to a temporary file
+
+def is_precompressed(path) -> bool:
+    return os.path.splitext(path)[1].lower() in PRECOMPRESSED_EXTENSIONS
+
+# raises ValueError if level can't be used with codec, so a bad level is reported before anything is compressed
+def check_level(codec, level):
+    if level is None or codec not in ZIP_LEVELS:
+        return
+    (lowest, highest) = ZIP_LEVELS[codec]
+    if not lowest <= level <= highest:
+        raise ValueError(f"Compression level {level} isn't valid for {codec}, it must be between {lowest} and {highest}")
+
+'''
+Adds files to a zipfile.ZipFile, compressing members on a pool of worker threads
+(zlib, bz2 and lzma release the GIL, so this scales across cores)
+Each worker compresses a whole member into a spool, then the members are written to the
+archive in the order they were added. At most workers * 2 members are in flight at once,
+so memory stays bounded.
+hash_algorithm - (optional) hash each file while it's compressed, the digests are kept in hashes (member name -> digest)
+pool - (optional) thread pool shared with other writers, e.g. by jobs running side by side in the scheduler,
+       so concurrent archives don't start one thread per core each
+throttle - (optional) TokenBucket limiting the bytes read per second from the files being compressed
+When the zipfile internals this relies on aren't usable (see zipfile_internals_usable()),
+members are written one at a time with ZipFile.write() instead.
+'''
+class ParallelZipWriter:
+    def __init__(self, zip_file, codec="deflate", level=None, workers=None, hash_algorithm=None, pool=None, throttle=None):
+        if codec not in ZIP_CODECS:
+            raise ValueError(f"Unsupported ZIP codec: {codec}")
+        check_level(codec, level)
+
+        self.zip_file = zip_file
+        self.compress_type = ZIP_CODECS[codec]
+        self.level = level
+        self.parallel = zipfile_internals_usable(zip_file)
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.owns_pool = pool is None
+        self.pool = pool or ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = deque()
+        self.stored_count = 0
+        self.hash_algorithm = hash_algorithm
+        self.hashes = {}
+        self.throttle = throttle
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(write_pending=exc_type is None)
+
+    def add_file(self, path, arcname):
+        if is_precompressed(path):
+            self.stored_count += 1
+        if not self.parallel:
+            self.write_serial(path, arcname)
+            return
+        self.pending.append(self.pool.submit(self.compress_member, path, arcname))
+        while len(self.pending) >= self.workers * 2:
+            self.write_next()
+
+    def add_dir(self, arcname):
+        self.flush()
+        self.zip_file.writestr(arcname.rstrip("/") + "/", "")
+
+    def flush(self):
+        while self.pending:
+            self.write_next()
+
+    def close(self, write_pending=True):
+        try:
+            if write_pending:
+                self.flush()
+        finally:
+            for future in self.pending:
+                future.cancel()
+            if self.owns_pool:
+                self.pool.shutdown(wait=True)
+
+    def compress_member(self, path, arcname) -> tuple:
+        zinfo = zipfile.ZipInfo.from_file(path, arcname)
+        zinfo.compress_type = self.compress_type
+        if is_precompressed(path):
+            zinfo.compress_type = zipfile.ZIP_STORED
+
+        compressor = new_compressor(zinfo.compress_type, self.level)
+        hasher = new_hasher(self.hash_algorithm) if self.hash_algorithm else None
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        crc = 0
+        size = 0
+        try:
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(COMPRESS_BLOCK_SIZE), b""):
+                    if self.throttle:
+                        self.throttle.consume(len(block))
+                    crc = zlib.crc32(block, crc)
+                    if hasher:
+                        hasher.update(block)
+                    size += len(block)
+                    spool.write(compressor.compress(block) if compressor else block)
+            if compressor:
+                spool.write(compressor.flush())
+        except BaseException:
+            spool.close()
+            raise
+
+        zinfo.file_size = size
+        zinfo.CRC = crc
+        zinfo.compress_size = spool.tell()
+        spool.seek(0)
+        return (zinfo, spool, hasher.hexdigest() if hasher else None)
+
+    def write_next(self):
+        (zinfo, spool, digest) = self.pending.popleft().result()
+        if digest:
+            self.hashes[zinfo.filename] = digest
+        with spool:
+            write_compressed_member(self.zip_file, zinfo, spool)
+
+    # compresses and writes a member on the calling thread, only through the public zipfile API
+    def write_serial(self, path, arcname):
+        compress_type = zipfile.ZIP_STORED if is_precompressed(path) else self.compress_type
+        digest = hash_file(path, self.hash_algorithm) if self.hash_algorithm else None
+        if self.throttle:
+            self.throttle.consume(os.path.getsize(path))
+        self.zip_file.write(path, arcname, compress_type, self.level)
+        if digest:
+            self.hashes[self.zip_file.filelist[-1].filename] = digest
+
+
+'''
+zipfile has no public API for adding a member that was already compressed, so the parallel writer uses these
+internals (checked against CPython 3.8 to 3.13): zipfile._get_compressor(), ZipFile._writecheck(),
+and the _didModify, _seekable, start_dir and _allowZip64 attributes of an open ZipFile
+They are only used through new_compressor() and write_compressed_member(), and only when
+zipfile_internals_usable() says they are there, otherwise archives are written serially.
+'''
+ZIPFILE_INTERNALS_CHECKED = ((3, 8), (3, 13)) # oldest and newest Python versions they were checked against
+ZIPFILE_INTERNAL_ATTRIBUTES = ("_didModify", "_seekable", "start_dir", "_allowZip64")
+warned_serial = False
+
+def zipfile_internals_usable(zip_file) -> bool:
+    global warned_serial
+    (oldest, newest) = ZIPFILE_INTERNALS_CHECKED
+    usable = (oldest <= sys.version_info[:2] <= newest and callable(getattr(zipfile, "_get_compressor", None))
+              and callable(getattr(zip_file, "_writecheck", None))
+              and all(hasattr(zip_file, name) for name in ZIPFILE_INTERNAL_ATTRIBUTES))
+    if not usable and not warned_serial:
+        warned_serial = True
+        logger.warning(f"Parallel ZIP compression isn't supported on Python {sys.version_info[0]}.{sys.version_info[1]}, "
+                       "archive members are compressed one at a time")
+    return usable
+
+def new_compressor(compress_type, level):
+    return zipfile._get_compressor(compress_type, level)
+
+# writes a member that has already been compressed into the archive
+# this mirrors what ZipFile.open(zinfo, "w") does, except the sizes and CRC are known up-front,
+# so no data descriptor or header rewrite is needed (works on unseekable outputs too)
+def write_compressed_member(zip_file, zinfo, data):
+    zinfo.flag_bits = 0x00
+    if zinfo.compress_type == zipfile.ZIP_LZMA:
+        zinfo.flag_bits |= 0x02 # compressed data includes an end-of-stream (EOS) marker
+
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+    if zip64 and not zip_file._allowZip64:
+        raise zipfile.LargeZipFile("Filesize would require ZIP64 extensions")
+
+    if zip_file._seekable:
+        zip_file.fp.seek(zip_file.start_dir)
+    zinfo.header_offset = zip_file.fp.tell()
+
+    zip_file._writecheck(zinfo)
+    zip_file._didModify = True
+
+    zip_file.fp.write(zinfo.FileHeader(zip64))
+    shutil.copyfileobj(data, zip_file.fp, COMPRESS_BLOCK_SIZE)
+
+    zip_file.filelist.append(zinfo)
+    zip_file.NameToInfo[zinfo.filename] = zinfo
+    zip_file.start_dir = zip_file.fp.tell()
@@ -0,0 +1,196 @@
+import os
+import time
+import shutil
+import logging
+import threading
+
+from fast_copy import FastCopier
+from tree_walker import TreeWalker
+from backup_manifest import BackupManifest
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+
+logger = logging.getLogger()
+
+COPY_BLOCK_SIZE = 1024 * 1024 # 1 MiB reads/writes when copying byte ranges
+DEFAULT_RANGE_SIZE = 64 * 1024 * 1024 # size of each range when a large file is split
+
+# counters for a copy run, used to report files/sec and MB/s
+class CopyStats:
+    def __init__(self, on_progress=None):
+        self.on_progress = on_progress # optional callback taking (files, bytes)
+        self.files = 0
+        self.bytes = 0
+        self.started = time.perf_counter()
+        self.finished = None
+        self.lock = threading.Lock()
+
+    def add(self, files, nbytes):
+        with self.lock:
+            self.files += files
+            self.bytes += nbytes
+        if self.on_progress:
+            self.on_progress(files, nbytes)
+
+    def finish(self):
+        self.finished = time.perf_counter()
+
+    def elapsed(self) -> float:
+        end = self.finished if self.finished is not None else time.perf_counter()
+        return max(end - self.started, 1e-9)
+
+    def files_per_sec(self) -> float:
+        return self.files / self.elapsed()
+
+    def mb_per_sec(self) -> float:
+        return self.bytes / (1024 * 1024) / self.elapsed()
+
+    def summary(self) -> str:
+        return (f"{self.files} files, {self.bytes / (1024 * 1024):.1f} MB in {self.elapsed():.2f}s "
+                f"({self.files_per_sec():.1f} files/s, {self.mb_per_sec():.1f} MB/s)")
+
+
+'''
+Copies a directory tree (or a single file) using a pool of worker threads
+workers - number of files copied at the same time
+split_threshold - files at least this big (in bytes) are copied as several byte ranges in parallel, 0 disables splitting
+range_size - size of each byte range when a file is split
+on_progress - optional callback taking (files, bytes), called as the copy progresses
+copier - FastCopier used for each file, shared so the strategies that work are remembered between runs
+rules - (optional) WalkRules deciding which files of a tree are copied
+journal - (optional) BackupJournal of the backup, files it already has are skipped and every file copied is recorded in it,
+          whatever earlier runs staged that the walk didn't see is removed before the copy is finished
+Metadata is preserved the same way as shutil.copy2()/copytree()
+After copy_tree(), records holds the stat record of every file in the copy (relative path -> record),
+taken from the walk so the tree doesn't have to be scanned again
+'''
+class ParallelCopier:
+    def __init__(self, workers=8, split_threshold=0, range_size=DEFAULT_RANGE_SIZE, on_progress=None, copier=None, rules=None, journal=None):
+        self.workers = max(1, workers)
+        self.split_threshold = split_threshold
+        self.range_size = max(COPY_BLOCK_SIZE, range_size)
+        self.on_progress = on_progress
+        self.copier = copier or FastCopier()
+        self.rules = rules
+        self.journal = journal
+        self.records = {}
+        self.stats = CopyStats()
+
+    # files that are hashed while copied have to be read in order, so they are never split
+    def should_split(self, size) -> bool:
+        return not self.copier.hash_algorithm and self.split_threshold > 0 and size >= self.split_threshold and size > self.range_size
+
+    def copy_tree(self, src, dst) -> CopyStats:
+        self.stats = CopyStats(self.on_progress)
+        self.records = {}
+        large_files = []
+        dirs = []
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = []
+            # same behaviour as shutil.copytree(symlinks=False): symlinks are followed and their contents copied
+            walker = TreeWalker(src, self.rules, follow_symlinks=True)
+            for (rel_root, root, subdirs, files) in walker.walk():
+                dest_root = os.path.join(dst, rel_root) if rel_root else dst
+                # a resumed backup copies into the staging directory left by the previous run
+                os.makedirs(dest_root, exist_ok=(dest_root != dst or self.journal is not None))
+                dirs.append((rel_root, root, dest_root))
+
+                for (f, st) in files:
+                    rel_path = os.path.join(rel_root, f) if rel_root else f
+                    self.records[rel_path] = BackupManifest.make_record(st)
+                    if self.journal and self.journal.is_done(rel_path, st):
+                        continue
+                    src_file = os.path.join(root, f)
+                    dest_file = os.path.join(dest_root, f)
+                    if self.should_split(st.st_size):
+                        large_files.append((src_file, dest_file, rel_path, st))
+                    else:
+                        futures.append(pool.submit(self.copy_whole_file, src_file, dest_file, st.st_size, rel_path, st))
+
+            # large files are copied after the small ones are queued, so their ranges share the pool
+            for (src_file, dest_file, rel_path, st) in large_files:
+                futures.extend(self.submit_ranges(pool, src_file, dest_file, st.st_size))
+
+            self.wait_all(futures)
+        walker.log_excluded()
+        walker.check_errors()
+
+        for (src_file, dest_file, rel_path, st) in large_files:
+            shutil.copystat(src_file, dest_file)
+            self.record(rel_path, st, dest_file)
+            self.stats.add(1, 0)
+
+        if self.journal:
+            self.journal.prune(self.records, set(rel_root for (rel_root, src_dir, dest_dir) in dirs))
+
+        # directory metadata goes last (deepest first), since creating files inside them changes their mtime
+        for (rel_root, src_dir, dest_dir) in reversed(dirs):
+            shutil.copystat(src_dir, dest_dir)
+
+        self.stats.finish()
+        logger.info(f"Parallel copy finished: {self.stats.summary()}")
+        return self.stats
+
+    def copy_single_file(self, src, dst) -> CopyStats:
+        self.stats = CopyStats(self.on_progress)
+        size = os.path.getsize(src)
+
+        if self.should_split(size):
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                self.wait_all(self.submit_ranges(pool, src, dst, size))
+            shutil.copystat(src, dst)
+            self.stats.add(1, 0)
+        else:
+            self.copy_whole_file(src, dst, size)
+
+        self.stats.finish()
+        logger.info(f"Parallel copy finished: {self.stats.summary()}")
+        return self.stats
+
+    def copy_whole_file(self, src, dst, size=None, rel_path=None, st=None):
+        self.copier.copy2(src, dst)
+        if rel_path is not None:
+            self.record(rel_path, st, dst)
+        self.stats.add(1, size if size is not None else os.path.getsize(dst))
+
+    # marks a file of the tree as copied in the journal, along with its hash when the copy was hashed
+    def record(self, rel_path, st, dst):
+        if self.journal:
+            self.journal.record(rel_path, st, self.copier.hashes.get(dst))
+
+    # pre-sizes the destination file and queues one copy task per byte range
+    def submit_ranges(self, pool, src, dst, size) -> list:
+        with open(dst, "wb") as f:
+            f.truncate(size)
+
+        futures = []
+        for offset in range(0, size, self.range_size):
+            length = min(self.range_size, size - offset)
+            futures.append(pool.submit(self.copy_range, src, dst, offset, length))
+        return futures
+
+    def copy_range(self, src, dst, offset, length):
+        with open(src, "rb") as fsrc, open(dst, "r+b") as fdst:
+            # copy inside the kernel when possible, then finish whatever is left with reads/writes
+            copied = self.copier.copy_range(fsrc.fileno(), fdst.fileno(), offset, length)
+            fsrc.seek(offset + copied)
+            fdst.seek(offset + copied)
+            remaining = length - copied
+            while remaining > 0:
+                block = fsrc.read(min(COPY_BLOCK_SIZE, remaining))
+                if not block:
+                    raise IOError(f"{src} was truncated while being copied")
+                fdst.write(block)
+                remaining -= len(block)
+                if self.copier.throttle:
+                    self.copier.throttle.consume(len(block))
+        self.stats.add(0, length)
+
+    # waits for every task, re-raising the first error
+    @staticmethod
+    def wait_all(futures):
+        done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in not_done:
+            future.cancel()
+        for future in done:
+            future.result()
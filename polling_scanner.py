@@ -0,0 +1,131 @@
+import os
+import logging
+import threading
+
+from tree_walker import NO_RULES
+
+logger = logging.getLogger()
+
+'''
+Change detection without inotify watches: keeps a snapshot of the tree and diffs it on an interval
+The snapshot holds one record per directory:
+relative dir path -> (dir mtime, {name: (is_dir, size, mtime_ns, inode)})
+A directory's mtime only changes when entries are added, removed or renamed, so directories
+whose mtime is unchanged are not listed again - only one stat() per directory is needed.
+Files modified in place don't change their directory's mtime, so every deep_scan_every polls
+a deep pass lists and stats everything to catch those as well.
+rules - (optional) WalkRules of the backup, excluded files and directories are never tracked
+'''
+class PollingScanner:
+    def __init__(self, root, on_change, interval=10, deep_scan_every=6, rules=None):
+        self.root = root
+        self.on_change = on_change # called with the set of absolute paths that changed
+        self.interval = interval
+        self.deep_scan_every = max(1, deep_scan_every)
+        self.rules = rules or NO_RULES
+        self.snapshot = {}
+        self.polls = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        # the first pass just builds the baseline snapshot
+        self.poll(deep=True)
+        logger.info(f"Polling scanner tracking {len(self.snapshot)} directories under {self.root}")
+
+        self.thread = threading.Thread(target=self.run, name="PollingScanner", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def join(self):
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.polls += 1
+            try:
+                changes = self.poll(deep=self.polls % self.deep_scan_every == 0)
+            except Exception as e:
+                logger.error(f"Polling scan of {self.root} failed: {e}")
+                continue
+
+            if changes:
+                self.on_change(changes)
+
+    # walks the tree, updating the snapshot, and returns the absolute paths that changed
+    def poll(self, deep=False) -> set:
+        changes = set()
+        pending = [""]
+
+        while pending:
+            rel_dir = pending.pop()
+            entries = self.scan_dir(rel_dir, deep, changes)
+            for name, record in entries.items():
+                if record[0]:
+                    pending.append(os.path.join(rel_dir, name) if rel_dir else name)
+
+        return {os.path.join(self.root, rel_path) if rel_path else self.root for rel_path in changes}
+
+    def scan_dir(self, rel_dir, deep, changes) -> dict:
+        abs_dir = os.path.join(self.root, rel_dir) if rel_dir else self.root
+        old = self.snapshot.get(rel_dir)
+
+        try:
+            dir_mtime = os.stat(abs_dir).st_mtime_ns
+        except OSError:
+            # removed since it was listed by its parent
+            self.forget_dir(rel_dir)
+            changes.add(rel_dir)
+            return {}
+
+        # nothing was added/removed in here, reuse the listing from the snapshot
+        if old is not None and old[0] == dir_mtime and not deep:
+            return old[1]
+
+        entries = {}
+        try:
+            with os.scandir(abs_dir) as it:
+                for entry in it:
+                    if self.rules.filters:
+                        rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                        if self.rules.is_excluded(entry.name, rel_path.replace(os.sep, "/")):
+                            continue
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            entries[entry.name] = (True, 0, 0, 0)
+                        else:
+                            st = entry.stat(follow_symlinks=False)
+                            entries[entry.name] = (False, st.st_size, st.st_mtime_ns, st.st_ino)
+                    except OSError:
+                        continue
+        except OSError as e:
+            logger.warning(f"Unable to scan directory {abs_dir}: {e}")
+            return old[1] if old else {}
+
+        self.snapshot[rel_dir] = (dir_mtime, entries)
+
+        # the first time a directory is seen there is nothing to compare it with
+        if old is None:
+            return entries
+
+        old_entries = old[1]
+        for name, record in entries.items():
+            if old_entries.get(name) != record:
+                changes.add(os.path.join(rel_dir, name) if rel_dir else name)
+        for name, record in old_entries.items():
+            if name not in entries:
+                rel_path = os.path.join(rel_dir, name) if rel_dir else name
+                changes.add(rel_path)
+                if record[0]:
+                    self.forget_dir(rel_path)
+
+        return entries
+
+    # drops a directory and everything under it from the snapshot
+    def forget_dir(self, rel_dir):
+        prefix = rel_dir + os.sep
+        for key in [k for k in self.snapshot if k == rel_dir or k.startswith(prefix)]:
+            del self.snapshot[key]
@@ -0,0 +1,348 @@
+import os
+import sys
+import time
+import shutil
+import fnmatch
+import logging
+import tarfile
+import zipfile
+import argparse
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from chunk_store import ChunkStore
+from fast_copy import FastCopier
+from parallel_copy import ParallelCopier
+
+# zstandard is optional, tar.zst archives can only be restored when it's installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger()
+
+RESTORE_BLOCK_SIZE = 1024 * 1024 # 1 MiB reads/writes when extracting a member
+
+# returns True if the name (or the name without its top-level folder, which is named after the backup)
+# matches one of the glob patterns, or is inside a directory given as a pattern
+def matches(name, patterns) -> bool:
+    if not patterns:
+        return True
+
+    name = name.rstrip("/")
+    candidates = [name]
+    if "/" in name:
+        candidates.append(name.split("/", 1)[1])
+
+    for pattern in patterns:
+        pattern = pattern.replace(os.sep, "/").rstrip("/")
+        for candidate in candidates:
+            if fnmatch.fnmatchcase(candidate, pattern) or candidate.startswith(pattern + "/"):
+                return True
+    return False
+
+# joins a member name onto the output directory, refusing names that would end up outside of it
+def safe_join(output_path, name) -> str:
+    parts = [p for p in name.replace("\\", "/").split("/") if p not in ("", ".")]
+    if not parts or ".." in parts or os.path.isabs(name) or ":" in parts[0]:
+        raise ValueError(f"Refusing to restore unsafe path: {name}")
+    return os.path.join(output_path, *parts)
+
+def copy_stream(src, dst):
+    shutil.copyfileobj(src, dst, RESTORE_BLOCK_SIZE)
+
+
+'''
+Restores selected files (or everything) from a backup:
+zip - ZIP made by compress_backup or streaming, members are found through the central directory,
+      so only what's restored is read, and members are extracted in parallel
+tar - tar(.gz/.bz2/.xz/.zst) made by streaming, read in a single pass (compressed tar streams can't be seeked)
+dir/file - a plain copy, files are copied in parallel
+snapshot - a snapshot index in a deduplicated store (<store>/snapshots/<name>.json), files are rebuilt from their chunks in parallel
+patterns - glob patterns/directories to restore, matched against paths inside the backup; empty restores everything
+Modification times and permissions are restored along with the contents.
+'''
+class BackupRestorer:
+    def __init__(self, backup_path, patterns=None, workers=None):
+        self.backup_path = backup_path
+        self.patterns = patterns or []
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.kind = self.detect_kind()
+        self.local = threading.local() # one open ZipFile per worker thread
+        self.open_zips = []
+
+    def detect_kind(self) -> str:
+        path = self.backup_path
+        if os.path.isdir(path):
+            return "dir"
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"Backup {path} does not exist")
+        if path.endswith(".json") and os.path.basename(os.path.dirname(path)) == "snapshots":
+            return "snapshot"
+        if zipfile.is_zipfile(path):
+            return "zip"
+        if path.endswith(".tar.zst") or tarfile.is_tarfile(path):
+            return "tar"
+        if path.endswith(".001"):
+            raise ValueError(f"{path} is a volume of a split archive, join the volumes in order first")
+        return "file"
+
+    # names of every file/empty directory in the backup that matches the patterns
+    def list_entries(self) -> list:
+        if self.kind == "zip":
+            with zipfile.ZipFile(self.backup_path) as zip_file:
+                return [info.filename for info in zip_file.infolist() if matches(info.filename, self.patterns)]
+        if self.kind == "tar":
+            with self.open_tar() as tar:
+                return [m.name for m in self.iter_tar(tar)]
+        if self.kind == "snapshot":
+            return sorted(self.snapshot_files())
+        return [name for (path, name) in self.iter_copy()]
+
+    # restores the matching entries under output_path, returns the number of files restored
+    def restore(self, output_path) -> int:
+        os.makedirs(output_path, exist_ok=True)
+        started = time.perf_counter()
+        restore_function = {
+            "zip": self.restore_zip,
+            "tar": self.restore_tar,
+            "snapshot": self.restore_snapshot,
+            "dir": self.restore_copy,
+            "file": self.restore_copy
+        }[self.kind]
+        (count, nbytes) = restore_function(output_path)
+
+        elapsed = max(time.perf_counter() - started, 1e-9)
+        logger.info(f"Restored {count} files ({nbytes / (1024 * 1024):.1f} MB) from {self.backup_path} to {output_path} "
+                    f"in {elapsed:.2f}s ({nbytes / (1024 * 1024) / elapsed:.1f} MB/s)")
+        return count
+
+    # writes the contents of the single matching file to out (e.g. stdout)
+    # a tar is read in a single pass, so the first matching file is streamed without looking for others after it
+    def stream(self, out):
+        if self.kind == "tar":
+            self.stream_tar(out)
+            out.flush()
+            return
+
+        names = [n for n in self.list_entries() if not n.endswith("/")]
+        if len(names) != 1:
+            raise ValueError(f"Streaming needs exactly one matching file, {len(names)} matched")
+
+        if self.kind == "zip":
+            with zipfile.ZipFile(self.backup_path) as zip_file, zip_file.open(names[0]) as member:
+                copy_stream(member, out)
+        elif self.kind == "snapshot":
+            store = self.load_snapshot()[0]
+            for chunk_hash in self.snapshot_files()[names[0]][1]["chunks"]:
+                out.write(store.get_chunk(chunk_hash))
+        else:
+            path = dict((name, path) for (path, name) in self.iter_copy())[names[0]]
+            with open(path, "rb") as f:
+                copy_stream(f, out)
+        out.flush()
+
+    def restore_zip(self, output_path) -> tuple:
+        with zipfile.ZipFile(self.backup_path) as zip_file:
+            selected = [info for info in zip_file.infolist() if matches(info.filename, self.patterns)]
+
+        files = []
+        for info in selected:
+            dest = safe_join(output_path, info.filename)
+            if info.is_dir():
+                os.makedirs(dest, exist_ok=True)
+            else:
+                files.append((info, dest))
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                ParallelCopier.wait_all([pool.submit(self.extract_zip_member, info, dest) for (info, dest) in files])
+        finally:
+            for zip_file in self.open_zips:
+                zip_file.close()
+            self.open_zips = []
+
+        # directory mtimes go last, since extracting files inside them changes them
+        for info in selected:
+            if info.is_dir():
+                set_zip_metadata(info, safe_join(output_path, info.filename))
+        return (len(files), sum(info.file_size for (info, dest) in files))
+
+    def extract_zip_member(self, info, dest):
+        # ZipFile objects can't be shared between threads that read at the same time
+        zip_file = getattr(self.local, "zip_file", None)
+        if zip_file is None:
+            zip_file = self.local.zip_file = zipfile.ZipFile(self.backup_path)
+            self.open_zips.append(zip_file)
+
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with zip_file.open(info) as member, open(dest, "wb") as f:
+            copy_stream(member, f)
+        set_zip_metadata(info, dest)
+        logger.debug("Restored %s", info.filename)
+
+    def open_tar(self):
+        if self.backup_path.endswith(".tar.zst"):
+            if zstandard is None:
+                raise ValueError("Restoring tar.zst archives requires the zstandard package")
+            reader = zstandard.ZstdDecompressor().stream_reader(open(self.backup_path, "rb"), closefd=True)
+            return tarfile.open(fileobj=reader, mode="r|")
+        return tarfile.open(self.backup_path, mode="r|*")
+
+    # yields the matching members of a tar opened in stream mode, which has to be read in order
+    def iter_tar(self, tar):
+        for member in tar:
+            if matches(member.name, self.patterns) and (member.isfile() or member.isdir()):
+                yield member
+
+    def stream_tar(self, out):
+        with self.open_tar() as tar:
+            for member in self.iter_tar(tar):
+                if member.isfile(): # directories match too, links and devices are never yielded
+                    copy_stream(tar.extractfile(member), out)
+                    return
+        raise ValueError("Streaming needs exactly one matching file, 0 matched")
+
+    def restore_tar(self, output_path) -> tuple:
+        count = 0
+        nbytes = 0
+        # the "data" filter (Python 3.12, backported to security releases) blocks unsafe paths and links
+        extract_options = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+        dirs = []
+        with self.open_tar() as tar:
+            for member in self.iter_tar(tar):
+                dest = safe_join(output_path, member.name)
+                tar.extract(member, output_path, **extract_options)
+                if member.isdir():
+                    dirs.append((dest, member.mtime))
+                else:
+                    count += 1
+                    nbytes += member.size
+                    logger.debug("Restored %s", member.name)
+
+        # directory mtimes go last, since extracting files inside them changes them
+        for (dest, mtime) in reversed(dirs):
+            os.utime(dest, (mtime, mtime))
+        return (count, nbytes)
+
+    # yields (path, name) for the matching files of a plain copy, names start with the backup's folder name
+    def iter_copy(self):
+        base_name = os.path.basename(os.path.normpath(self.backup_path))
+        if self.kind == "file":
+            if matches(base_name, self.patterns):
+                yield (self.backup_path, base_name)
+            return
+
+        for root, dirs, files in os.walk(self.backup_path):
+            rel_root = os.path.relpath(root, self.backup_path)
+            for f in sorted(files):
+                rel_path = f if rel_root == "." else os.path.join(rel_root, f)
+                name = f"{base_name}/{rel_path.replace(os.sep, '/')}"
+                if matches(name, self.patterns):
+                    yield (os.path.join(root, f), name)
+
+    def restore_copy(self, output_path) -> tuple:
+        copier = FastCopier()
+        files = list(self.iter_copy())
+
+        def restore_file(path, name):
+            dest = safe_join(output_path, name)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            copier.copy2(path, dest)
+            logger.debug("Restored %s", name)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            ParallelCopier.wait_all([pool.submit(restore_file, path, name) for (path, name) in files])
+        return (len(files), sum(os.path.getsize(path) for (path, name) in files))
+
+    def load_snapshot(self) -> tuple:
+        snapshots_path = os.path.dirname(os.path.abspath(self.backup_path))
+        store = ChunkStore(os.path.dirname(snapshots_path))
+        name = os.path.splitext(os.path.basename(self.backup_path))[0]
+        return (store, store.load_snapshot(name))
+
+    # matching files of the snapshot as name -> (relative path, entry), names start with the snapshot name
+    # like the folder inside a ZIP
+    def snapshot_files(self) -> dict:
+        (store, snapshot) = self.load_snapshot()
+        base_name = os.path.splitext(os.path.basename(self.backup_path))[0]
+        files = {}
+        for rel_path, entry in snapshot["files"].items():
+            name = f"{base_name}/{rel_path.replace(os.sep, '/')}"
+            if matches(name, self.patterns):
+                files[name] = (rel_path, entry)
+        return files
+
+    def restore_snapshot(self, output_path) -> tuple:
+        (store, snapshot) = self.load_snapshot()
+        base_name = os.path.splitext(os.path.basename(self.backup_path))[0]
+
+        for rel_dir in snapshot["dirs"]:
+            name = f"{base_name}/{rel_dir.replace(os.sep, '/')}"
+            if matches(name, self.patterns):
+                os.makedirs(safe_join(output_path, name), exist_ok=True)
+
+        files = self.snapshot_files()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            ParallelCopier.wait_all([pool.submit(store.restore_file, entry, safe_join(output_path, name))
+                                     for name, (rel_path, entry) in files.items()])
+        return (len(files), sum(entry["size"] for (rel_path, entry) in files.values()))
+
+# restores the modification time and (when stored) the permissions of a ZIP member
+def set_zip_metadata(info, dest):
+    mode = (info.external_attr >> 16) & 0o7777
+    if mode:
+        os.chmod(dest, mode)
+    mtime = time.mktime(info.date_time + (0, 0, -1))
+    os.utime(dest, (mtime, mtime))
+
+
+def get_cmd_parser():
+    parser = argparse.ArgumentParser(
+        prog="File Backup Script Restore",
+        description="Restores files from a backup made by main.py: a ZIP, a tar archive, a plain copy or a snapshot in the deduplicated store (<destination>/BACKUP-STORE/snapshots/<name>.json)")
+    parser.add_argument("backup_path",
+        help="Path of the backup to restore from.")
+    parser.add_argument("patterns",
+        help="Paths, directories or glob patterns (e.g. \"docs/*.txt\") to restore, relative to the backed up directory. Default: everything.",
+        nargs="*")
+    parser.add_argument("-o", "--output",
+        help="Directory to restore into. Default value will be the current directory.",
+        default=".")
+    parser.add_argument("--stdout",
+        help="Writes the contents of the single matching file to stdout instead of restoring it.",
+        action="store_true")
+    parser.add_argument("--list",
+        help="Only lists the matching entries.",
+        action="store_true")
+    parser.add_argument("--workers",
+        help="Sets the number of files restored at the same time. Default: one per CPU core.",
+        type=int,
+        default=None)
+    return parser
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(levelname)s] %(message)s",
+        stream=sys.stderr # stdout may be carrying a restored file
+    )
+    # patterns may come before or after the options
+    args = get_cmd_parser().parse_intermixed_args()
+
+    try:
+        restorer = BackupRestorer(args.backup_path, args.patterns, args.workers)
+        if args.list:
+            for name in restorer.list_entries():
+                print(name)
+        elif args.stdout:
+            restorer.stream(sys.stdout.buffer)
+        else:
+            restorer.restore(args.output)
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile, tarfile.TarError) as e:
+        logger.error(f"Unable to restore from {args.backup_path}: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+import os
+import sys
+import time
+import json
+import inspect
+import logging
+import argparse
+import threading
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from backup_config import BackupConfig
+from local_backup_manager import LocalBackupManager
+from throttle import lower_priority
+from parallel_compression import check_level
+
+logger = logging.getLogger()
+
+# BackupConfig arguments a job can set, with their defaults
+CONFIG_PARAMETERS = {
+    name: param.default
+    for name, param in inspect.signature(BackupConfig.__init__).parameters.items() if name != "self"
+}
+# positional arguments that aren't required in the job file
+CONFIG_DEFAULTS = {"selected_file": "", "backup_name": "", "compress_backup": "0", "cloud_providers": None}
+# arguments BackupConfig expects as strings
+STRING_PARAMETERS = {"source_path", "destination_path"} | {
+    name for name, default in {**CONFIG_PARAMETERS, **CONFIG_DEFAULTS}.items() if isinstance(default, str)
+}
+
+# returns the device a path is on, walking up to the nearest existing parent for paths that don't exist yet
+def device_of(path) -> int:
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return os.stat(path).st_dev
+
+
+'''
+One backup in the job file
+interval - seconds between runs, 0 - only run once
+priority - when several jobs are due, higher priorities start first
+'''
+class BackupJob:
+    def __init__(self, name, config, interval=0, priority=0):
+        self.name = name
+        self.config = config
+        self.interval = interval
+        self.priority = priority
+        self.next_run = time.time()
+        self.runs = 0
+        self.last_result = None
+
+    # every device the job reads from or writes to
+    def devices(self) -> set:
+        return {device_of(self.config.source_path or "."), device_of(self.config.destination_path)}
+
+    @staticmethod
+    def from_dict(entry, defaults):
+        options = dict(CONFIG_DEFAULTS)
+        options.update(defaults)
+        options.update(entry)
+
+        name = options.pop("name", None) or os.path.basename(os.path.normpath(options.get("source_path", "")))
+        interval = options.pop("interval", 0)
+        priority = options.pop("priority", 0)
+
+        unknown = set(options) - set(CONFIG_PARAMETERS)
+        if unknown:
+            raise ValueError(f"Unknown options in job {name}: {', '.join(sorted(unknown))}")
+        # the priority belongs to the process (and every job thread inherits it), so it can't differ between jobs
+        if "low_priority" in options:
+            raise ValueError(f"Job {name} sets low_priority, which can't be set per job: "
+                             "run the scheduler with --low_priority 1 to lower the priority of every job")
+        for required in ("source_path", "destination_path"):
+            if not options.get(required):
+                raise ValueError(f"Job {name} is missing {required}")
+
+        # flags are strings in BackupConfig ("0"/"1"), accept numbers for them in the job file too
+        for key, value in options.items():
+            if key in STRING_PARAMETERS and not isinstance(value, str):
+                options[key] = str(value)
+        if isinstance(options["cloud_providers"], str):
+            options["cloud_providers"] = [options["cloud_providers"]]
+
+        config = BackupConfig(**options)
+        if config.writes_zip():
+            try:
+                check_level(config.codec, config.compress_level)
+            except ValueError as e:
+                raise ValueError(f"Job {name}: {e}")
+        return BackupJob(name, config, interval, priority)
+
+
+'''
+Job file (JSON):
+{
+    "max_concurrent_jobs": 4,
+    "device_limits": {"default": 1, "/mnt/nas": 2},
+    "defaults": {"compress_backup": "1"},
+    "jobs": [
+        {"name": "documents", "source_path": "...", "destination_path": "...", "interval": 3600, "priority": 10},
+        ...
+    ]
+}
+device_limits - number of jobs allowed to use the device a path is on at the same time ("default" for every other device)
+defaults - BackupConfig options applied to every job, each job can override them
+returns (jobs, max_concurrent_jobs, device_limits)
+'''
+def load_job_file(path) -> tuple:
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    defaults = data.get("defaults", {})
+    jobs = [BackupJob.from_dict(entry, defaults) for entry in data.get("jobs", [])]
+    names = [job.name for job in jobs]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        raise ValueError(f"Job names must be unique: {', '.join(sorted(duplicates))}")
+
+    return (jobs, data.get("max_concurrent_jobs", 4), data.get("device_limits", {}))
+
+
+'''
+Runs many backup jobs in one process
+- at most max_concurrent_jobs run at the same time, and at most the device limit on any single device
+  (a job counts against both its source and destination device), so jobs on different disks run side by side
+  while jobs on the same disk queue up instead of fighting over it
+- due jobs start in priority order, a job that can't start because its disk is busy doesn't hold up jobs on other disks
+- ZIP compression uses one thread pool shared by every job, and copy strategies that don't work for a pair of
+  devices are shared too; cloud credentials are cached for the whole process by the cloud modules
+'''
+class JobScheduler:
+    def __init__(self, jobs, max_concurrent_jobs=4, device_limits=None, compress_workers=None):
+        self.jobs = jobs
+        self.max_concurrent_jobs = max(1, max_concurrent_jobs)
+        device_limits = dict(device_limits or {})
+        self.default_device_limit = max(1, device_limits.pop("default", 1))
+        self.device_limits = {device_of(path): max(1, limit) for path, limit in device_limits.items()}
+
+        self.job_pool = ThreadPoolExecutor(max_workers=self.max_concurrent_jobs, thread_name_prefix="job")
+        self.compress_pool = ThreadPoolExecutor(max_workers=max(1, compress_workers or os.cpu_count() or 1),
+                                                thread_name_prefix="compress")
+        self.copy_failures = set()
+
+        self.running = {} # job -> devices it holds
+        self.device_counts = Counter()
+        self.condition = threading.Condition()
+        self.stopped = False
+
+    def device_limit(self, device) -> int:
+        return self.device_limits.get(device, self.default_device_limit)
+
+    # signs into the cloud services used by any job up-front, so every job reuses the same credentials
+    def authorise_cloud(self):
+        if any(job.config.cloud_providers and "google_drive" in job.config.cloud_providers for job in self.jobs):
+            import google_drive_manager
+            google_drive_manager.authorise()
+
+    '''
+    runs jobs until stop() is called
+    once - run every job a single time (still respecting the limits) and return
+    '''
+    def run(self, once=False):
+        self.authorise_cloud()
+        logger.info(f"Scheduler started with {len(self.jobs)} jobs, up to {self.max_concurrent_jobs} at a time")
+        try:
+            with self.condition:
+                while not self.stopped:
+                    self.start_due_jobs(once)
+                    if not self.running and not self.has_jobs_left(once):
+                        if not once:
+                            logger.info("Every job has run and none of them has an interval, nothing left to schedule")
+                        break
+                    self.condition.wait(self.seconds_until_next_job(once))
+        except KeyboardInterrupt:
+            logger.info("Terminating, waiting for running jobs to finish...")
+        finally:
+            self.job_pool.shutdown(wait=True)
+            self.compress_pool.shutdown(wait=True)
+        logger.info("Scheduler stopped")
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    # whether any job will run again (jobs without an interval only run once)
+    def has_jobs_left(self, once) -> bool:
+        return any(job.next_run != float("inf") and not (once and job.runs > 0) for job in self.jobs)
+
+    # seconds until the next idle job is due, None to wait for a running job to finish
+    # (due jobs blocked by a busy device are started when a running job finishes and frees it)
+    def seconds_until_next_job(self, once) -> float:
+        now = time.time()
+        waiting = [job.next_run for job in self.jobs
+                   if job not in self.running and job.next_run > now and not (once and job.runs > 0)]
+        if not waiting:
+            return None
+        return min(min(waiting) - now, 60)
+
+    # must be called with the condition held
+    def start_due_jobs(self, once):
+        now = time.time()
+        due = [job for job in self.jobs
+               if job not in self.running and job.next_run <= now and not (once and job.runs > 0)]
+        due.sort(key=lambda job: (-job.priority, job.next_run))
+
+        for job in due:
+            if len(self.running) >= self.max_concurrent_jobs:
+                return
+            try:
+                devices = job.devices()
+            except OSError as e:
+                logger.error(f"Job {job.name} can't start: {e}")
+                self.finish(job, None, now)
+                continue
+            if any(self.device_counts[device] >= self.device_limit(device) for device in devices):
+                continue # its disk is busy, let jobs on other disks go first
+
+            self.running[job] = devices
+            self.device_counts.update(devices)
+            self.job_pool.submit(self.run_job, job)
+
+    def run_job(self, job):
+        threading.current_thread().name = job.name # shows up in every log line of the job
+        started = time.time()
+        logger.info(f"Starting job {job.name}")
+        result = None
+        try:
+            manager = LocalBackupManager(job.config, configure_logging=False,
+                                         compress_pool=self.compress_pool, copy_failures=self.copy_failures)
+            result = manager.perform_backup()
+        except Exception as e:
+            logger.error(f"Job {job.name} failed: {e}")
+        finally:
+            logger.info(f"Job {job.name} {'finished' if result is not None else 'FAILED'} in {time.time() - started:.1f}s")
+            with self.condition:
+                self.device_counts.subtract(self.running.pop(job))
+                self.finish(job, result, started)
+                self.condition.notify_all()
+
+    def finish(self, job, result, started):
+        job.runs += 1
+        job.last_result = result
+        job.next_run = started + job.interval if job.interval > 0 else float("inf")
+
+
+def get_cmd_parser():
+    parser = argparse.ArgumentParser(
+        prog="File Backup Script Scheduler",
+        description="Runs every backup in a job file from a single process, with per-device concurrency limits, priorities and intervals")
+    parser.add_argument("job_file",
+        help="Path of the JSON job file.")
+    parser.add_argument("--once",
+        help="Runs every job a single time and exits, instead of running them on their intervals.",
+        action="store_true")
+    parser.add_argument("--compress_workers",
+        help="Sets the number of threads compressing ZIP members, shared by every job. Default: one per CPU core.",
+        type=int,
+        default=None)
+    parser.add_argument("--verbose",
+        help="Sets a flag to log every file that is copied/compressed. 0 - ONLY LOG PROGRESS, 1 - LOG EVERY FILE. Default value will be 0.",
+        default="0")
+    parser.add_argument("--low_priority",
+        help="Sets a flag to run every job with low CPU and I/O priority (the I/O priority requires the psutil package). 0 - NORMAL PRIORITY, 1 - LOW PRIORITY. Default value will be 0.",
+        default="0")
+    parser.add_argument("--log_file",
+        help="Also writes the log to this file.",
+        default=None)
+    return parser
+
+def main():
+    args = get_cmd_parser().parse_args()
+
+    handlers = [logging.StreamHandler()]
+    if args.log_file:
+        handlers.append(logging.FileHandler(args.log_file))
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose == "1" else logging.INFO,
+        format="[%(levelname)s] [%(threadName)s] %(message)s",
+        handlers=handlers
+    )
+
+    try:
+        (jobs, max_concurrent_jobs, device_limits) = load_job_file(args.job_file)
+        scheduler = JobScheduler(jobs, max_concurrent_jobs, device_limits, args.compress_workers)
+    except (OSError, ValueError, TypeError) as e:
+        logger.error(f"Unable to load the job file {args.job_file}: {e}")
+        sys.exit(2)
+
+    # before the pools start any threads, they inherit the priority
+    if args.low_priority == "1":
+        lower_priority()
+    scheduler.run(args.once)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import os
+import logging
+import tarfile
+import zipfile
+
+from parallel_compression import ParallelZipWriter
+from tree_walker import TreeWalker
+from backup_manifest import BackupManifest
+from throttle import ThrottledReader
+
+# zstandard is optional, tar.zst archives are only available when it's installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger()
+
+# archive formats that can be written straight from the source
+# maps each format to the tarfile stream mode (None for ZIP)
+ARCHIVE_FORMATS = {
+    "zip": None,
+    "tar": "w|",
+    "tar.gz": "w|gz",
+    "tar.bz2": "w|bz2",
+    "tar.xz": "w|xz"
+}
+if zstandard is not None:
+    ARCHIVE_FORMATS["tar.zst"] = "w|" # the zstd layer is added around the plain tar stream
+
+# returns the name of the archive for a backup at output_path
+# if it's a file, then strip away the file's extension from the archive's name (same as compress_backup)
+def archive_name(output_path, archive_format, is_file) -> str:
+    if is_file:
+        output_path = os.path.splitext(output_path)[0]
+    return f"{output_path}.{archive_format}"
+
+'''
+reads the source once and writes it straight into an archive, without making a copy first
+source - file or directory to archive
+archive_path - path of the archive to create
+arc_root - name the file/directory is stored under inside the archive
+codec/level/workers - ZIP codec, compression level and number of compression threads
+(tar.zst uses level and workers, the other tar formats use their default settings)
+hash_manifest - (optional, ZIP only) HashManifest the hash of every member is added to as it's compressed
+pool - (optional, ZIP only) thread pool shared with other archives, used instead of workers
+rules - (optional) WalkRules deciding which files of a directory source are archived
+throttle - (optional) TokenBucket limiting the bytes read per second from the source
+records - (optional) dict filled with the stat record of every file of a directory source (relative path -> record),
+          taken from the walk that archives it, so the catalog doesn't have to scan the source again
+The archive is written to <archive_path>.part and renamed once complete, so an interrupted run
+never leaves something that looks like a finished backup.
+returns the number of entries written
+'''
+def write_archive(source, archive_path, arc_root, archive_format="zip", codec="deflate", level=None, workers=None,
+                  hash_manifest=None, pool=None, rules=None, throttle=None, records=None):
+    part_path = f"{archive_path}.part"
+    try:
+        with open(part_path, "wb") as f:
+            count = write_archive_to(f, source, arc_root, archive_format, codec, level, workers, hash_manifest, pool, rules,
+                                     throttle, records)
+        os.replace(part_path, archive_path)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+
+    logger.info(f"Streamed {count} entries into archive: {archive_path}")
+    return count
+
+# same as write_archive(), but writes into an already open file object, which doesn't need to be seekable
+# returns the number of entries written
+def write_archive_to(fileobj, source, arc_root, archive_format="zip", codec="deflate", level=None, workers=None,
+                     hash_manifest=None, pool=None, rules=None, throttle=None, records=None) -> int:
+    if archive_format not in ARCHIVE_FORMATS:
+        raise ValueError(f"Unsupported archive format: {archive_format}")
+
+    if archive_format == "zip":
+        return write_zip(source, fileobj, arc_root, codec, level, workers, hash_manifest, pool, rules, throttle, records)
+    if archive_format == "tar.zst":
+        return write_tar_zst(source, fileobj, arc_root, level, workers, rules, throttle, records)
+    return write_tar_stream(source, fileobj, arc_root, ARCHIVE_FORMATS[archive_format], rules, throttle, records)
+
+# yields (path, arcname, is_dir) for everything that goes into the archive, walking the tree lazily
+# directories are only yielded when empty, the same as compress_backup
+# records - (optional) dict the stat record of every file of a directory source is added to
+def iter_entries(source, arc_root, rules=None, records=None):
+    if not os.path.isdir(source):
+        yield (source, arc_root, False)
+        return
+
+    walker = TreeWalker(source, rules)
+    for (rel_root, root, dirs, files) in walker.walk():
+        arc_dir = os.path.join(arc_root, rel_root) if rel_root else arc_root
+        for (f, st) in files:
+            if records is not None:
+                records[os.path.join(rel_root, f) if rel_root else f] = BackupManifest.make_record(st)
+            yield (os.path.join(root, f), os.path.join(arc_dir, f), False)
+        if not files and not dirs:
+            yield (root, arc_dir, True)
+    walker.log_excluded()
+    walker.check_errors()
+
+def write_zip(source, fileobj, arc_root, codec="deflate", level=None, workers=None, hash_manifest=None, pool=None,
+              rules=None, throttle=None, records=None) -> int:
+    count = 0
+    hash_algorithm = hash_manifest.algorithm if hash_manifest else None
+    # members are compressed in blocks into bounded spools, so memory use doesn't depend on file size
+    with zipfile.ZipFile(fileobj, "w") as zip_file:
+        with ParallelZipWriter(zip_file, codec, level, workers, hash_algorithm, pool, throttle) as writer:
+            for (path, arcname, is_dir) in iter_entries(source, arc_root, rules, records):
+                if is_dir:
+                    writer.add_dir(arcname)
+                else:
+                    writer.add_file(path, arcname)
+                count += 1
+        if hash_manifest:
+            hash_manifest.files.update(writer.hashes)
+    return count
+
+# zstd compresses on several threads by itself (workers=None uses every core)
+def write_tar_zst(source, fileobj, arc_root, level=None, workers=None, rules=None, throttle=None, records=None) -> int:
+    compressor = zstandard.ZstdCompressor(level=level if level is not None else 3, threads=workers or -1)
+    with compressor.stream_writer(fileobj, closefd=False) as zst:
+        return write_tar_stream(source, zst, arc_root, "w|", rules, throttle, records)
+
+def write_tar_stream(source, fileobj, arc_root, mode, rules=None, throttle=None, records=None) -> int:
+    count = 0
+    # dereference - symlinked files are stored as the files they point at, the same as a copy or a ZIP
+    with tarfile.open(fileobj=fileobj, mode=mode, dereference=True) as tar:
+        for (path, arcname, is_dir) in iter_entries(source, arc_root, rules, records):
+            if throttle and not is_dir:
+                # same as tar.add(), with the file's contents read through the throttle
+                tarinfo = tar.gettarinfo(path, arcname)
+                if tarinfo.isreg():
+                    with open(path, "rb") as f:
+                        tar.addfile(tarinfo, ThrottledReader(f, throttle))
+                else:
+                    tar.addfile(tarinfo)
+            else:
+                tar.add(path, arcname, recursive=False)
+            count += 1
+            # tarfile remembers every member it has written, drop them so memory stays flat
+            # regardless of how many files are archived (hard links are stored as regular files)
+            tar.members.clear()
+            tar.inodes.clear()
+    return count
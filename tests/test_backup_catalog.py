@@ -0,0 +1,85 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+# the tests import the backup script's modules from the repository root
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from backup_catalog import BackupCatalog
+from backup_config import BackupConfig
+from backup_manifest import BackupManifest
+from local_backup_manager import LocalBackupManager
+
+FILES = {
+    "a.txt": b"a" * 100,
+    os.path.join("docs", "b.txt"): b"b" * 2000,
+    os.path.join("docs", "deep", "c.bin"): os.urandom(5000)
+}
+
+
+'''
+The files the catalog records for each kind of backup, taken from the walk that wrote the backup
+instead of a second scan of the source
+'''
+class BackupCatalogTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.temp_dir, "data")
+        self.destination = os.path.join(self.temp_dir, "backups")
+        for (rel_path, data) in FILES.items():
+            path = os.path.join(self.source, rel_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def expected_files(self) -> dict:
+        files = {}
+        for rel_path in FILES:
+            st = os.stat(os.path.join(self.source, rel_path))
+            files[rel_path.replace(os.sep, "/")] = (st.st_size, st.st_mtime_ns)
+        return files
+
+    def catalog_files(self, name) -> dict:
+        with BackupCatalog.for_destination(self.destination) as catalog:
+            backup = catalog.get_backup(name)
+            self.assertIsNotNone(backup)
+            return {row["path"]: (row["size"], row["mtime_ns"]) for row in catalog.list_files(backup["id"])}
+
+    def test_records_come_from_the_backup_walk(self):
+        modes = {
+            "copy": {},
+            "parallel-copy": {"copy_workers": 4},
+            "compressed": {"compress_backup": "1"},
+            "journaled-compressed": {"compress_backup": "1", "journal": "1"},
+            "stream-zip": {"compress_backup": "1", "stream_archive": "1"},
+            "stream-tar": {"compress_backup": "1", "stream_archive": "1", "archive_format": "tar.gz"},
+            "volumes": {"compress_backup": "1", "stream_archive": "1", "volume_size": 1}
+        }
+        for (name, options) in modes.items():
+            with self.subTest(mode=name):
+                config = BackupConfig(self.source, self.destination, "", name, options.pop("compress_backup", "0"), [],
+                                      catalog="1", **options)
+                manager = LocalBackupManager(config, configure_logging=False)
+                # any scan of the source besides the backup's own walk fails the test
+                with mock.patch.object(BackupManifest, "scan", side_effect=AssertionError("the source was scanned again")):
+                    self.assertIsNotNone(manager.perform_backup())
+                self.assertEqual(self.catalog_files(name), self.expected_files())
+
+    def test_single_file_source(self):
+        config = BackupConfig(self.source, self.destination, "a.txt", "single", "1", [], stream_archive="1",
+                              catalog="1")
+        self.assertIsNotNone(LocalBackupManager(config, configure_logging=False).perform_backup())
+        st = os.stat(os.path.join(self.source, "a.txt"))
+        self.assertEqual(self.catalog_files("single"), {"a.txt": (st.st_size, st.st_mtime_ns)})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+# the tests import the backup script's modules from the repository root
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from backup_config import BackupConfig
+from backup_journal import BackupJournal, STAGING_SUFFIX
+from hash_manifest import HashManifest, hash_file, manifest_path_for
+from local_backup_manager import LocalBackupManager
+
+BACKUP_NAME = "data-BACKUP"
+
+FILES = {
+    "f1.txt": b"first",
+    "f2.txt": b"second" * 1000,
+    os.path.join("sub", "f3.txt"): b"third",
+    os.path.join("old", "o.txt"): b"old"
+}
+
+
+'''
+Journaled full backups: a copy that fails halfway is resumed by the next run,
+which publishes exactly what the source holds at that point
+'''
+class BackupJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.temp_dir, "data")
+        self.destination = os.path.join(self.temp_dir, "backups")
+        os.makedirs(self.destination)
+        self.write_source()
+        self.output_path = os.path.join(self.destination, BACKUP_NAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_source(self):
+        for (rel_path, data) in FILES.items():
+            path = os.path.join(self.source, rel_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+
+    def manager(self, copy_workers) -> LocalBackupManager:
+        config = BackupConfig(self.source, self.destination, "", BACKUP_NAME, "0", [], copy_workers=copy_workers,
+                              hash_manifest="1", journal="1")
+        return LocalBackupManager(config, configure_logging=False)
+
+    # every file is copied and journaled, then the run dies while setting the directory metadata
+    def fail_after_files(self, copy_workers):
+        real_copystat = shutil.copystat
+
+        def copystat(src, dst, **kwargs):
+            if os.path.isdir(src):
+                raise OSError("disk went away")
+            return real_copystat(src, dst, **kwargs)
+
+        with mock.patch.object(shutil, "copystat", copystat):
+            self.assertIsNone(self.manager(copy_workers).perform_backup())
+
+    def published_files(self) -> dict:
+        files = {}
+        for root, dirs, names in os.walk(self.output_path):
+            for name in names:
+                path = os.path.join(root, name)
+                with open(path, "rb") as f:
+                    files[os.path.relpath(path, self.output_path)] = f.read()
+        return files
+
+    def test_resume_drops_files_deleted_from_the_source(self):
+        for copy_workers in (1, 4):
+            with self.subTest(copy_workers=copy_workers):
+                self.fail_after_files(copy_workers)
+                journal = BackupJournal.find(self.destination, self.source)
+                self.assertEqual(set(journal.done), set(FILES))
+                self.assertTrue(os.path.isdir(self.output_path + STAGING_SUFFIX))
+
+                os.remove(os.path.join(self.source, "f1.txt"))
+                shutil.rmtree(os.path.join(self.source, "old"))
+                expected = {rel_path: data for (rel_path, data) in FILES.items()
+                            if rel_path != "f1.txt" and not rel_path.startswith("old")}
+
+                manager = self.manager(copy_workers)
+                self.assertEqual(manager.output_backup_name, BACKUP_NAME)
+                with mock.patch.object(manager.copier, "copy2", wraps=manager.copier.copy2) as copy2:
+                    self.assertEqual(manager.perform_backup(), self.output_path)
+                self.assertEqual(copy2.call_count, 0) # the files still in the source were already copied
+
+                self.assertEqual(self.published_files(), expected)
+                self.assertFalse(os.path.exists(os.path.join(self.output_path, "old")))
+                self.assertFalse(os.path.exists(self.output_path + STAGING_SUFFIX))
+                self.assertIsNone(BackupJournal.find(self.destination, self.source))
+
+                hashes = HashManifest(manifest_path_for(self.output_path)).load()
+                self.assertEqual(hashes.files, {rel_path.replace(os.sep, "/"): hash_file(os.path.join(self.output_path, rel_path), hashes.algorithm)
+                                                for rel_path in expected})
+                self.assertEqual(set(manager.file_records), set(expected))
+
+                shutil.rmtree(self.output_path)
+                os.remove(manifest_path_for(self.output_path))
+                self.write_source() # puts the deleted files back for the next run
+
+    # a file changed since it was journaled is copied again, the rest are skipped
+    def test_resume_copies_only_changed_files(self):
+        self.fail_after_files(1)
+        changed = os.path.join(self.source, "sub", "f3.txt")
+        with open(changed, "wb") as f:
+            f.write(b"third, changed")
+        os.utime(changed, ns=(0, 10 ** 18))
+
+        manager = self.manager(1)
+        with mock.patch.object(manager.copier, "copy2", wraps=manager.copier.copy2) as copy2:
+            self.assertEqual(manager.perform_backup(), self.output_path)
+        self.assertEqual([call.args[0] for call in copy2.call_args_list], [changed])
+        self.assertEqual(self.published_files()[os.path.join("sub", "f3.txt")], b"third, changed")
+        self.assertEqual(len(self.published_files()), len(FILES))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,179 @@
+import os
+import sys
+import random
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+# the tests import the backup script's modules from the repository root
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import chunk_store
+
+from backup_config import BackupConfig
+from chunk_store import ChunkStore
+from local_backup_manager import LocalBackupManager, DEDUP_STORE_NAME
+
+# small chunks, so the tests run on small files
+MIN_SIZE = 2 * 1024
+AVG_SIZE = 8 * 1024
+MAX_SIZE = 32 * 1024
+
+
+'''
+Content-defined chunking in the deduplicated store
+'''
+class ChunkingTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.rng = random.Random(1234)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def store(self, min_size=MIN_SIZE, avg_size=AVG_SIZE, max_size=MAX_SIZE) -> ChunkStore:
+        return ChunkStore(os.path.join(self.temp_dir, "store"), min_size=min_size, avg_size=avg_size, max_size=max_size)
+
+    def cuts(self, store, data) -> list:
+        cuts = []
+        offset = 0
+        while offset < len(data):
+            offset += store.find_cut(data[offset:offset + store.max_size])
+            cuts.append(offset)
+        return cuts
+
+    # boundaries have to stay where they were, or nothing stored before would be deduplicated again
+    @unittest.skipIf(chunk_store.numpy is None, "numpy isn't installed")
+    def test_numpy_cut_points_match_the_loop(self):
+        random_data = self.rng.randbytes(300 * 1024)
+        text = b"".join(b"line %d of a log file\n" % self.rng.randrange(1000) for _ in range(15000))
+        sizes = [
+            (MIN_SIZE, AVG_SIZE, MAX_SIZE),
+            (64, 256, 1024), # windows shorter than the first scan
+            (1024, 2 ** 16, 2 ** 18), # a single cut, near the far end
+            (MIN_SIZE, AVG_SIZE, MIN_SIZE + 40) # the window reaches the end of the range
+        ]
+        for (min_size, avg_size, max_size) in sizes:
+            store = self.store(min_size, avg_size, max_size)
+            for (name, data) in (("random", random_data), ("text", text), ("zeros", bytes(100 * 1024))):
+                with self.subTest(sizes=(min_size, avg_size, max_size), data=name):
+                    vectorized = self.cuts(store, data)
+                    with mock.patch.object(chunk_store, "numpy", None):
+                        self.assertEqual(vectorized, self.cuts(store, data))
+
+    def test_chunks_stay_within_limits(self):
+        store = self.store()
+        data = self.rng.randbytes(500 * 1024)
+        cuts = self.cuts(store, data)
+        sizes = [b - a for (a, b) in zip([0] + cuts, cuts)]
+        self.assertTrue(all(MIN_SIZE < size <= MAX_SIZE for size in sizes[:-1]))
+        self.assertEqual(cuts[-1], len(data))
+
+    # an insertion at the start of a file only changes the chunks around it
+    def test_insertion_only_changes_nearby_chunks(self):
+        store = self.store()
+        data = self.rng.randbytes(500 * 1024)
+        path = os.path.join(self.temp_dir, "file.bin")
+        with open(path, "wb") as f:
+            f.write(data)
+        before = store.store_file(path)
+        with open(path, "wb") as f:
+            f.write(b"inserted" + data)
+        after = store.store_file(path)
+
+        self.assertGreater(len(before), 10)
+        self.assertLessEqual(len(set(after) - set(before)), 2)
+        self.assertEqual(b"".join(store.get_chunk(h) for h in after), b"inserted" + data)
+
+
+'''
+Dedup backups through LocalBackupManager: snapshots share chunks, unchanged files are
+taken from the last snapshot of the same source, and snapshots restore to the original tree
+'''
+class DedupBackupTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.destination = os.path.join(self.temp_dir, "backups")
+        self.rng = random.Random(5678)
+        self.sources = {}
+        for name in ("first", "second"):
+            source = os.path.join(self.temp_dir, name)
+            os.makedirs(os.path.join(source, "docs"))
+            self.write(source, "a.txt", b"a" * 100)
+            self.write(source, os.path.join("docs", "big.bin"), self.rng.randbytes(600 * 1024))
+            self.sources[name] = source
+        self.store_path = os.path.join(self.destination, DEDUP_STORE_NAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    @staticmethod
+    def write(source, rel_path, data):
+        with open(os.path.join(source, rel_path), "wb") as f:
+            f.write(data)
+
+    def backup(self, source_name, name) -> LocalBackupManager:
+        config = BackupConfig(self.sources[source_name], self.destination, "", name, "0", [], backup_mode="dedup")
+        manager = LocalBackupManager(config, configure_logging=False)
+        self.assertEqual(str(manager.perform_backup()), os.path.join(self.store_path, "snapshots", f"{name}.json"))
+        return manager
+
+    def test_snapshots_share_chunks(self):
+        self.backup("first", "first-1")
+        chunks = set(self.chunk_files())
+
+        # unchanged: every file comes from the previous snapshot without being read
+        with mock.patch.object(ChunkStore, "store_file", side_effect=AssertionError("an unchanged file was read")):
+            manager = self.backup("first", "first-2")
+        self.assertEqual(manager.metrics.stages["dedup"]["bytes"], 0)
+        self.assertEqual(set(self.chunk_files()), chunks)
+
+        # the same contents in another source are stored once, only the different big.bin adds chunks
+        self.backup("second", "second-1")
+        files = self.snapshot_files("second-1")
+        self.assertEqual(files["a.txt"]["chunks"], self.snapshot_files("first-1")["a.txt"]["chunks"])
+        self.assertEqual(set(self.chunk_files()) - chunks, set(files[os.path.join("docs", "big.bin")]["chunks"]))
+
+    # the newest snapshot in the shared store is of another source, the parent has to be the same source's
+    def test_parent_is_the_last_snapshot_of_the_same_source(self):
+        self.backup("first", "first-1")
+        self.backup("second", "second-1")
+        store = ChunkStore(self.store_path)
+        with mock.patch.object(ChunkStore, "store_file", side_effect=AssertionError("an unchanged file was read")):
+            store.create_snapshot(self.sources["first"], "first-2")
+        self.assertEqual(store.reused_files, 2)
+
+        self.assertEqual(store.latest_snapshot_of(self.sources["second"])["source"], os.path.abspath(self.sources["second"]))
+        self.assertEqual(store.latest_snapshot_of(os.path.join(self.temp_dir, "unknown")), {})
+
+    def test_restore_snapshot(self):
+        source = self.sources["first"]
+        os.makedirs(os.path.join(source, "empty"))
+        os.utime(os.path.join(source, "a.txt"), ns=(10 ** 18, 10 ** 18))
+        os.chmod(os.path.join(source, "a.txt"), 0o640)
+        self.backup("first", "first-1")
+
+        output = os.path.join(self.temp_dir, "restored")
+        ChunkStore(self.store_path).restore_snapshot("first-1", output)
+        for rel_path in ("a.txt", os.path.join("docs", "big.bin")):
+            with open(os.path.join(source, rel_path), "rb") as f, open(os.path.join(output, rel_path), "rb") as restored:
+                self.assertEqual(restored.read(), f.read())
+        st = os.stat(os.path.join(output, "a.txt"))
+        self.assertEqual(st.st_mtime_ns, 10 ** 18)
+        self.assertEqual(st.st_mode & 0o777, 0o640)
+        self.assertTrue(os.path.isdir(os.path.join(output, "empty")))
+
+        self.assertEqual(ChunkStore(self.store_path).load_snapshot("first-1")["source"], os.path.abspath(source))
+
+    def snapshot_files(self, name) -> dict:
+        return ChunkStore(self.store_path).load_snapshot(name)["files"]
+
+    def chunk_files(self) -> list:
+        return [name for root, dirs, names in os.walk(os.path.join(self.store_path, "chunks")) for name in names]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+# the tests import the backup script's modules from the repository root, and the fake endpoint from the benchmarks
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, "benchmarks"))
+
+import requests
+import google_drive_manager
+
+from google_drive_manager import DriveUploader, DriveUploadError, CHUNK_ALIGNMENT, MAX_RETRIES
+from fake_drive import FakeDriveServer
+
+CHUNK_SIZE = CHUNK_ALIGNMENT
+FILE_SIZE = CHUNK_SIZE * 5 + 1000 # the last chunk is a partial one
+
+
+# raised by DyingSession, stands in for the process being killed in the middle of an upload
+class Killed(Exception):
+    pass
+
+
+# HTTP session that dies after sending a number of chunks, or runs a callback once they're sent
+class DyingSession(requests.Session):
+    def __init__(self, chunks, on_limit=None):
+        super().__init__()
+        self.chunks = chunks
+        self.on_limit = on_limit
+
+    def put(self, url, data=None, **kwargs):
+        if data:
+            if self.chunks == 0:
+                if self.on_limit is None:
+                    raise Killed()
+                self.on_limit()
+                self.on_limit = None
+            self.chunks -= 1
+        return super().put(url, data=data, **kwargs)
+
+
+'''
+DriveUploader against the local fake Drive endpoint: resuming interrupted uploads,
+starting over when the session has expired, and retrying after server errors
+'''
+class DriveUploaderTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeDriveServer(keep_data=True).start()
+        self.temp_dir = tempfile.mkdtemp()
+        self.sessions_file = os.path.join(self.temp_dir, "sessions.json")
+        self.path = os.path.join(self.temp_dir, "backup.zip")
+        self.data = os.urandom(FILE_SIZE)
+        with open(self.path, "wb") as f:
+            f.write(self.data)
+
+        # retries back off for seconds, there's no need to wait on a local endpoint
+        patcher = mock.patch.object(google_drive_manager.time, "sleep")
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.fake.stop()
+        shutil.rmtree(self.temp_dir)
+
+    def uploader(self, session_factory=requests.Session) -> DriveUploader:
+        return DriveUploader(None, chunk_size=CHUNK_SIZE, workers=1, sessions_file=self.sessions_file,
+                             upload_url=self.fake.upload_url, session_factory=session_factory)
+
+    def saved_sessions(self) -> dict:
+        with open(self.sessions_file, "r") as f:
+            return json.load(f)
+
+    def assert_uploaded(self, result):
+        self.assertEqual(result["name"], "backup.zip")
+        self.assertEqual(self.fake.files["backup.zip"], self.data)
+        self.assertNotIn(os.path.abspath(self.path), self.saved_sessions())
+
+    # killed after 2 chunks, the next run continues from the bytes Drive has without sending them again
+    def test_resumes_interrupted_upload(self):
+        with self.assertRaises(Killed):
+            self.uploader(lambda: DyingSession(2)).upload(self.path)
+        self.assertIn(os.path.abspath(self.path), self.saved_sessions())
+        self.assertEqual(self.fake.bytes_received, 2 * CHUNK_SIZE)
+
+        result = self.uploader().upload(self.path)
+        self.assert_uploaded(result)
+        self.assertEqual(self.fake.sessions_started, 1)
+        self.assertEqual(self.fake.bytes_received, FILE_SIZE)
+
+    # the saved session expired while the upload was interrupted, so it starts over from the first byte
+    def test_restarts_upload_when_saved_session_expired(self):
+        for status in (404, 410):
+            with self.subTest(status=status):
+                self.fake.files.clear()
+                with self.assertRaises(Killed):
+                    self.uploader(lambda: DyingSession(2)).upload(self.path)
+                self.fake.expire_sessions(status)
+                started = self.fake.sessions_started
+
+                result = self.uploader().upload(self.path)
+                self.assert_uploaded(result)
+                self.assertEqual(self.fake.sessions_started, started + 1)
+
+    # the session expires between two chunks of a running upload
+    def test_restarts_upload_when_session_expires_mid_upload(self):
+        for status in (404, 410):
+            with self.subTest(status=status):
+                self.fake.files.clear()
+                started = self.fake.sessions_started
+                result = self.uploader(lambda: DyingSession(2, lambda: self.fake.expire_sessions(status))).upload(self.path)
+                self.assert_uploaded(result)
+                self.assertEqual(self.fake.sessions_started, started + 2)
+
+    # 5xx answers are retried, asking Drive where to continue from each time
+    def test_retries_after_server_error(self):
+        self.fake.fail_next(503)
+        self.fake.fail_next(500)
+
+        result = self.uploader().upload(self.path)
+        self.assert_uploaded(result)
+        self.assertEqual(self.sleep.call_count, 2)
+        self.assertEqual(self.fake.sessions_started, 1)
+        self.assertEqual(self.fake.bytes_received, FILE_SIZE)
+
+    def test_gives_up_after_max_retries(self):
+        self.fake.fail_next(503, MAX_RETRIES + 1)
+
+        with self.assertRaises(DriveUploadError):
+            self.uploader().upload(self.path)
+        self.assertEqual(self.sleep.call_count, MAX_RETRIES)
+        # kept, so the next run can still resume the upload
+        self.assertIn(os.path.abspath(self.path), self.saved_sessions())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+# the tests import the backup script's modules from the repository root
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from backup_config import BackupConfig
+from backup_manifest import BackupManifest
+from hash_manifest import HashManifest, hash_file, manifest_path_for
+from local_backup_manager import LocalBackupManager
+
+BACKUP_NAME = "data-INCREMENTAL"
+
+FILES = {
+    "a.txt": b"a" * 100,
+    os.path.join("docs", "b.txt"): b"b" * 2000,
+    os.path.join("docs", "old", "c.txt"): b"c"
+}
+
+
+'''
+Incremental backups: only new/changed files are copied into the mirror, deleted ones are removed,
+and a watchdog run only looks at the paths it was given
+'''
+class IncrementalBackupTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.temp_dir, "data")
+        self.destination = os.path.join(self.temp_dir, "backups")
+        for (rel_path, data) in FILES.items():
+            self.write(rel_path, data)
+        self.mirror = os.path.join(self.destination, BACKUP_NAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, rel_path, data, mtime_ns=None):
+        path = os.path.join(self.source, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        if mtime_ns is not None:
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+        return path
+
+    # runs a backup, returning the manager and the source files it copied
+    def backup(self, changed_paths=None, **options) -> tuple:
+        config = BackupConfig(self.source, self.destination, "", BACKUP_NAME, "0", [], backup_mode="incremental", **options)
+        manager = LocalBackupManager(config, configure_logging=False)
+        with mock.patch.object(manager.copier, "copy2", wraps=manager.copier.copy2) as copy2:
+            self.assertEqual(manager.perform_backup(changed_paths), self.mirror)
+        copied = {os.path.relpath(call.args[0], self.source) for call in copy2.call_args_list}
+        return (manager, copied)
+
+    def mirrored(self) -> dict:
+        files = {}
+        for root, dirs, names in os.walk(self.mirror):
+            for name in names:
+                path = os.path.join(root, name)
+                with open(path, "rb") as f:
+                    files[os.path.relpath(path, self.mirror)] = f.read()
+        return files
+
+    def manifest(self) -> dict:
+        with open(f"{self.mirror}.manifest.json", "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def test_copies_only_changes_and_removes_deleted_files(self):
+        (manager, copied) = self.backup()
+        self.assertEqual(copied, set(FILES))
+        self.assertEqual(self.mirrored(), FILES)
+
+        (manager, copied) = self.backup()
+        self.assertEqual(copied, set())
+
+        b = os.path.join("docs", "b.txt")
+        self.write(b, b"changed")
+        self.write("new.txt", b"new")
+        shutil.rmtree(os.path.join(self.source, "docs", "old"))
+        (manager, copied) = self.backup()
+        self.assertEqual(copied, {b, "new.txt"})
+        self.assertEqual(self.mirrored(), {"a.txt": FILES["a.txt"], b: b"changed", "new.txt": b"new"})
+        self.assertFalse(os.path.exists(os.path.join(self.mirror, "docs", "old")))
+        self.assertEqual(self.manifest()["last_run"]["deleted"], [os.path.join("docs", "old", "c.txt")])
+        self.assertEqual(set(manager.file_records), {"a.txt", b, "new.txt"})
+
+    # a file that was touched but has the same contents is hashed instead of copied again
+    def test_hash_check_skips_touched_files(self):
+        self.backup(hash_check="1")
+        path = self.write("a.txt", FILES["a.txt"], mtime_ns=10 ** 18)
+        with mock.patch.object(BackupManifest, "hash_file", wraps=BackupManifest.hash_file) as hash_source:
+            (manager, copied) = self.backup(hash_check="1")
+        self.assertEqual(copied, set())
+        self.assertEqual([call.args[0] for call in hash_source.call_args_list], [path])
+        self.assertEqual(self.manifest()["files"]["a.txt"]["mtime_ns"], 10 ** 18)
+
+        # same size, different contents: copied, and the hash diff() computed is the one kept
+        self.write("a.txt", b"z" * 100)
+        with mock.patch.object(BackupManifest, "hash_file", wraps=BackupManifest.hash_file) as hash_source:
+            (manager, copied) = self.backup(hash_check="1")
+        self.assertEqual(copied, {"a.txt"})
+        self.assertEqual(hash_source.call_count, 1)
+        self.assertEqual(self.manifest()["files"]["a.txt"]["hash"], BackupManifest.hash_file(path))
+
+    def test_hash_manifest_follows_the_mirror(self):
+        self.backup(hash_manifest="1")
+        self.write("new.txt", b"new")
+        os.remove(os.path.join(self.source, "a.txt"))
+        self.backup(hash_manifest="1")
+
+        hashes = HashManifest(manifest_path_for(self.mirror)).load()
+        expected = {rel_path: hash_file(os.path.join(self.mirror, rel_path), hashes.algorithm) for rel_path in self.mirrored()}
+        self.assertEqual(hashes.files, {rel_path.replace(os.sep, "/"): digest for (rel_path, digest) in expected.items()})
+
+    # a watchdog run only rescans the paths that changed, anything else is taken from the manifest
+    def test_changed_paths_are_rescanned(self):
+        self.backup()
+        self.write("a.txt", b"changed")
+        self.write(os.path.join("docs", "b.txt"), b"also changed, but not reported")
+        self.write(os.path.join("added", "d.txt"), b"d")
+        changed_paths = [os.path.join(self.source, "a.txt"), os.path.join(self.source, "added")]
+
+        with mock.patch.object(BackupManifest, "scan", wraps=BackupManifest.scan) as scan:
+            (manager, copied) = self.backup(changed_paths)
+        self.assertEqual(copied, {"a.txt", os.path.join("added", "d.txt")})
+        # only the new directory was walked
+        self.assertEqual([call.args[2] for call in scan.call_args_list], ["added"])
+        self.assertEqual(self.mirrored()[os.path.join("docs", "b.txt")], FILES[os.path.join("docs", "b.txt")])
+
+        # a full run picks up what the watchdog missed
+        (manager, copied) = self.backup()
+        self.assertEqual(copied, {os.path.join("docs", "b.txt")})
+
+    def test_mirror_removed_copies_everything_again(self):
+        self.backup()
+        shutil.rmtree(self.mirror)
+        (manager, copied) = self.backup()
+        self.assertEqual(copied, set(FILES))
+        self.assertEqual(self.mirrored(), FILES)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+# the tests import the backup script's modules from the repository root
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from backup_config import BackupConfig
+from local_backup_manager import LocalBackupManager
+from restore import BackupRestorer
+
+BACKUP_NAME = "data-BACKUP"
+
+FILES = {
+    "a.txt": b"a" * 100,
+    os.path.join("docs", "b.txt"): b"b" * 2000,
+    os.path.join("docs", "deep", "c.bin"): os.urandom(70000)
+}
+MTIME_NS = 1_600_000_000 * 10 ** 9
+
+
+'''
+BackupRestorer on every kind of backup main.py writes: selective restores, restoring
+everything, and streaming a single file
+'''
+class BackupRestorerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = tempfile.mkdtemp()
+        cls.source = os.path.join(cls.temp_dir, "data")
+        cls.destination = os.path.join(cls.temp_dir, "backups")
+        for (rel_path, data) in FILES.items():
+            path = os.path.join(cls.source, rel_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+            os.utime(path, ns=(MTIME_NS, MTIME_NS))
+        os.makedirs(os.path.join(cls.source, "empty"))
+
+        cls.backups = {}
+        modes = {
+            "dir": {},
+            "zip": {"compress_backup": "1"},
+            "tar": {"compress_backup": "1", "stream_archive": "1", "archive_format": "tar.gz"},
+            "snapshot": {"backup_mode": "dedup"}
+        }
+        for (kind, options) in modes.items():
+            config = BackupConfig(cls.source, cls.destination, "", f"{BACKUP_NAME}-{kind}", options.pop("compress_backup", "0"), [],
+                                  **options)
+            manager = LocalBackupManager(config, configure_logging=False)
+            if manager.perform_backup() is None:
+                raise RuntimeError(f"Unable to make the {kind} backup")
+            cls.backups[kind] = manager.output_path
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.temp_dir)
+
+    def setUp(self):
+        self.output = tempfile.mkdtemp(dir=self.temp_dir)
+
+    def restored(self, kind) -> dict:
+        root = os.path.join(self.output, f"{BACKUP_NAME}-{kind}")
+        files = {}
+        for dir_path, dirs, names in os.walk(root):
+            for name in names:
+                path = os.path.join(dir_path, name)
+                with open(path, "rb") as f:
+                    files[os.path.relpath(path, root)] = f.read()
+        return files
+
+    def test_restores_everything(self):
+        for (kind, backup_path) in self.backups.items():
+            with self.subTest(kind=kind):
+                restorer = BackupRestorer(backup_path, workers=4)
+                self.assertEqual(restorer.kind, kind)
+                self.assertEqual(restorer.restore(self.output), len(FILES))
+                self.assertEqual(self.restored(kind), FILES)
+                restored = os.path.join(self.output, f"{BACKUP_NAME}-{kind}", "docs", "b.txt")
+                self.assertEqual(os.stat(restored).st_mtime_ns // 10 ** 9, MTIME_NS // 10 ** 9)
+                shutil.rmtree(self.output)
+
+    def test_restores_selected_directory(self):
+        for (kind, backup_path) in self.backups.items():
+            with self.subTest(kind=kind):
+                self.assertEqual(BackupRestorer(backup_path, ["docs/deep"]).restore(self.output), 1)
+                self.assertEqual(self.restored(kind), {os.path.join("docs", "deep", "c.bin"): FILES[os.path.join("docs", "deep", "c.bin")]})
+                shutil.rmtree(self.output)
+
+    def test_streams_single_file(self):
+        for (kind, backup_path) in self.backups.items():
+            with self.subTest(kind=kind):
+                out = io.BytesIO()
+                BackupRestorer(backup_path, ["docs/deep/*.bin"]).stream(out)
+                self.assertEqual(out.getvalue(), FILES[os.path.join("docs", "deep", "c.bin")])
+
+    def test_stream_without_a_matching_file(self):
+        # "docs/deep" only matches a directory in a tar, which holds an entry for every directory
+        for (kind, backup_path) in self.backups.items():
+            for pattern in ("missing.txt", "empty"):
+                with self.subTest(kind=kind, pattern=pattern):
+                    with self.assertRaisesRegex(ValueError, "exactly one matching file, 0 matched"):
+                        BackupRestorer(backup_path, [pattern]).stream(io.BytesIO())
+
+    # a compressed tar can't be seeked, so it's only read once to stream a file out of it
+    def test_streams_tar_in_one_pass(self):
+        restorer = BackupRestorer(self.backups["tar"], ["a.txt"])
+        with mock.patch.object(restorer, "open_tar", wraps=restorer.open_tar) as open_tar:
+            out = io.BytesIO()
+            restorer.stream(out)
+        self.assertEqual(open_tar.call_count, 1)
+        self.assertEqual(out.getvalue(), FILES["a.txt"])
+
+
+if __name__ == "__main__":
+    unittest.main()
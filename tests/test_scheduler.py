@@ -0,0 +1,170 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from collections import Counter
+from unittest import mock
+
+# the tests import the backup script's modules from the repository root
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import scheduler
+
+from scheduler import JobScheduler, load_job_file
+
+JOB_SECONDS = 0.1
+
+
+'''
+Stands in for LocalBackupManager, recording how many jobs run at the same time on each (fake) device
+'''
+class Recorder:
+    def __init__(self, devices):
+        self.devices = devices # destination path -> device
+        self.lock = threading.Lock()
+        self.running = Counter()
+        self.most_running = Counter()
+        self.started = []
+
+    def manager(self, config, **kwargs):
+        recorder = self
+
+        class FakeManager:
+            def perform_backup(self):
+                device = recorder.devices[config.destination_path]
+                with recorder.lock:
+                    recorder.started.append(os.path.basename(config.destination_path))
+                    recorder.running[device] += 1
+                    recorder.running["all"] += 1
+                    for key in (device, "all"):
+                        recorder.most_running[key] = max(recorder.most_running[key], recorder.running[key])
+                time.sleep(JOB_SECONDS)
+                with recorder.lock:
+                    recorder.running[device] -= 1
+                    recorder.running["all"] -= 1
+                return config.destination_path
+
+        return FakeManager()
+
+
+'''
+JobScheduler and the job file: per-device limits, priorities, intervals, and validating jobs
+'''
+class JobSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        # every path is on the same disk here, so each job's source and destination are put on a fake device by name
+        self.devices = {}
+        for (name, device) in (("a1", 1), ("a2", 1), ("a3", 1), ("b1", 2), ("b2", 2), ("c1", 3)):
+            os.makedirs(os.path.join(self.temp_dir, f"{name}-source"))
+            self.devices[os.path.join(self.temp_dir, f"{name}-source")] = device
+            self.devices[os.path.join(self.temp_dir, name)] = device
+
+        def device_of(path):
+            return self.devices.get(os.path.abspath(path), 0)
+
+        patcher = mock.patch.object(scheduler, "device_of", device_of)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.recorder = Recorder(self.devices)
+        patcher = mock.patch.object(scheduler, "LocalBackupManager", self.recorder.manager)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def job_file(self, jobs, **data) -> str:
+        path = os.path.join(self.temp_dir, "jobs.json")
+        data["jobs"] = jobs
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        return path
+
+    def job(self, destination, **options) -> dict:
+        return {"name": destination, "source_path": os.path.join(self.temp_dir, f"{destination}-source"),
+                "destination_path": os.path.join(self.temp_dir, destination), **options}
+
+    # runs the scheduler on a thread, failing the test if it doesn't return by itself
+    def run_scheduler(self, path, once, timeout=10) -> JobScheduler:
+        (jobs, max_concurrent_jobs, device_limits) = load_job_file(path)
+        job_scheduler = JobScheduler(jobs, max_concurrent_jobs, device_limits)
+        thread = threading.Thread(target=job_scheduler.run, args=(once,))
+        thread.start()
+        thread.join(timeout)
+        if thread.is_alive():
+            job_scheduler.stop()
+            thread.join()
+            self.fail("The scheduler didn't exit")
+        return job_scheduler
+
+    def test_device_limits(self):
+        path = self.job_file([self.job(name) for name in ("a1", "a2", "a3", "b1", "b2", "c1")],
+                             max_concurrent_jobs=4, device_limits={"default": 1, os.path.join(self.temp_dir, "b1"): 2})
+        job_scheduler = self.run_scheduler(path, once=True)
+
+        self.assertEqual(len(self.recorder.started), 6)
+        self.assertEqual(self.recorder.most_running[1], 1)
+        self.assertEqual(self.recorder.most_running[2], 2)
+        self.assertEqual(self.recorder.most_running[3], 1)
+        # jobs on the other devices ran while the device 1 jobs queued up
+        self.assertGreater(self.recorder.most_running["all"], 1)
+        self.assertLessEqual(self.recorder.most_running["all"], 4)
+        self.assertTrue(all(job.last_result is not None for job in job_scheduler.jobs))
+
+    def test_priorities(self):
+        path = self.job_file([self.job("a1", priority=1), self.job("b1", priority=5), self.job("c1", priority=3)],
+                             max_concurrent_jobs=1)
+        self.run_scheduler(path, once=True)
+        self.assertEqual(self.recorder.started, ["b1", "c1", "a1"])
+
+    # without --once, jobs with no interval run a single time and the scheduler exits when they're done
+    def test_exits_when_no_job_has_an_interval(self):
+        path = self.job_file([self.job("a1"), self.job("b1", interval=0)])
+        job_scheduler = self.run_scheduler(path, once=False)
+        self.assertEqual(sorted(self.recorder.started), ["a1", "b1"])
+        self.assertEqual([job.runs for job in job_scheduler.jobs], [1, 1])
+
+    def test_interval_jobs_run_again(self):
+        path = self.job_file([self.job("a1", interval=0.2), self.job("b1")])
+        (jobs, max_concurrent_jobs, device_limits) = load_job_file(path)
+        job_scheduler = JobScheduler(jobs, max_concurrent_jobs, device_limits)
+        thread = threading.Thread(target=job_scheduler.run)
+        thread.start()
+        time.sleep(1)
+        job_scheduler.stop()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertGreaterEqual(self.recorder.started.count("a1"), 3)
+        self.assertEqual(self.recorder.started.count("b1"), 1)
+
+    def test_job_file_validation(self):
+        job = load_job_file(self.job_file([self.job("a1", compress_backup=1, cloud_providers="google_drive", copy_workers=4)]))[0][0]
+        self.assertEqual(job.config.compress_backup, "1")
+        self.assertEqual(job.config.cloud_providers, ["google_drive"])
+        self.assertEqual(job.config.copy_workers, 4)
+
+        invalid = {
+            "the main.py flag instead of the job key": self.job("a1", mode="incremental"),
+            "low_priority": self.job("a1", low_priority="1"),
+            "missing destination": {"source_path": os.path.join(self.temp_dir, "a1-source")},
+            "compression level": self.job("a1", compress_backup="1", codec="deflate", compress_level=12)
+        }
+        for (reason, entry) in invalid.items():
+            with self.subTest(reason=reason):
+                with self.assertRaises(ValueError):
+                    load_job_file(self.job_file([entry]))
+        with self.assertRaisesRegex(ValueError, "low_priority"):
+            load_job_file(self.job_file([self.job("a1")], defaults={"low_priority": "1"}))
+        with self.assertRaisesRegex(ValueError, "unique"):
+            load_job_file(self.job_file([self.job("a1"), self.job("a1")]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+import os
+import sys
+import json
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import unittest
+
+from unittest import mock
+
+# the tests import the backup script's modules from the repository root
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import tree_walker
+
+from backup_config import BackupConfig
+from local_backup_manager import LocalBackupManager
+from tree_walker import TreeWalker, WalkError
+
+FILES = {
+    "a.txt": b"a",
+    os.path.join("docs", "b.txt"): b"b",
+    os.path.join("private", "c.txt"): b"c"
+}
+
+
+'''
+TreeWalker as every backup mode uses it: unreadable parts of the source fail the backup,
+and symlinked directories are backed up the same way in every mode
+'''
+class TreeWalkerTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.temp_dir, "data")
+        self.destination = os.path.join(self.temp_dir, "backups")
+        for (rel_path, data) in FILES.items():
+            path = os.path.join(self.source, rel_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+        self.private = os.path.join(self.source, "private")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def backup(self, name, **options):
+        config = BackupConfig(self.source, self.destination, "", name, options.pop("compress_backup", "0"), [], **options)
+        return LocalBackupManager(config, configure_logging=False).perform_backup()
+
+    # the private directory can't be listed (chmod doesn't stop root, so listing it is made to fail instead)
+    def unreadable_private(self):
+        real_scandir = os.scandir
+
+        def scandir(path="."):
+            if isinstance(path, str) and os.path.abspath(path) == self.private:
+                raise PermissionError(13, "Permission denied", path)
+            return real_scandir(path)
+
+        return mock.patch.object(tree_walker.os, "scandir", scandir)
+
+    def test_walk_collects_unreadable_directories(self):
+        walker = TreeWalker(self.source)
+        with self.unreadable_private():
+            names = {rel_path for (rel_path, path, st) in walker.files()}
+        self.assertEqual(names, {"a.txt", os.path.join("docs", "b.txt")})
+        self.assertEqual([path for (path, message) in walker.errors], [self.private])
+        with self.assertRaises(WalkError) as raised:
+            walker.check_errors()
+        self.assertIn(self.private, str(raised.exception))
+
+    def test_file_removed_while_walking_is_not_an_error(self):
+        walker = TreeWalker(self.source)
+        for (rel_dir, abs_dir, dirs, files) in walker.walk():
+            if not rel_dir:
+                shutil.rmtree(os.path.join(abs_dir, "docs"))
+        walker.check_errors()
+
+    def test_unreadable_directory_fails_every_mode(self):
+        modes = {
+            "copy": {},
+            "parallel copy": {"copy_workers": 4},
+            "incremental": {"backup_mode": "incremental"},
+            "dedup": {"backup_mode": "dedup"},
+            "stream": {"compress_backup": "1", "stream_archive": "1"}
+        }
+        for (mode, options) in modes.items():
+            with self.subTest(mode=mode):
+                with self.unreadable_private():
+                    self.assertIsNone(self.backup(mode, **options))
+                # nothing is left behind that looks like a finished backup
+                self.assertFalse(os.path.exists(os.path.join(self.destination, mode)))
+                self.assertFalse(os.path.exists(os.path.join(self.destination, mode + ".zip")))
+
+    # a failed scan doesn't remove the unreadable files from an existing incremental mirror
+    def test_unreadable_directory_keeps_incremental_mirror(self):
+        self.assertIsNotNone(self.backup("mirror", backup_mode="incremental"))
+        with self.unreadable_private():
+            self.assertIsNone(self.backup("mirror", backup_mode="incremental"))
+        with open(os.path.join(self.destination, "mirror", "private", "c.txt"), "rb") as f:
+            self.assertEqual(f.read(), b"c")
+
+    @unittest.skipUnless(hasattr(os, "symlink"), "symlinks aren't supported here")
+    def test_symlinked_directory_is_backed_up_in_every_mode(self):
+        linked = os.path.join(self.temp_dir, "linked")
+        os.makedirs(linked)
+        with open(os.path.join(linked, "d.txt"), "wb") as f:
+            f.write(b"d")
+        try:
+            os.symlink(linked, os.path.join(self.source, "link"), target_is_directory=True)
+        except OSError as e:
+            self.skipTest(f"unable to create a symlink: {e}")
+        expected = {"a.txt", "docs/b.txt", "private/c.txt", "link/d.txt"}
+
+        def walked(root):
+            return {rel_path.replace(os.sep, "/") for (rel_path, path, st) in TreeWalker(root, follow_symlinks=False).files()}
+
+        self.backup("copy")
+        self.assertEqual(walked(os.path.join(self.destination, "copy")), expected)
+
+        self.backup("incremental", backup_mode="incremental")
+        self.assertEqual(walked(os.path.join(self.destination, "incremental")), expected)
+
+        snapshot_path = self.backup("dedup", backup_mode="dedup")
+        with open(snapshot_path, "r", encoding="utf-8") as f:
+            self.assertEqual({rel_path.replace(os.sep, "/") for rel_path in json.load(f)["files"]}, expected)
+
+        zip_path = self.backup("stream", compress_backup="1", stream_archive="1")
+        with zipfile.ZipFile(zip_path) as zip_file:
+            self.assertEqual({name.split("/", 1)[1] for name in zip_file.namelist()}, expected)
+
+        tar_path = self.backup("tar", compress_backup="1", stream_archive="1", archive_format="tar")
+        with tarfile.open(tar_path) as tar:
+            members = {m.name.split("/", 1)[1]: m for m in tar.getmembers() if not m.isdir()}
+        self.assertEqual(set(members), expected)
+        self.assertTrue(all(m.isfile() for m in members.values()))
+
+
+if __name__ == "__main__":
+    unittest.main()
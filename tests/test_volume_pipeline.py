@@ -0,0 +1,78 @@
+import os
+import sys
+import glob
+import time
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+# the tests import the backup script's modules from the repository root
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from backup_config import BackupConfig
+from local_backup_manager import LocalBackupManager
+from volume_pipeline import VolumeWriter
+
+SOURCE_SIZE = 8 * 1024 * 1024 # 8 volumes of 1 MB, stored without compression
+UPLOAD_SECONDS = 0.05
+
+
+'''
+Streaming into volumes that are uploaded while the next ones are written (cloud uploads are replaced by a stub)
+'''
+class VolumeUploadTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.temp_dir, "data")
+        self.destination = os.path.join(self.temp_dir, "backups")
+        os.makedirs(self.source)
+        with open(os.path.join(self.source, "random.bin"), "wb") as f:
+            f.write(os.urandom(SOURCE_SIZE))
+        self.uploads = []
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def manager(self, upload) -> LocalBackupManager:
+        config = BackupConfig(self.source, self.destination, "", "volumes", "1", ["google_drive"], stream_archive="1",
+                              codec="stored", volume_size=1, max_pending_volumes=1)
+        manager = LocalBackupManager(config, configure_logging=False)
+
+        def upload_to_cloud(path):
+            self.uploads.append(os.path.basename(path))
+            return upload(path)
+
+        manager.upload_to_cloud = upload_to_cloud
+        return manager
+
+    def volumes(self) -> list:
+        return sorted(glob.glob(os.path.join(glob.escape(self.destination), "volumes.zip.*")))
+
+    def test_uploads_every_volume_and_times_the_uploads(self):
+        def upload(path):
+            time.sleep(UPLOAD_SECONDS)
+            return True
+
+        manager = self.manager(upload)
+        first_volume = manager.perform_backup()
+        volumes = self.volumes()
+        self.assertEqual(str(first_volume), volumes[0])
+        self.assertGreaterEqual(len(volumes), SOURCE_SIZE // (1024 * 1024))
+        self.assertEqual(self.uploads, [os.path.basename(v) for v in volumes])
+        self.assertGreaterEqual(manager.metrics.stages["upload"]["seconds"], UPLOAD_SECONDS * len(volumes))
+
+    def test_stops_after_the_first_failed_upload(self):
+        manager = self.manager(lambda path: False)
+        with mock.patch.object(VolumeWriter, "open_volume", autospec=True, side_effect=VolumeWriter.open_volume) as open_volume:
+            self.assertIsNone(manager.perform_backup())
+        # only the first volume was sent, and the archive wasn't written to the end
+        self.assertEqual(self.uploads, ["volumes.zip.001"])
+        self.assertLess(open_volume.call_count, SOURCE_SIZE // (1024 * 1024))
+        self.assertEqual(self.volumes(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
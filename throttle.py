@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import logging
+import threading
+
+# psutil is optional, without it only the CPU priority can be lowered (and only on Linux/macOS)
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+logger = logging.getLogger()
+
+BURST_SECONDS = 0.25 # bytes allowed through at once after being idle, in seconds of the rate
+LOW_PRIORITY_NICENESS = 10
+LOW_PRIORITY_IO_LEVEL = 7 # lowest level of the best-effort I/O class on Linux
+
+'''
+Token bucket limiting the bytes per second that pass through it, shared by every thread using it
+rate - bytes per second, 0 - unlimited
+A request bigger than what's in the bucket goes through straight away and leaves the bucket in debt,
+so the caller (and the next ones) sleep until the rate catches up. Blocks can be any size and
+the average rate still holds.
+'''
+class TokenBucket:
+    def __init__(self, rate=0):
+        self.lock = threading.Lock()
+        self.rate = 0
+        self.tokens = 0
+        self.updated = time.monotonic()
+        self.waited = 0 # total seconds callers slept
+        self.set_rate(rate)
+
+    # can be called while other threads are consuming, the new rate applies from the next request
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = max(0, rate)
+            self.tokens = min(self.tokens, self.rate * BURST_SECONDS)
+            self.updated = time.monotonic()
+
+    def is_limited(self) -> bool:
+        return self.rate > 0
+
+    def consume(self, nbytes):
+        if self.rate <= 0:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate * BURST_SECONDS, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= nbytes
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+            self.waited += delay
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+# wraps a file object so that everything read from it goes through a token bucket
+# length - (optional) number of bytes that will be read, reported by len() so HTTP clients send a Content-Length
+class ThrottledReader:
+    def __init__(self, fileobj, bucket, length=None):
+        self.fileobj = fileobj
+        self.bucket = bucket
+        self.remaining = length
+
+    def read(self, size=-1) -> bytes:
+        data = self.fileobj.read(size)
+        self.bucket.consume(len(data))
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        return data
+
+    def __len__(self) -> int:
+        return max(0, self.remaining or 0)
+
+
+'''
+Rate limits of a backup, in MB/s (0 - unlimited)
+io - bytes read from the source by the copy, compression, streaming and dedup stages
+upload - bytes sent to cloud services
+One instance can be shared by several backups (e.g. every run in watchdog mode),
+so changing its limits applies to the backup that is running as well.
+'''
+class BackupThrottle:
+    def __init__(self, io_limit=0, upload_limit=0):
+        self.io = TokenBucket()
+        self.upload = TokenBucket()
+        self.set_limits(io_limit, upload_limit)
+
+    @staticmethod
+    def from_config(config):
+        return BackupThrottle(config.io_limit, config.upload_limit)
+
+    def set_limits(self, io_limit, upload_limit):
+        self.io_limit = io_limit
+        self.upload_limit = upload_limit
+        self.io.set_rate(io_limit * 1024 * 1024)
+        self.upload.set_rate(upload_limit * 1024 * 1024)
+
+    def describe(self) -> str:
+        def limit(value):
+            return f"{value} MB/s" if value > 0 else "unlimited"
+        return f"I/O {limit(self.io_limit)}, upload {limit(self.upload_limit)}"
+
+
+'''
+JSON file holding the limits of a running process, e.g. {"io_limit": 20, "upload_limit": 5}
+poll() re-reads it whenever it's modified and applies it to the throttle, so the limits of a
+long-running watchdog can be changed (or lifted with 0) without restarting it
+'''
+class LimitsFile:
+    def __init__(self, path, throttle):
+        self.path = path
+        self.throttle = throttle
+        self.mtime_ns = None
+
+    def poll(self):
+        try:
+            mtime_ns = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime_ns == self.mtime_ns:
+            return
+        self.mtime_ns = mtime_ns
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                limits = json.load(f)
+            self.throttle.set_limits(float(limits.get("io_limit", self.throttle.io_limit)),
+                                     float(limits.get("upload_limit", self.throttle.upload_limit)))
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            logger.error(f"Unable to read the limits file {self.path}: {e}")
+            return
+        logger.info(f"Backup limits set from {self.path}: {self.throttle.describe()}")
+
+
+'''
+lowers the CPU and I/O priority of the process, so backups yield to everything else running on the machine
+on Linux priorities belong to each thread and are inherited by the threads it starts,
+so this has to be called before any worker threads are started
+'''
+def lower_priority():
+    if psutil is None:
+        if hasattr(os, "nice"):
+            os.nice(LOW_PRIORITY_NICENESS)
+            logger.warning("psutil isn't installed, only the CPU priority was lowered (not the I/O priority)")
+        else:
+            logger.warning("psutil isn't installed, unable to lower the priority of the backup")
+        return
+
+    process = psutil.Process()
+    try:
+        if os.name == "nt":
+            process.nice(psutil.BELOW_NORMAL_PRIORITY_CLASS)
+            process.ionice(psutil.IOPRIO_LOW)
+        else:
+            process.nice(LOW_PRIORITY_NICENESS)
+            if hasattr(process, "ionice"): # not available on macOS
+                process.ionice(psutil.IOPRIO_CLASS_BE, value=LOW_PRIORITY_IO_LEVEL)
+    except (psutil.Error, OSError) as e:
+        logger.warning(f"Unable to lower the priority of the backup: {e}")
+        return
+    logger.info("Running the backup with low CPU and I/O priority")
@@ -0,0 +1,204 @@
+import os
+import re
+import time
+import fnmatch
+import logging
+
+logger = logging.getLogger()
+
+# glob patterns are case-insensitive where file names are
+PATTERN_FLAGS = re.IGNORECASE if os.name == "nt" else 0
+
+# compiles a list of glob patterns into a single regex, None if there are no patterns
+def compile_patterns(patterns):
+    if not patterns:
+        return None
+    return re.compile("|".join(f"(?:{fnmatch.translate(p)})" for p in patterns), PATTERN_FLAGS)
+
+
+'''
+Include/exclude rules for the files that go into a backup, compiled once per backup
+exclude - glob patterns, a pattern without a "/" matches a file/directory name anywhere in the tree
+          (e.g. "node_modules", "*.tmp"), a pattern with a "/" matches the path relative to the source
+          (e.g. ".git/objects", "build/*/cache"); excluded directories are never walked into
+include - glob patterns in the same form, when set only files matching one of them are backed up
+          (directories are still walked, so "*.docx" picks up documents at any depth)
+min_size/max_size - in bytes, 0 - no limit
+min_age/max_age - in seconds since the file was last modified, 0 - no limit
+'''
+class WalkRules:
+    def __init__(self, include=None, exclude=None, min_size=0, max_size=0, min_age=0, max_age=0):
+        (self.include_names, self.include_paths) = self.split_patterns(include)
+        (self.exclude_names, self.exclude_paths) = self.split_patterns(exclude)
+        self.min_size = min_size
+        self.max_size = max_size
+        # ages are turned into mtime bounds once, instead of working out each file's age
+        now = time.time()
+        self.newest_mtime = now - min_age if min_age > 0 else None
+        self.oldest_mtime = now - max_age if max_age > 0 else None
+        self.uses_paths = self.include_paths is not None or self.exclude_paths is not None
+        # False when every file is kept, so walks without rules skip the checks
+        self.filters = (self.include_names is not None or self.exclude_names is not None or self.uses_paths
+                        or min_size > 0 or max_size > 0 or min_age > 0 or max_age > 0)
+
+    @staticmethod
+    def split_patterns(patterns) -> tuple:
+        patterns = [p.strip().strip("/") for p in patterns or [] if p.strip().strip("/")]
+        return (compile_patterns([p for p in patterns if "/" not in p]),
+                compile_patterns([p for p in patterns if "/" in p]))
+
+    # sizes in MB and ages in days, as they are given on the command line
+    @staticmethod
+    def from_config(config):
+        return WalkRules(config.include, config.exclude,
+                         int(config.min_file_size * 1024 * 1024), int(config.max_file_size * 1024 * 1024),
+                         config.min_age * 86400, config.max_age * 86400)
+
+    # rel_path is only needed by "/" patterns, it is "/" separated
+    def is_excluded(self, name, rel_path) -> bool:
+        if self.exclude_names is not None and self.exclude_names.match(name):
+            return True
+        return self.exclude_paths is not None and self.exclude_paths.match(rel_path) is not None
+
+    def keep_file(self, name, rel_path, st) -> bool:
+        if self.is_excluded(name, rel_path):
+            return False
+        if self.include_names is not None or self.include_paths is not None:
+            if not ((self.include_names is not None and self.include_names.match(name)) or
+                    (self.include_paths is not None and self.include_paths.match(rel_path))):
+                return False
+        if st.st_size < self.min_size or (self.max_size and st.st_size > self.max_size):
+            return False
+        if self.newest_mtime is not None and st.st_mtime > self.newest_mtime:
+            return False
+        if self.oldest_mtime is not None and st.st_mtime < self.oldest_mtime:
+            return False
+        return True
+
+    # checks a path found some other way than walking (e.g. a watchdog event): excluded if it
+    # or any of its parent directories is, st - its stat result when it's a file
+    def keep_path(self, rel_path, st=None) -> bool:
+        parts = rel_path.replace(os.sep, "/").split("/")
+        for i in range(len(parts) - 1):
+            if self.is_excluded(parts[i], "/".join(parts[:i + 1])):
+                return False
+        if st is None:
+            return not self.is_excluded(parts[-1], "/".join(parts))
+        return self.keep_file(parts[-1], "/".join(parts), st)
+
+
+# rules that keep everything, used when a walk doesn't filter
+NO_RULES = WalkRules()
+
+
+# raised once a walk is over when part of the tree couldn't be read, so a backup with files missing
+# doesn't look like a successful one (the same as shutil.copytree() raising shutil.Error)
+class WalkError(OSError):
+    def __init__(self, root, errors):
+        self.errors = errors # (path, error message) of everything that couldn't be read
+        (path, message) = errors[0]
+        more = f" and {len(errors) - 1} more" if len(errors) > 1 else ""
+        super().__init__(f"Unable to read {path}{more} under {root}: {message}")
+
+
+'''
+Walks a tree with os.scandir(), the shared walker behind every stage of a backup
+- the stat() result of each file comes from its directory entry and is handed to the caller, so
+  sizes/mtimes are never looked up again (on Windows scandir() returns them without any extra call)
+- excluded directories are pruned without being listed, excluded files are never stat'ed
+  unless a size/age rule needs them
+- only regular files and directories are returned, sockets/FIFOs/devices are skipped
+- directories and files that can't be read are logged and collected in errors, files removed while
+  the tree is walked are left out, check_errors() raises a WalkError once the walk is over
+follow_symlinks - walk into symlinked directories (the same as shutil.copytree()), symlinks back
+                  into one of their own parents are skipped instead of looping forever
+                  every stage of a backup follows them, so all the backup modes store the same files
+                  (symlinked files are always followed and returned as the files they point at)
+'''
+class TreeWalker:
+    def __init__(self, root, rules=None, follow_symlinks=True):
+        self.root = root
+        self.rules = rules or NO_RULES
+        self.follow_symlinks = follow_symlinks
+        self.excluded_files = 0
+        self.excluded_dirs = 0
+        self.errors = []
+
+    '''
+    yields (rel_dir, abs_dir, dirs, files) top-down, like os.walk()
+    rel_dir - "" for the root, os.sep separated otherwise
+    dirs - names of the subdirectories that will be walked
+    files - (name, stat_result) of the files that passed the rules
+    start - (optional) relative path of a subdirectory to walk instead of the whole tree
+    '''
+    def walk(self, start=""):
+        pending = [start]
+        rules = self.rules
+        while pending:
+            rel_dir = pending.pop()
+            abs_dir = os.path.join(self.root, rel_dir) if rel_dir else self.root
+            dirs = []
+            files = []
+            try:
+                with os.scandir(abs_dir) as it:
+                    entries = list(it)
+            except OSError as e:
+                if isinstance(e, FileNotFoundError) and rel_dir != start:
+                    logger.debug("Skipping %s, it was removed while walking the tree", abs_dir)
+                else:
+                    self.add_error(abs_dir, e)
+                continue
+
+            for entry in entries:
+                rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                key = rel_path.replace(os.sep, "/") if rules.uses_paths and os.sep != "/" else rel_path
+                try:
+                    if entry.is_dir(follow_symlinks=self.follow_symlinks):
+                        if rules.filters and rules.is_excluded(entry.name, key):
+                            self.excluded_dirs += 1
+                        elif not entry.is_symlink() or not self.is_loop(entry.path):
+                            dirs.append(entry.name)
+                    elif entry.is_file():
+                        if not rules.filters or not rules.is_excluded(entry.name, key):
+                            st = entry.stat()
+                            if not rules.filters or rules.keep_file(entry.name, key, st):
+                                files.append((entry.name, st))
+                                continue
+                        self.excluded_files += 1
+                except FileNotFoundError:
+                    logger.debug("Skipping %s, it was removed after its directory was listed", entry.path)
+                except OSError as e:
+                    self.add_error(entry.path, e)
+
+            yield (rel_dir, abs_dir, dirs, files)
+            # pushed in reverse so subdirectories are walked in listing order
+            for name in reversed(dirs):
+                pending.append(os.path.join(rel_dir, name) if rel_dir else name)
+
+    # yields (rel_path, abs_path, stat_result) for every file that passed the rules
+    def files(self, start=""):
+        for (rel_dir, abs_dir, dirs, files) in self.walk(start):
+            for (name, st) in files:
+                yield (os.path.join(rel_dir, name) if rel_dir else name, os.path.join(abs_dir, name), st)
+
+    def add_error(self, path, error):
+        logger.error(f"Unable to read {path}: {error}")
+        self.errors.append((path, str(error)))
+
+    # raises a WalkError if anything couldn't be read, called once the walk is over
+    def check_errors(self):
+        if self.errors:
+            raise WalkError(self.root, self.errors)
+
+    # a symlinked directory that points at the root or one of the directories above it
+    def is_loop(self, path) -> bool:
+        target = os.path.realpath(path)
+        parent = os.path.realpath(os.path.dirname(path))
+        if parent == target or parent.startswith(target.rstrip(os.sep) + os.sep):
+            logger.warning(f"Skipping symlink loop: {path} -> {target}")
+            return True
+        return False
+
+    def log_excluded(self):
+        if self.excluded_files or self.excluded_dirs:
+            logger.info(f"Excluded {self.excluded_files} files and {self.excluded_dirs} directories under {self.root}")
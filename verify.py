@@ -0,0 +1,149 @@
+import os
+import sys
+import logging
+import zipfile
+import argparse
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from hash_manifest import HashManifest, hash_file, manifest_path_for, new_hasher, to_key
+from tree_walker import TreeWalker
+
+logger = logging.getLogger()
+
+ZIP_READ_BLOCK_SIZE = 1024 * 1024 # 1 MiB reads when hashing ZIP members
+
+# results of verifying a backup against its hash manifest
+class VerifyReport:
+    def __init__(self):
+        self.checked = 0
+        self.mismatched = [] # files whose content changed
+        self.missing = [] # files in the manifest that aren't in the backup
+        self.extra = [] # files in the backup that aren't in the manifest
+
+    def ok(self) -> bool:
+        return not self.mismatched and not self.missing
+
+    def summary(self) -> str:
+        return (f"{self.checked} files checked, {len(self.mismatched)} mismatched, "
+                f"{len(self.missing)} missing, {len(self.extra)} not in the manifest")
+
+
+'''
+Re-hashes a backup (a directory copy, a single file or a ZIP) and compares it against the
+hash manifest written with it (<backup>.hashes.json by default)
+Files are read through memory maps and ZIP members decompressed on a pool of worker threads
+(hashing and zlib release the GIL, so this scales across cores)
+'''
+class BackupVerifier:
+    def __init__(self, backup_path, manifest_path=None, workers=None):
+        self.backup_path = backup_path
+        self.manifest = HashManifest(manifest_path or manifest_path_for(backup_path)).load()
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.local = threading.local() # one open ZipFile per worker thread
+        self.open_zips = []
+
+    def verify(self) -> VerifyReport:
+        logger.info(f"Verifying {self.backup_path} against {self.manifest.manifest_path} "
+                    f"({len(self.manifest.files)} files, {self.manifest.algorithm})...")
+        report = VerifyReport()
+
+        if self.manifest.kind == "zip":
+            with zipfile.ZipFile(self.backup_path) as zip_file:
+                names = {info.filename for info in zip_file.infolist() if not info.is_dir()}
+            try:
+                self.check_all(report, self.hash_zip_member, names)
+            finally:
+                for zip_file in self.open_zips:
+                    zip_file.close()
+                self.open_zips = []
+        elif self.manifest.kind == "dir":
+            names = {to_key(rel_path) for (rel_path, path, st) in TreeWalker(self.backup_path).files()}
+            self.check_all(report, self.hash_member_file, names)
+        else:
+            names = set(self.manifest.files) if os.path.isfile(self.backup_path) else set()
+            self.check_all(report, lambda key: hash_file(self.backup_path, self.manifest.algorithm), names)
+
+        for key in report.mismatched:
+            logger.error(f"Hash mismatch: {key}")
+        for key in report.missing:
+            logger.error(f"Missing from the backup: {key}")
+        for key in report.extra:
+            logger.warning(f"Not in the hash manifest: {key}")
+
+        if report.ok():
+            logger.info(f"Verification passed: {report.summary()}")
+        else:
+            logger.error(f"Verification FAILED: {report.summary()}")
+        return report
+
+    # hashes every file that's both in the manifest and the backup (names) in parallel
+    def check_all(self, report, hash_function, names):
+        expected = self.manifest.files
+        report.missing = sorted(set(expected) - names)
+        report.extra = sorted(names - set(expected))
+        keys = sorted(names & set(expected))
+
+        # an unreadable file/member counts as a mismatch instead of stopping the whole run
+        def safe_hash(key):
+            try:
+                return hash_function(key)
+            except (OSError, zipfile.BadZipFile) as e:
+                logger.error(f"Unable to read {key}: {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for (key, digest) in zip(keys, pool.map(safe_hash, keys)):
+                report.checked += 1
+                if digest != expected[key]:
+                    report.mismatched.append(key)
+
+    def hash_member_file(self, key) -> str:
+        return hash_file(os.path.join(self.backup_path, *key.split("/")), self.manifest.algorithm)
+
+    def hash_zip_member(self, name) -> str:
+        # ZipFile objects can't be shared between threads that read at the same time
+        zip_file = getattr(self.local, "zip_file", None)
+        if zip_file is None:
+            zip_file = self.local.zip_file = zipfile.ZipFile(self.backup_path)
+            self.open_zips.append(zip_file)
+
+        hasher = new_hasher(self.manifest.algorithm)
+        with zip_file.open(name) as member: # also checks the CRC stored in the archive
+            for block in iter(lambda: member.read(ZIP_READ_BLOCK_SIZE), b""):
+                hasher.update(block)
+        return hasher.hexdigest()
+
+
+def get_cmd_parser():
+    parser = argparse.ArgumentParser(
+        prog="File Backup Script Verifier",
+        description="Checks a backup directory, file or ZIP against the hash manifest written with it (--hash_manifest 1)")
+    parser.add_argument("backup_path",
+        help="Path of the backup to verify.")
+    parser.add_argument("--manifest",
+        help="Path of the hash manifest. Default: <backup_path>.hashes.json.",
+        default=None)
+    parser.add_argument("--workers",
+        help="Sets the number of files hashed at the same time. Default: one per CPU core.",
+        type=int,
+        default=None)
+    return parser
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(levelname)s] %(message)s"
+    )
+    args = get_cmd_parser().parse_args()
+
+    try:
+        report = BackupVerifier(args.backup_path, args.manifest, args.workers).verify()
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+        logger.error(f"Unable to verify {args.backup_path}: {e}")
+        sys.exit(2)
+
+    sys.exit(0 if report.ok() else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+import os
+import time
+import queue
+import logging
+import threading
+
+logger = logging.getLogger()
+
+'''
+Write-only file object that splits everything written to it into fixed-size volumes:
+<base_path>.001, <base_path>.002, ...
+Each volume is handed to on_sealed as soon as it is full (and the last one on close()).
+Concatenating the volumes in order gives back the original archive.
+If the archive fails while being written (an exception inside the with block), the volume being written
+is closed without being sealed, so a truncated volume is never handed to on_sealed.
+cancel - (optional) threading.Event, once it's set the next write raises, which stops the archive being written
+'''
+class VolumeWriter:
+    def __init__(self, base_path, volume_size, on_sealed=None, cancel=None):
+        if volume_size <= 0:
+            raise ValueError("Volume size must be greater than 0")
+
+        self.base_path = base_path
+        self.volume_size = volume_size
+        self.on_sealed = on_sealed
+        self.cancel = cancel
+        self.volumes = []
+        self.current = None
+        self.current_size = 0
+        self.closed = False
+
+    def volume_path(self, index) -> str:
+        return f"{self.base_path}.{index:03d}"
+
+    # archives are written as a stream, so the volumes can't be seeked
+    def seekable(self) -> bool:
+        return False
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if self.cancel is not None and self.cancel.is_set():
+            raise IOError(f"Writing {self.base_path} was cancelled")
+        view = memoryview(data)
+        written = 0
+        while written < len(view):
+            if self.current is None:
+                self.open_volume()
+
+            n = min(len(view) - written, self.volume_size - self.current_size)
+            self.current.write(view[written:written + n])
+            self.current_size += n
+            written += n
+
+            if self.current_size >= self.volume_size:
+                self.seal_volume()
+        return written
+
+    def flush(self):
+        if self.current is not None:
+            self.current.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.current is not None:
+            self.seal_volume()
+
+    # closes the volume being written without sealing it
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+
+    def open_volume(self):
+        path = self.volume_path(len(self.volumes) + 1)
+        self.current = open(path, "wb")
+        self.current_size = 0
+        self.volumes.append(path)
+
+    def seal_volume(self):
+        self.current.close()
+        self.current = None
+        if self.on_sealed:
+            self.on_sealed(self.volumes[-1])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+'''
+Producer/consumer pipeline that uploads volumes while the next ones are still being written
+upload_volume - called with the path of each sealed volume on a background thread, raises if the upload failed
+max_pending - number of sealed volumes allowed to wait for upload, once reached the writer blocks
+until the upload catches up, which bounds the extra disk space used
+Once a volume fails to upload, cancel is set (pass it to the VolumeWriter so it stops writing the archive)
+and the volumes still waiting are not uploaded.
+seconds - time from the start of the first upload until finish() returned, the uploads run while the
+archive is written, so this is what the upload stage took
+'''
+class VolumeUploadPipeline:
+    def __init__(self, upload_volume, max_pending=2):
+        self.upload_volume = upload_volume
+        self.queue = queue.Queue(maxsize=max(1, max_pending))
+        self.failed = []
+        self.uploaded = []
+        self.cancel = threading.Event()
+        self.started = None
+        self.seconds = 0.0
+        self.thread = threading.Thread(target=self.run, name="VolumeUploader", daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.finish()
+
+    def start(self):
+        self.thread.start()
+
+    # passed to VolumeWriter as on_sealed, blocks while max_pending volumes are waiting
+    def submit(self, path):
+        self.queue.put(path)
+
+    def finish(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.started is not None:
+            self.seconds = time.perf_counter() - self.started
+
+    def run(self):
+        while True:
+            path = self.queue.get()
+            if path is None:
+                return
+            if self.cancel.is_set():
+                continue # the archive won't be complete in the cloud anyway
+            if self.started is None:
+                self.started = time.perf_counter()
+            try:
+                logger.info(f"Uploading volume {os.path.basename(path)}...")
+                self.upload_volume(path)
+                self.uploaded.append(path)
+            except Exception as e:
+                logger.error(f"Failed to upload volume {path}: {e}")
+                self.failed.append(path)
+                self.cancel.set()